@@ -13,8 +13,8 @@ from .exposition import (
 )
 from .gc_collector import GC_COLLECTOR, GCCollector
 from .metrics import (
-    Counter, disable_created_metrics, enable_created_metrics, Enum, Gauge,
-    Histogram, Info, Summary,
+    Counter, disable_created_metrics, enable_created_metrics, Enum,
+    exponential_buckets, Gauge, Histogram, Info, linear_buckets, Summary,
 )
 from .metrics_core import Metric
 from .platform_collector import PLATFORM_COLLECTOR, PlatformCollector
@@ -31,6 +31,8 @@ __all__ = (
     'Histogram',
     'Info',
     'Enum',
+    'linear_buckets',
+    'exponential_buckets',
     'enable_created_metrics',
     'disable_created_metrics',
     'CONTENT_TYPE_LATEST',
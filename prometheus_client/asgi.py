@@ -1,12 +1,20 @@
-from typing import Callable
+from typing import Callable, Optional
 from urllib.parse import parse_qs
 
-from .exposition import _bake_output
+from .exposition import (
+    _bake_output, _OutputCache, _prefetch_chunks, _stream_output,
+)
 from .registry import Collector, REGISTRY
 
 
-def make_asgi_app(registry: Collector = REGISTRY, disable_compression: bool = False) -> Callable:
-    """Create a ASGI app which serves the metrics from a registry."""
+def make_asgi_app(registry: Collector = REGISTRY, disable_compression: bool = False,
+                  cache_max_age: Optional[float] = None) -> Callable:
+    """Create a ASGI app which serves the metrics from a registry.
+
+    If cache_max_age is set, the output is reused for scrapes made within that
+    many seconds of each other, rather than collecting the registry again.
+    """
+    cache = _OutputCache(cache_max_age) if cache_max_age else None
 
     async def prometheus_app(scope, receive, send):
         assert scope.get("type") == "http"
@@ -20,8 +28,14 @@ def make_asgi_app(registry: Collector = REGISTRY, disable_compression: bool = Fa
             value.decode("utf8") for (name, value) in scope.get('headers')
             if name.decode("utf8").lower() == 'accept-encoding'
         ])
-        # Bake output
-        status, headers, output = _bake_output(registry, accept_header, accept_encoding_header, params, disable_compression)
+        if cache is None:
+            # Stream output
+            status, headers, chunks = _stream_output(registry, accept_header, accept_encoding_header, params, disable_compression)
+            output, rest = _prefetch_chunks(chunks)
+        else:
+            # Bake output
+            status, headers, output = _bake_output(registry, accept_header, accept_encoding_header, params, disable_compression, cache)
+            rest = None
         formatted_headers = []
         for header in headers:
             formatted_headers.append(tuple(x.encode('utf8') for x in header))
@@ -35,6 +49,12 @@ def make_asgi_app(registry: Collector = REGISTRY, disable_compression: bool = Fa
                     "headers": formatted_headers,
                 }
             )
+            if rest is not None:
+                # Each chunk is sent once the next one exists, so the last
+                # one can be sent without more_body.
+                for chunk in rest:
+                    await send({"type": "http.response.body", "body": output, "more_body": True})
+                    output = chunk
             await send({"type": "http.response.body", "body": output})
 
     return prometheus_app
@@ -5,7 +5,9 @@ from .metrics_core import (
     SummaryMetricFamily, UnknownMetricFamily, UntypedMetricFamily,
 )
 from .registry import CollectorRegistry, REGISTRY
-from .samples import BucketSpan, Exemplar, NativeHistogram, Sample, Timestamp
+from .samples import (
+    BucketSpan, Exemplar, LabelSet, NativeHistogram, Sample, Timestamp,
+)
 
 __all__ = (
     'BucketSpan',
@@ -21,6 +23,7 @@ __all__ = (
     'HistogramMetricFamily',
     'Info',
     'InfoMetricFamily',
+    'LabelSet',
     'Metric',
     'NativeHistogram',
     'REGISTRY',
@@ -3,14 +3,17 @@ from contextlib import closing
 from functools import partial
 import gzip
 from http.server import BaseHTTPRequestHandler
+import itertools
 import os
 import socket
 from socketserver import ThreadingMixIn
 import ssl
 import sys
 import threading
+import time
 from typing import (
-    Any, Callable, Dict, List, Literal, Optional, Sequence, Tuple, Union,
+    Any, Callable, Dict, Iterable, Iterator, List, Literal, Optional, Sequence,
+    Tuple, Union,
 )
 from urllib.error import HTTPError
 from urllib.parse import parse_qs, quote_plus, urlparse
@@ -19,9 +22,12 @@ from urllib.request import (
     Request,
 )
 from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+import zlib
 
 from .openmetrics import exposition as openmetrics
+from .protobuf import exposition as protobuf
 from .registry import Collector, REGISTRY
+from .samples import LabelSet
 from .utils import floatToGoString, parse_version
 
 try:
@@ -37,6 +43,7 @@ __all__ = (
     'CONTENT_TYPE_PLAIN_1_0_0',
     'delete_from_gateway',
     'generate_latest',
+    'generate_latest_chunks',
     'instance_ip_grouping_key',
     'make_asgi_app',
     'make_wsgi_app',
@@ -113,23 +120,142 @@ class _PrometheusRedirectHandler(HTTPRedirectHandler):
         return new_request
 
 
-def _bake_output(registry, accept_header, accept_encoding_header, params, disable_compression):
+class _OutputCache:
+    """Baked output shared by the scrapes made within max_age seconds.
+
+    Outputs are keyed by content type, compression and name[] filter. When
+    several scrapes miss at once, only the first one bakes the output and the
+    others wait for it.
+    """
+    MAX_ENTRIES = 64
+
+    def __init__(self, max_age: float):
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        # Key to [expiry, lock for baking, output].
+        self._entries: Dict[Tuple, List] = {}
+
+    def _get_entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.MAX_ENTRIES:
+                    # Every name[] filter gets its own entry, so drop the
+                    # expired ones before adding another.
+                    now = time.monotonic()
+                    for k, e in list(self._entries.items()):
+                        if e[0] <= now and not e[1].locked():
+                            del self._entries[k]
+                    if len(self._entries) >= self.MAX_ENTRIES:
+                        return None
+                entry = self._entries[key] = [0.0, threading.Lock(), None]
+            return entry
+
+    def get(self, key, bake):
+        entry = self._get_entry(key)
+        if entry is None:
+            return bake()
+        if time.monotonic() < entry[0]:
+            return entry[2]
+        with entry[1]:
+            if time.monotonic() >= entry[0]:
+                entry[2] = bake()
+                entry[0] = time.monotonic() + self._max_age
+            return entry[2]
+
+
+def _bake_output(registry, accept_header, accept_encoding_header, params, disable_compression, cache=None):
     """Bake output for metrics output."""
     # Choose the correct plain text format of the output.
     encoder, content_type = choose_encoder(accept_header)
+    compress = not disable_compression and gzip_accepted(accept_encoding_header)
+    if cache is not None:
+        key = (content_type, compress, tuple(sorted(params.get('name[]', ()))))
+        status, headers, output = cache.get(key, lambda: _bake_encoded_output(registry, encoder, content_type, params, compress))
+        # Servers may add to the headers, so each response gets its own list.
+        return status, list(headers), output
+    return _bake_encoded_output(registry, encoder, content_type, params, compress)
+
+
+def _bake_encoded_output(registry, encoder, content_type, params, compress):
     if 'name[]' in params:
         registry = registry.restricted_registry(params['name[]'])
     output = encoder(registry)
     headers = [('Content-Type', content_type)]
     # If gzip encoding required, gzip the output.
-    if not disable_compression and gzip_accepted(accept_encoding_header):
+    if compress:
         output = gzip.compress(output)
         headers.append(('Content-Encoding', 'gzip'))
     return '200 OK', headers, output
 
 
-def make_wsgi_app(registry: Collector = REGISTRY, disable_compression: bool = False) -> Callable:
-    """Create a WSGI app which serves the metrics from a registry."""
+def _stream_output(registry, accept_header, accept_encoding_header, params, disable_compression):
+    """Like _bake_output, but the output is an iterator of chunks.
+
+    The registry is collected while the output is consumed, so the whole
+    output is never held in memory at once.
+    """
+    encoder, content_type = _choose_chunk_encoder(accept_header)
+    if 'name[]' in params:
+        registry = registry.restricted_registry(params['name[]'])
+    chunks = encoder(registry)
+    headers = [('Content-Type', content_type)]
+    if not disable_compression and gzip_accepted(accept_encoding_header):
+        chunks = _gzip_chunks(chunks)
+        headers.append(('Content-Encoding', 'gzip'))
+    return '200 OK', headers, _coalesce_chunks(chunks)
+
+
+def _gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    # The compressor only emits output once it has a block of data, so most
+    # of these are empty, and they are joined by _coalesce_chunks.
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+# Chunks are joined until they reach this size, to not send or compress a
+# tiny chunk per metric family.
+_STREAM_CHUNK_SIZE = 1 << 16
+
+
+def _coalesce_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    buffered: List[bytes] = []
+    size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= _STREAM_CHUNK_SIZE:
+            yield b''.join(buffered)
+            buffered = []
+            size = 0
+    if size:
+        yield b''.join(buffered)
+
+
+def _prefetch_chunks(chunks: Iterable[bytes]) -> Tuple[bytes, Optional[Iterator[bytes]]]:
+    """Return the first chunk, and an iterator of the rest if there are more.
+
+    The first chunk is produced before the response is started, so that
+    errors collecting it can still result in an error response, and outputs
+    that fit in a single chunk are sent as one.
+    """
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    for second in chunks:
+        return first, itertools.chain((second,), chunks)
+    return first, None
+
+
+def make_wsgi_app(registry: Collector = REGISTRY, disable_compression: bool = False,
+                  cache_max_age: Optional[float] = None) -> Callable:
+    """Create a WSGI app which serves the metrics from a registry.
+
+    If cache_max_age is set, the output is reused for scrapes made within that
+    many seconds of each other, rather than collecting the registry again.
+    """
+    cache = _OutputCache(cache_max_age) if cache_max_age else None
 
     def prometheus_app(environ, start_response):
         # Prepare parameters
@@ -151,11 +277,19 @@ def make_wsgi_app(registry: Collector = REGISTRY, disable_compression: bool = Fa
             status = '200 OK'
             headers = []
             output = b''
-        else:
+        elif cache is None:
             # Note: For backwards compatibility, the URI path for GET is not
             # constrained to the documented /metrics, but any path is allowed.
+            # Stream output
+            status, headers, chunks = _stream_output(registry, accept_header, accept_encoding_header, params, disable_compression)
+            first, rest = _prefetch_chunks(chunks)
+            start_response(status, headers)
+            if rest is None:
+                return [first]
+            return itertools.chain((first,), rest)
+        else:
             # Bake output
-            status, headers, output = _bake_output(registry, accept_header, accept_encoding_header, params, disable_compression)
+            status, headers, output = _bake_output(registry, accept_header, accept_encoding_header, params, disable_compression, cache)
         # Return output
         start_response(status, headers)
         return [output]
@@ -240,6 +374,7 @@ def start_wsgi_server(
         client_capath: Optional[str] = None,
         protocol: int = ssl.PROTOCOL_TLS_SERVER,
         client_auth_required: bool = False,
+        cache_max_age: Optional[float] = None,
 ) -> Tuple[WSGIServer, threading.Thread]:
     """Starts a WSGI server for prometheus metrics as a daemon thread."""
 
@@ -247,7 +382,7 @@ def start_wsgi_server(
         """Copy of ThreadingWSGIServer to update address_family locally"""
 
     TmpServer.address_family, addr = _get_best_family(addr, port)
-    app = make_wsgi_app(registry)
+    app = make_wsgi_app(registry, cache_max_age=cache_max_age)
     httpd = make_server(addr, port, app, TmpServer, handler_class=_SilentHandler)
     if certfile and keyfile:
         context = _get_ssl_ctx(certfile, keyfile, protocol, client_cafile, client_capath, client_auth_required)
@@ -262,6 +397,13 @@ def start_wsgi_server(
 start_http_server = start_wsgi_server
 
 
+# HELP and TYPE lines of each metric family, and the rendered name and labels
+# of samples whose labels are not a LabelSet, as they rarely change between
+# scrapes.
+_headers = openmetrics._RenderCache()
+_sample_prefixes = openmetrics._RenderCache()
+
+
 def generate_latest(registry: Collector = REGISTRY, escaping: str = openmetrics.UNDERSCORES) -> bytes:
     """
     Generates the exposition format using the basic Prometheus text format.
@@ -272,31 +414,54 @@ def generate_latest(registry: Collector = REGISTRY, escaping: str = openmetrics.
 
     Returns: UTF-8 encoded string containing the metrics in text format.
     """
+    return b''.join(generate_latest_chunks(registry, escaping))
 
-    def sample_line(samples):
+
+def generate_latest_chunks(registry: Collector = REGISTRY, escaping: str = openmetrics.UNDERSCORES) -> Iterator[bytes]:
+    """
+    Generates the exposition format using the basic Prometheus text format,
+    one UTF-8 encoded chunk per metric family.
+
+    The registry is collected while the chunks are consumed, so the whole
+    exposition is never held in memory at once.
+    """
+
+    def sample_prefix(samples):
         if samples.labels:
-            labelstr = '{0}'.format(','.join(
-                # Label values always support UTF-8
-                ['{}="{}"'.format(
-                    openmetrics.escape_label_name(k, escaping), openmetrics._escape(v, openmetrics.ALLOWUTF8, False))
-                    for k, v in sorted(samples.labels.items())]))
+            labelstr = openmetrics._render_labels(samples.labels, escaping)
         else:
             labelstr = ''
-        timestamp = ''
-        if samples.timestamp is not None:
-            # Convert to milliseconds.
-            timestamp = f' {int(float(samples.timestamp) * 1000):d}'
         if escaping != openmetrics.ALLOWUTF8 or openmetrics._is_valid_legacy_metric_name(samples.name):
             if labelstr:
                 labelstr = '{{{0}}}'.format(labelstr)
-            return f'{openmetrics.escape_metric_name(samples.name, escaping)}{labelstr} {floatToGoString(samples.value)}{timestamp}\n'
+            return f'{openmetrics.escape_metric_name(samples.name, escaping)}{labelstr} '
         maybe_comma = ''
         if labelstr:
             maybe_comma = ','
-        return f'{{{openmetrics.escape_metric_name(samples.name, escaping)}{maybe_comma}{labelstr}}} {floatToGoString(samples.value)}{timestamp}\n'
+        return f'{{{openmetrics.escape_metric_name(samples.name, escaping)}{maybe_comma}{labelstr}}} '
 
-    output = []
+    def sample_line(samples):
+        labels = samples.labels
+        if isinstance(labels, LabelSet):
+            rendered = labels._renderings()
+            key = ('text', samples.name, labels._extra, escaping)
+            prefix = rendered.get(key)
+            if prefix is None:
+                prefix = rendered[key] = sample_prefix(samples)
+        else:
+            key = (samples.name, tuple(labels.items()), escaping)
+            prefix = _sample_prefixes.get(key)
+            if prefix is None:
+                prefix = _sample_prefixes.put(key, sample_prefix(samples))
+        if samples.timestamp is not None:
+            # Convert to milliseconds.
+            return f'{prefix}{floatToGoString(samples.value)} {int(float(samples.timestamp) * 1000):d}\n'
+        return f'{prefix}{floatToGoString(samples.value)}\n'
+
+    _headers.new_scrape()
+    _sample_prefixes.new_scrape()
     for metric in registry.collect():
+        output = []
         try:
             mname = metric.name
             mtype = metric.type
@@ -315,12 +480,21 @@ def generate_latest(registry: Collector = REGISTRY, escaping: str = openmetrics.
             elif mtype == 'unknown':
                 mtype = 'untyped'
 
-            output.append('# HELP {} {}\n'.format(
-                openmetrics.escape_metric_name(mname, escaping), metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
-            output.append(f'# TYPE {openmetrics.escape_metric_name(mname, escaping)} {mtype}\n')
+            key = (mname, mtype, metric.documentation, escaping)
+            header = _headers.get(key)
+            if header is None:
+                header = _headers.put(key, '# HELP {} {}\n# TYPE {} {}\n'.format(
+                    openmetrics.escape_metric_name(mname, escaping),
+                    metric.documentation.replace('\\', r'\\').replace('\n', r'\n'),
+                    openmetrics.escape_metric_name(mname, escaping),
+                    mtype))
+            output.append(header)
 
             om_samples: Dict[str, List[str]] = {}
             for s in metric.samples:
+                if s.native_histogram:
+                    # Native histograms cannot be represented in this format.
+                    continue
                 for suffix in ['_created', '_gsum', '_gcount']:
                     if s.name == metric.name + suffix:
                         # OpenMetrics specific sample, put in a gauge at the end.
@@ -337,10 +511,19 @@ def generate_latest(registry: Collector = REGISTRY, escaping: str = openmetrics.
                                                   metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
             output.append(f'# TYPE {openmetrics.escape_metric_name(metric.name + suffix, escaping)} gauge\n')
             output.extend(lines)
-    return ''.join(output).encode('utf-8')
+        yield ''.join(output).encode('utf-8')
 
 
 def choose_encoder(accept_header: str) -> Tuple[Callable[[Collector], bytes], str]:
+    encoder, content_type = _choose_chunk_encoder(accept_header)
+    return partial(_join_chunks, encoder), content_type
+
+
+def _join_chunks(encoder, registry):
+    return b''.join(encoder(registry))
+
+
+def _choose_chunk_encoder(accept_header: str) -> Tuple[Callable[[Collector], Iterator[bytes]], str]:
     # Python client library accepts a narrower range of content-types than
     # Prometheus does.
     accept_header = accept_header or ''
@@ -353,10 +536,17 @@ def choose_encoder(accept_header: str) -> Tuple[Callable[[Collector], bytes], st
             # Only return an escaping header if we have a good version and
             # mimetype.
             if not version:
-                return (partial(openmetrics.generate_latest, escaping=openmetrics.UNDERSCORES, version="1.0.0"), openmetrics.CONTENT_TYPE_LATEST)
+                return (partial(openmetrics.generate_latest_chunks, escaping=openmetrics.UNDERSCORES, version="1.0.0"), openmetrics.CONTENT_TYPE_LATEST)
             if version and parse_version(version) >= (1, 0, 0):
-                return (partial(openmetrics.generate_latest, escaping=escaping, version=version),
+                return (partial(openmetrics.generate_latest_chunks, escaping=escaping, version=version),
                         f'application/openmetrics-text; version={version}; charset=utf-8; escaping=' + str(escaping))
+        elif accepted.split(';')[0].strip() == 'application/vnd.google.protobuf':
+            toks = accepted.split(';')
+            if (_get_parameter(toks, 'proto') == 'io.prometheus.client.MetricFamily'
+                    and _get_parameter(toks, 'encoding') == 'delimited'):
+                escaping = _get_escaping(toks)
+                return (partial(protobuf.generate_latest_chunks, escaping=escaping),
+                        protobuf.CONTENT_TYPE_PROTOBUF + '; escaping=' + str(escaping))
         elif accepted.split(';')[0].strip() == 'text/plain':
             toks = accepted.split(';')
             version = _get_version(toks)
@@ -364,9 +554,9 @@ def choose_encoder(accept_header: str) -> Tuple[Callable[[Collector], bytes], st
             # Only return an escaping header if we have a good version and
             # mimetype.
             if version and parse_version(version) >= (1, 0, 0):
-                return (partial(generate_latest, escaping=escaping),
+                return (partial(generate_latest_chunks, escaping=escaping),
                         CONTENT_TYPE_LATEST + '; escaping=' + str(escaping))
-    return generate_latest, CONTENT_TYPE_PLAIN_0_0_4
+    return generate_latest_chunks, CONTENT_TYPE_PLAIN_0_0_4
 
 
 def _get_version(accept_header: List[str]) -> str:
@@ -374,11 +564,19 @@ def _get_version(accept_header: List[str]) -> str:
 
     If no version is specified, returns empty string."""
 
+    return _get_parameter(accept_header, 'version')
+
+
+def _get_parameter(accept_header: List[str], name: str) -> str:
+    """Return a parameter of a media type from the Accept header.
+
+    If the parameter is not specified, returns empty string."""
+
     for tok in accept_header:
         if '=' not in tok:
             continue
         key, value = tok.strip().split('=', 1)
-        if key == 'version':
+        if key == name:
             return value
     return ""
 
@@ -419,6 +617,7 @@ def gzip_accepted(accept_encoding_header: str) -> bool:
 class MetricsHandler(BaseHTTPRequestHandler):
     """HTTP handler that gives metrics from ``REGISTRY``."""
     registry: Collector = REGISTRY
+    _output_cache: Optional[_OutputCache] = None
 
     def do_GET(self) -> None:
         # Prepare parameters
@@ -426,22 +625,45 @@ class MetricsHandler(BaseHTTPRequestHandler):
         accept_header = self.headers.get('Accept')
         accept_encoding_header = self.headers.get('Accept-Encoding')
         params = parse_qs(urlparse(self.path).query)
-        # Bake output
-        status, headers, output = _bake_output(registry, accept_header, accept_encoding_header, params, False)
+        if self._output_cache is not None:
+            # Bake output
+            status, headers, output = _bake_output(registry, accept_header, accept_encoding_header, params, False, self._output_cache)
+            chunks: Iterable[bytes] = [output]
+        else:
+            # Stream output
+            status, headers, chunks = _stream_output(registry, accept_header, accept_encoding_header, params, False)
+            first, rest = _prefetch_chunks(chunks)
+            chunks = [first] if rest is None else itertools.chain((first,), rest)
+        # Chunked transfer encoding needs HTTP/1.1, otherwise the end of
+        # the output is marked by closing the connection.
+        chunked = self.protocol_version >= 'HTTP/1.1' and self.request_version >= 'HTTP/1.1'
+        if chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
         # Return output
         self.send_response(int(status.split(' ')[0]))
         for header in headers:
             self.send_header(*header)
         self.end_headers()
-        self.wfile.write(output)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
 
     def log_message(self, format: str, *args: Any) -> None:
         """Log nothing."""
 
     @classmethod
-    def factory(cls, registry: Collector) -> type:
+    def factory(cls, registry: Collector, cache_max_age: Optional[float] = None) -> type:
         """Returns a dynamic MetricsHandler class tied
            to the passed registry.
+
+           If cache_max_age is set, the output is reused for scrapes made
+           within that many seconds of each other.
         """
         # This implementation relies on MetricsHandler.registry
         #  (defined above and defaulted to REGISTRY).
@@ -450,7 +672,8 @@ class MetricsHandler(BaseHTTPRequestHandler):
         #  object for type().
         cls_name = str(cls.__name__)
         MyMetricsHandler = type(cls_name, (cls, object),
-                                {"registry": registry})
+                                {"registry": registry,
+                                 "_output_cache": _OutputCache(cache_max_age) if cache_max_age else None})
         return MyMetricsHandler
 
 
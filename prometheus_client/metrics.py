@@ -1,18 +1,23 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from operator import itemgetter
 import os
+import sys
 from threading import Lock
 import time
 import types
 from typing import (
-    Any, Callable, Dict, Iterable, List, Literal, Optional, Sequence, Tuple,
+    Any, Callable, Dict, Iterable, Literal, Optional, Sequence, Set, Tuple,
     Type, TypeVar, Union,
 )
-import warnings
 
 from . import values  # retain this import style for testability
 from .context_managers import ExceptionCounter, InprogressTracker, Timer
 from .metrics_core import Metric
-from .registry import Collector, CollectorRegistry, REGISTRY
-from .samples import Exemplar, Sample
+from .registry import (
+    CARDINALITY_POLICIES, Collector, CollectorRegistry, REGISTRY,
+)
+from .samples import Exemplar, LabelSet, Sample
 from .utils import floatToGoString, INF
 from .validation import (
     _validate_exemplar, _validate_labelnames, _validate_metric_name,
@@ -63,6 +68,19 @@ def enable_created_metrics():
 class MetricWrapperBase(Collector):
     _type: Optional[str] = None
     _reserved_labelnames: Sequence[str] = ()
+    # Set on children handed out by the 'reject' cardinality policy, which
+    # are not exposed and so must not write to the multiprocess files.
+    _detached = False
+    # When a child was last returned by labels(), if its parent has a TTL.
+    _last_access = 0.0
+    # Set by remove_expired() while it decides whether to remove the child.
+    _expiring = False
+    OVERFLOW_LABEL_VALUE = '__overflow__'
+    # Dropped labelsets are forgotten once there are this many, after which
+    # they are counted again.
+    _MAX_DROPPED_CHILDREN = 4096
+    # The labels of this child, built when it is first collected.
+    _labelset: Optional[LabelSet] = None
 
     def _is_observable(self):
         # Whether this metric is observable, i.e.
@@ -80,16 +98,40 @@ class MetricWrapperBase(Collector):
     def _is_parent(self):
         return self._labelnames and not self._labelvalues
 
+    def _get_value_class(self):
+        # Multiprocess mode always takes precedence, as values must end up in
+        # the mmaped files for the collecting process to see them.
+        if self._detached:
+            return values.MutexValue
+        if self._value_class is None or values.ValueClass._multiprocess:
+            return values.ValueClass
+        return self._value_class
+
     def _get_metric(self):
         return Metric(self._name, self._documentation, self._type, self._unit)
 
+    def _dropped_labelsets_documentation(self):
+        return f'Labelsets of {self._name} dropped because it reached {self._max_children} children.'
+
+    def _get_dropped_labelsets_metric(self):
+        return Metric(self._name + '_dropped_labelsets', self._dropped_labelsets_documentation(), 'counter')
+
     def describe(self) -> Iterable[Metric]:
+        if self._is_parent() and self._max_children is not None:
+            return [self._get_metric(), self._get_dropped_labelsets_metric()]
         return [self._get_metric()]
 
     def collect(self) -> Iterable[Metric]:
         metric = self._get_metric()
+        is_parent = self._is_parent()
         for suffix, labels, value, timestamp, exemplar, native_histogram_value in self._samples():
+            if not is_parent:
+                labels = self._sample_labels(labels)
             metric.add_sample(self._name + suffix, labels, value, timestamp, exemplar, native_histogram_value)
+        if self._is_parent() and self._max_children is not None:
+            dropped = self._get_dropped_labelsets_metric()
+            dropped.add_sample(self._name + '_dropped_labelsets_total', {}, self._dropped_labelsets.get())
+            return [metric, dropped]
         return [metric]
 
     def __str__(self) -> str:
@@ -108,6 +150,10 @@ class MetricWrapperBase(Collector):
                  unit: str = '',
                  registry: Optional[CollectorRegistry] = REGISTRY,
                  _labelvalues: Optional[Sequence[str]] = None,
+                 value_class: Optional[type] = None,
+                 max_children: Optional[int] = None,
+                 cardinality_policy: Optional[str] = None,
+                 ttl_seconds: Optional[float] = None,
                  ) -> None:
 
         self._original_name = name
@@ -119,13 +165,48 @@ class MetricWrapperBase(Collector):
         self._kwargs: Dict[str, Any] = {}
         self._documentation = documentation
         self._unit = unit
+        self._value_class = value_class
+        if value_class is not None:
+            self._kwargs['value_class'] = value_class
 
         _validate_metric_name(self._name)
 
         if self._is_parent():
             # Prepare the fields needed for child metrics.
+            if max_children is None and registry:
+                max_children = registry._max_children
+            if cardinality_policy is None:
+                cardinality_policy = registry._cardinality_policy if registry else 'overflow'
+            if max_children is not None and max_children < 1:
+                raise ValueError('max_children must be at least 1')
+            if cardinality_policy not in CARDINALITY_POLICIES:
+                raise ValueError('Invalid cardinality policy: ' + cardinality_policy)
+            if ttl_seconds is not None and ttl_seconds <= 0:
+                raise ValueError('ttl_seconds must be positive')
+            self._ttl_seconds = ttl_seconds
+            self._max_children = max_children
+            self._cardinality_policy = cardinality_policy
+            if max_children is not None:
+                # Stored like other values, so multiprocess mode sums it over processes.
+                self._dropped_labelsets = values.ValueClass(
+                    'counter', self._name + '_dropped_labelsets', self._name + '_dropped_labelsets_total',
+                    (), (), self._dropped_labelsets_documentation(),
+                )
+            self._overflow_labelvalues = (self.OVERFLOW_LABEL_VALUE,) * len(self._labelnames)
+            self._rejected_child = None
+            # Labelsets past max_children, mapped to the child they were given.
+            self._dropped_children: Dict[Sequence[str], T] = {}
+            # Children handed out by bind(), which are never evicted.
+            self._pinned: Set[Sequence[str]] = set()
+            # The evict policy keeps children in least recently used order.
+            self._evict = max_children is not None and cardinality_policy == 'evict'
             self._lock = Lock()
-            self._metrics: Dict[Sequence[str], T] = {}
+            self._metrics: Dict[Sequence[str], T] = OrderedDict() if self._evict else {}
+            # Used to validate and order label keyword arguments in labels().
+            self._labelname_set = frozenset(self._labelnames)
+            self._labelkwargs_getter = itemgetter(*self._labelnames)
+        else:
+            self._max_children = None
 
         if self._is_observable():
             self._metric_init()
@@ -157,57 +238,182 @@ class MetricWrapperBase(Collector):
 
         See the best practices on [naming](http://prometheus.io/docs/practices/naming/)
         and [labels](http://prometheus.io/docs/practices/instrumentation/#use-labels).
-        """
-        if not self._labelnames:
-            raise ValueError('No label names were set when constructing %s' % self)
 
-        if self._labelvalues:
+        If the metric was given max_children and already has that many
+        children, a new labelset is handled according to cardinality_policy:
+        'reject' returns a child which is not exposed, 'overflow' returns the
+        child with every label set to '__overflow__', and 'evict' removes the
+        least recently used child to make room. Each of these labelsets is
+        counted once in the <name>_dropped_labelsets_total counter.
+
+        If the metric was given ttl_seconds, children that were not returned
+        by labels() for that long are removed when the metric is collected,
+        or by remove_expired(). Children returned by bind() do not expire.
+        """
+        if self._labelvalues or not self._labelnames:
+            if not self._labelnames:
+                raise ValueError('No label names were set when constructing %s' % self)
             raise ValueError('{} already has labels set ({}); can not chain calls to .labels()'.format(
                 self,
                 dict(zip(self._labelnames, self._labelvalues))
             ))
 
-        if labelvalues and labelkwargs:
-            raise ValueError("Can't pass both *args and **kwargs")
-
         if labelkwargs:
-            if sorted(labelkwargs) != sorted(self._labelnames):
+            if labelvalues:
+                raise ValueError("Can't pass both *args and **kwargs")
+            if labelkwargs.keys() != self._labelname_set:
                 raise ValueError('Incorrect label names')
-            labelvalues = tuple(str(labelkwargs[l]) for l in self._labelnames)
+            if len(self._labelnames) == 1:
+                labelvalues = (str(self._labelkwargs_getter(labelkwargs)),)
+            else:
+                labelvalues = tuple(map(str, self._labelkwargs_getter(labelkwargs)))
         else:
             if len(labelvalues) != len(self._labelnames):
                 raise ValueError('Incorrect label count')
-            labelvalues = tuple(str(l) for l in labelvalues)
+            labelvalues = tuple(map(str, labelvalues))
+
+        # Existing children are looked up without taking the lock, which is
+        # only needed to create a child.
+        child = self._metrics.get(labelvalues)
+        if child is None:
+            # Labelsets dropped by max_children are remembered with the child
+            # they were given, so they are not counted or added again.
+            child = self._dropped_children.get(labelvalues)
+            if child is None:
+                with self._lock:
+                    child = self._metrics.get(labelvalues)
+                    if child is None:
+                        child = self._add_child(labelvalues)
+        elif self._evict:
+            with self._lock:
+                if labelvalues in self._metrics:
+                    self._metrics.move_to_end(labelvalues)  # type: ignore
+        if self._ttl_seconds is not None:
+            child._last_access = time.monotonic()
+            # remove_expired() marks a child before checking its access time,
+            # so it either sees this access, or the child is marked and may
+            # be removed, in which case it is looked up again under the lock.
+            if child._expiring:
+                with self._lock:
+                    child = self._metrics.get(labelvalues)
+                    if child is None:
+                        child = self._add_child(labelvalues)
+                    child._last_access = time.monotonic()
+        return child
+
+    def _new_child(self, labelvalues, detached=False):
+        original_name = getattr(self, '_original_name', self._name)
+        namespace = getattr(self, '_namespace', '')
+        subsystem = getattr(self, '_subsystem', '')
+        unit = getattr(self, '_unit', '')
+
+        child_kwargs = dict(self._kwargs) if self._kwargs else {}
+        for k in ('namespace', 'subsystem', 'unit'):
+            child_kwargs.pop(k, None)
+
+        cls = self.__class__
+        child = cls.__new__(cls)
+        child._detached = detached
+        child.__init__(
+            original_name,
+            documentation=self._documentation,
+            labelnames=self._labelnames,
+            namespace=namespace,
+            subsystem=subsystem,
+            unit=unit,
+            _labelvalues=labelvalues,
+            **child_kwargs
+        )
+        return child
+
+    def _add_child(self, labelvalues):
+        """Create the child for a new labelset. Lock must be held by caller."""
+        if self._max_children is not None:
+            children = len(self._metrics)
+            if self._overflow_labelvalues in self._metrics:
+                children -= 1
+            if children >= self._max_children:
+                self._dropped_labelsets.inc(1)
+                # Evicting fails when every child is bound, then the labelset is rejected.
+                if not (self._evict and self._evict_child()):
+                    return self._drop_labelset(labelvalues)
+        child = self._new_child(labelvalues)
+        child._last_access = time.monotonic()
+        self._metrics[labelvalues] = child
+        return child
+
+    def _drop_labelset(self, labelvalues):
+        """Return the child for a labelset past max_children. Lock must be held by caller."""
+        if self._cardinality_policy == 'overflow':
+            child = self._metrics.get(self._overflow_labelvalues)
+            if child is None:
+                child = self._new_child(self._overflow_labelvalues)
+                child._last_access = time.monotonic()
+                self._metrics[self._overflow_labelvalues] = child
+        else:
+            # Hand out a child that is not exposed, so updates are dropped.
+            if self._rejected_child is None:
+                self._rejected_child = self._new_child(labelvalues, detached=True)
+            child = self._rejected_child
+        if len(self._dropped_children) >= self._MAX_DROPPED_CHILDREN:
+            self._dropped_children = {}
+        self._dropped_children[labelvalues] = child
+        return child
+
+    def _evict_child(self):
+        """Remove the least recently used child. Lock must be held by caller."""
+        for labelvalues in self._metrics:
+            if labelvalues not in self._pinned and labelvalues != self._overflow_labelvalues:
+                self._remove_child(labelvalues)
+                return True
+        return False
+
+    def _remove_child(self, labelvalues):
+        """Remove a child, and its values from the multiprocess files. Lock must be held by caller."""
+        child = self._metrics.pop(labelvalues, None)
+        self._pinned.discard(labelvalues)
+        if child is not None:
+            child._remove_values()
+            # There may be room for the dropped labelsets now, and the
+            # overflow child may be gone.
+            self._dropped_children = {}
+
+    def _child_values(self):
+        """Return the value objects of a child."""
+        return ()
+
+    def _remove_values(self):
+        for value in self._child_values():
+            remove = getattr(value, 'remove', None)
+            if remove is not None:
+                remove()
+
+    def bind(self: T, *labelvalues: Any, **labelkwargs: Any) -> T:
+        """Return a handle on the child for the given labelset.
+
+        This takes the same arguments as labels(). The child is created if
+        needed, and can be kept by the caller to skip the label lookup on
+        every use:
+
+            from prometheus_client import Counter
+
+            c = Counter('my_requests_total', 'HTTP Failures', ['method', 'endpoint'])
+            get_root = c.bind('get', '/')
+
+            def handle():
+                get_root.inc()
+
+        The handle stays valid until the labelset is removed from the metric.
+        A bound child is never evicted to make room for other labelsets, and
+        does not expire.
+        """
+        child = self.labels(*labelvalues, **labelkwargs)
         with self._lock:
-            if labelvalues not in self._metrics:
-
-                original_name = getattr(self, '_original_name', self._name)
-                namespace = getattr(self, '_namespace', '')
-                subsystem = getattr(self, '_subsystem', '')
-                unit = getattr(self, '_unit', '')
-
-                child_kwargs = dict(self._kwargs) if self._kwargs else {}
-                for k in ('namespace', 'subsystem', 'unit'):
-                    child_kwargs.pop(k, None)
-
-                self._metrics[labelvalues] = self.__class__(
-                    original_name,
-                    documentation=self._documentation,
-                    labelnames=self._labelnames,
-                    namespace=namespace,
-                    subsystem=subsystem,
-                    unit=unit,
-                    _labelvalues=labelvalues,
-                    **child_kwargs
-                )
-            return self._metrics[labelvalues]
+            if child._labelvalues in self._metrics:
+                self._pinned.add(child._labelvalues)
+        return child
 
     def remove(self, *labelvalues: Any) -> None:
-        if 'prometheus_multiproc_dir' in os.environ or 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
-            warnings.warn(
-                "Removal of labels has not been implemented in  multi-process mode yet.",
-                UserWarning)
-
         if not self._labelnames:
             raise ValueError('No label names were set when constructing %s' % self)
 
@@ -216,17 +422,10 @@ class MetricWrapperBase(Collector):
             raise ValueError('Incorrect label count (expected %d, got %s)' % (len(self._labelnames), labelvalues))
         labelvalues = tuple(str(l) for l in labelvalues)
         with self._lock:
-            if labelvalues in self._metrics:
-                del self._metrics[labelvalues]
+            self._remove_child(labelvalues)
 
     def remove_by_labels(self, labels: dict[str, str]) -> None:
         """Remove all series whose labelset partially matches the given labels."""
-        if 'prometheus_multiproc_dir' in os.environ or 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
-            warnings.warn(
-                "Removal of labels has not been implemented in  multi-process mode yet.",
-                UserWarning
-            )
-
         if not self._labelnames:
             raise ValueError('No label names were set when constructing %s' % self)
         
@@ -248,18 +447,38 @@ class MetricWrapperBase(Collector):
             # list(...) to avoid "dictionary changed size during iteration"
             for lv in list(self._metrics.keys()):
                 if all(lv[pos] == want for pos, want in pos_filter.items()):
-                    # pop with default avoids KeyError if concurrently removed
-                    self._metrics.pop(lv, None)
+                    self._remove_child(lv)
         
 
     def clear(self) -> None:
         """Remove all labelsets from the metric"""
-        if 'prometheus_multiproc_dir' in os.environ or 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
-            warnings.warn(
-                "Clearing labels has not been implemented in multi-process mode yet",
-                UserWarning)
         with self._lock:
-            self._metrics = {}
+            children = self._metrics
+            self._metrics = OrderedDict() if self._evict else {}
+            self._pinned = set()
+            self._dropped_children = {}
+            for child in children.values():
+                child._remove_values()
+
+    def remove_expired(self) -> None:
+        """Remove the children not returned by labels() in the last ttl_seconds.
+
+        This is done on every collection, and can also be called periodically
+        to bound memory use of metrics that are rarely scraped.
+        """
+        if not self._is_parent() or self._ttl_seconds is None:
+            return
+        deadline = time.monotonic() - self._ttl_seconds
+        with self._lock:
+            for labelvalues, child in list(self._metrics.items()):
+                if child._last_access < deadline and labelvalues not in self._pinned:
+                    # labels() may have returned the child since its access
+                    # time was read, see there.
+                    child._expiring = True
+                    if child._last_access < deadline:
+                        self._remove_child(labelvalues)
+                    else:
+                        child._expiring = False
 
     def _samples(self) -> Iterable[Sample]:
         if self._is_parent():
@@ -268,12 +487,27 @@ class MetricWrapperBase(Collector):
             return self._child_samples()
 
     def _multi_samples(self) -> Iterable[Sample]:
+        self.remove_expired()
         with self._lock:
             metrics = self._metrics.copy()
-        for labels, metric in metrics.items():
-            series_labels = list(zip(self._labelnames, labels))
+        # The labels that samples add, such as le, are shared between children,
+        # as label sets keep them in the keys of their renderings.
+        extras: Dict[Tuple[Tuple[str, str], ...], Tuple[Tuple[str, str], ...]] = {}
+        for metric in metrics.values():
             for suffix, sample_labels, value, timestamp, exemplar, native_histogram_value in metric._samples():
-                yield Sample(suffix, dict(series_labels + list(sample_labels.items())), value, timestamp, exemplar, native_histogram_value)
+                yield Sample(suffix, metric._sample_labels(sample_labels, extras), value, timestamp, exemplar, native_histogram_value)
+
+    def _sample_labels(self, sample_labels: Dict[str, str], extras: Optional[Dict[Any, Any]] = None) -> LabelSet:
+        """Return the labels of this child together with the labels of one of its samples."""
+        labelset = self._labelset
+        if labelset is None:
+            labelset = self._labelset = LabelSet(zip(self._labelnames, self._labelvalues))
+        if sample_labels:
+            extra = tuple(sample_labels.items())
+            if extras is not None:
+                extra = extras.setdefault(extra, extra)
+            return labelset._extend(extra)
+        return labelset
 
     def _child_samples(self) -> Iterable[Sample]:  # pragma: no cover
         raise NotImplementedError('_child_samples() must be implemented by %r' % self)
@@ -328,10 +562,13 @@ class Counter(MetricWrapperBase):
     _type = 'counter'
 
     def _metric_init(self) -> None:
-        self._value = values.ValueClass(self._type, self._name, self._name + '_total', self._labelnames,
-                                        self._labelvalues, self._documentation)
+        self._value = self._get_value_class()(self._type, self._name, self._name + '_total', self._labelnames,
+                                              self._labelvalues, self._documentation)
         self._created = time.time()
 
+    def _child_values(self):
+        return (self._value,)
+
     def inc(self, amount: float = 1, exemplar: Optional[Dict[str, str]] = None) -> None:
         """Increment counter by the given amount."""
         self._raise_if_not_observable()
@@ -418,6 +655,10 @@ class Gauge(MetricWrapperBase):
                  registry: Optional[CollectorRegistry] = REGISTRY,
                  _labelvalues: Optional[Sequence[str]] = None,
                  multiprocess_mode: Literal['all', 'liveall', 'min', 'livemin', 'max', 'livemax', 'sum', 'livesum', 'mostrecent', 'livemostrecent'] = 'all',
+                 value_class: Optional[type] = None,
+                 max_children: Optional[int] = None,
+                 cardinality_policy: Optional[str] = None,
+                 ttl_seconds: Optional[float] = None,
                  ):
         self._multiprocess_mode = multiprocess_mode
         if multiprocess_mode not in self._MULTIPROC_MODES:
@@ -431,16 +672,23 @@ class Gauge(MetricWrapperBase):
             unit=unit,
             registry=registry,
             _labelvalues=_labelvalues,
+            value_class=value_class,
+            max_children=max_children,
+            cardinality_policy=cardinality_policy,
+            ttl_seconds=ttl_seconds,
         )
         self._kwargs['multiprocess_mode'] = self._multiprocess_mode
         self._is_most_recent = self._multiprocess_mode in self._MOST_RECENT_MODES
 
     def _metric_init(self) -> None:
-        self._value = values.ValueClass(
+        self._value = self._get_value_class()(
             self._type, self._name, self._name, self._labelnames, self._labelvalues,
             self._documentation, multiprocess_mode=self._multiprocess_mode
         )
 
+    def _child_values(self):
+        return (self._value,)
+
     def inc(self, amount: float = 1) -> None:
         """Increment gauge by the given amount."""
         if self._is_most_recent:
@@ -531,15 +779,92 @@ class Summary(MetricWrapperBase):
 
         with REQUEST_TIME.time():
             pass  # Logic to be timed
+
+    Passing `quantiles` additionally estimates those quantiles over a sliding
+    window of the last `max_age_seconds`, to within a relative error of
+    `quantile_relative_accuracy`. Memory per child is bounded regardless of
+    the number of observations:
+
+        s = Summary('request_latency_seconds', 'Latency', quantiles=(0.5, 0.9, 0.99))
+
+    Quantiles can not be aggregated across processes, so they do not work in
+    multiprocess mode.
     """
     _type = 'summary'
     _reserved_labelnames = ['quantile']
 
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Iterable[str] = (),
+                 namespace: str = '',
+                 subsystem: str = '',
+                 unit: str = '',
+                 registry: Optional[CollectorRegistry] = REGISTRY,
+                 _labelvalues: Optional[Sequence[str]] = None,
+                 value_class: Optional[type] = None,
+                 quantiles: Sequence[float] = (),
+                 max_age_seconds: float = 600,
+                 age_buckets: int = 5,
+                 quantile_relative_accuracy: float = 0.01,
+                 max_children: Optional[int] = None,
+                 cardinality_policy: Optional[str] = None,
+                 ttl_seconds: Optional[float] = None,
+                 ):
+        quantiles = tuple(float(q) for q in quantiles)
+        for q in quantiles:
+            if not 0 <= q <= 1:
+                raise ValueError('Quantiles must be between 0 and 1')
+        if quantiles:
+            if max_age_seconds <= 0:
+                raise ValueError('Summary max_age_seconds must be positive')
+            if age_buckets < 1:
+                raise ValueError('Summary must have at least one age bucket')
+            if not 0 < quantile_relative_accuracy < 1:
+                raise ValueError('Summary quantile_relative_accuracy must be between 0 and 1')
+            if values.ValueClass._multiprocess:
+                raise ValueError('Summary quantiles are not supported in multiprocess mode')
+        self._quantiles = quantiles
+        self._max_age_seconds = max_age_seconds
+        self._age_buckets = age_buckets
+        self._quantile_relative_accuracy = quantile_relative_accuracy
+        super().__init__(
+            name=name,
+            documentation=documentation,
+            labelnames=labelnames,
+            namespace=namespace,
+            subsystem=subsystem,
+            unit=unit,
+            registry=registry,
+            _labelvalues=_labelvalues,
+            value_class=value_class,
+            max_children=max_children,
+            cardinality_policy=cardinality_policy,
+            ttl_seconds=ttl_seconds,
+        )
+        if quantiles:
+            self._kwargs['quantiles'] = quantiles
+            self._kwargs['max_age_seconds'] = max_age_seconds
+            self._kwargs['age_buckets'] = age_buckets
+            self._kwargs['quantile_relative_accuracy'] = quantile_relative_accuracy
+
     def _metric_init(self) -> None:
-        self._count = values.ValueClass(self._type, self._name, self._name + '_count', self._labelnames,
-                                        self._labelvalues, self._documentation)
-        self._sum = values.ValueClass(self._type, self._name, self._name + '_sum', self._labelnames, self._labelvalues, self._documentation)
+        value_class = self._get_value_class()
+        self._count = value_class(self._type, self._name, self._name + '_count', self._labelnames,
+                                  self._labelvalues, self._documentation)
+        self._sum = value_class(self._type, self._name, self._name + '_sum', self._labelnames, self._labelvalues, self._documentation)
         self._created = time.time()
+        self._quantile_value: Optional[values.QuantileValue] = None
+        if self._quantiles:
+            self._quantile_value = values.QuantileValue(
+                self._quantiles,
+                self._quantile_relative_accuracy,
+                self._max_age_seconds,
+                self._age_buckets,
+            )
+
+    def _child_values(self):
+        return (self._count, self._sum)
 
     def observe(self, amount: float) -> None:
         """Observe the given amount.
@@ -554,6 +879,8 @@ class Summary(MetricWrapperBase):
         self._raise_if_not_observable()
         self._count.inc(1)
         self._sum.inc(amount)
+        if self._quantile_value is not None:
+            self._quantile_value.observe(amount)
 
     def time(self) -> Timer:
         """Time a block of code or function, and observe the duration in seconds.
@@ -563,7 +890,11 @@ class Summary(MetricWrapperBase):
         return Timer(self, 'observe')
 
     def _child_samples(self) -> Iterable[Sample]:
-        samples = [
+        samples = []
+        if self._quantile_value is not None:
+            for q, value in self._quantile_value.get():
+                samples.append(Sample('', {'quantile': floatToGoString(q)}, value, None, None))
+        samples += [
             Sample('_count', {}, self._count.get(), None, None),
             Sample('_sum', {}, self._sum.get(), None, None),
         ]
@@ -572,6 +903,43 @@ class Summary(MetricWrapperBase):
         return tuple(samples)
 
 
+def _round_buckets(bounds: Iterable[float]) -> Tuple[float, ...]:
+    # Drop floating point noise such as 0.30000000000000004, which would
+    # otherwise end up in the le label.
+    buckets = tuple(float(f'{bound:.15g}') for bound in bounds)
+    for lower, upper in zip(buckets, buckets[1:]):
+        if lower >= upper:
+            raise ValueError(f'Buckets are too close together, {lower} and {upper} can not be told apart')
+    return buckets
+
+
+def linear_buckets(start: float, width: float, count: int) -> Tuple[float, ...]:
+    """Return `count` histogram buckets, `width` apart, starting at `start`.
+
+    The +Inf bucket is not included, Histogram appends it automatically.
+    """
+    if count < 1:
+        raise ValueError('Must have at least one bucket')
+    if width <= 0:
+        raise ValueError('Bucket width must be positive')
+    return _round_buckets(start + i * width for i in range(count))
+
+
+def exponential_buckets(start: float, factor: float, count: int) -> Tuple[float, ...]:
+    """Return `count` histogram buckets, each `factor` times the previous one.
+
+    The first bucket is `start`, which must be positive. The +Inf bucket is
+    not included, Histogram appends it automatically.
+    """
+    if count < 1:
+        raise ValueError('Must have at least one bucket')
+    if start <= 0:
+        raise ValueError('Exponential buckets must start at a positive value')
+    if factor <= 1:
+        raise ValueError('Bucket factor must be greater than 1')
+    return _round_buckets(start * factor ** i for i in range(count))
+
+
 class Histogram(MetricWrapperBase):
     """A Histogram tracks the size and number of events in buckets.
 
@@ -606,10 +974,19 @@ class Histogram(MetricWrapperBase):
 
     The default buckets are intended to cover a typical web/rpc request from milliseconds to seconds.
     They can be overridden by passing `buckets` keyword argument to `Histogram`.
+
+    Passing `native_histogram_schema` additionally records observations in a
+    native (sparse exponential) histogram, which is exposed in OpenMetrics 2.0.
+    Pass `buckets=()` to only keep the classic +Inf bucket alongside it:
+
+        h = Histogram('request_latency_seconds', 'Latency', buckets=(), native_histogram_schema=3)
+
+    Native histograms are experimental and do not work in multiprocess mode.
     """
     _type = 'histogram'
     _reserved_labelnames = ['le']
     DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, INF)
+    DEFAULT_NATIVE_HISTOGRAM_ZERO_THRESHOLD = 2.938735877055719e-39  # 2 ** -128
 
     def __init__(self,
                  name: str,
@@ -621,7 +998,26 @@ class Histogram(MetricWrapperBase):
                  registry: Optional[CollectorRegistry] = REGISTRY,
                  _labelvalues: Optional[Sequence[str]] = None,
                  buckets: Sequence[Union[float, str]] = DEFAULT_BUCKETS,
+                 value_class: Optional[type] = None,
+                 native_histogram_schema: Optional[int] = None,
+                 native_histogram_zero_threshold: float = DEFAULT_NATIVE_HISTOGRAM_ZERO_THRESHOLD,
+                 native_histogram_max_buckets: int = 160,
+                 max_children: Optional[int] = None,
+                 cardinality_policy: Optional[str] = None,
+                 ttl_seconds: Optional[float] = None,
                  ):
+        if native_histogram_schema is not None:
+            if not -4 <= native_histogram_schema <= 8:
+                raise ValueError('Native histogram schema must be between -4 and 8')
+            if native_histogram_zero_threshold < 0:
+                raise ValueError('Native histogram zero threshold must not be negative')
+            if native_histogram_max_buckets < 1:
+                raise ValueError('Native histogram must allow at least one bucket')
+            if values.ValueClass._multiprocess:
+                raise ValueError('Native histograms are not supported in multiprocess mode')
+        self._native_histogram_schema = native_histogram_schema
+        self._native_histogram_zero_threshold = native_histogram_zero_threshold
+        self._native_histogram_max_buckets = native_histogram_max_buckets
         self._prepare_buckets(buckets)
         super().__init__(
             name=name,
@@ -632,8 +1028,16 @@ class Histogram(MetricWrapperBase):
             unit=unit,
             registry=registry,
             _labelvalues=_labelvalues,
+            value_class=value_class,
+            max_children=max_children,
+            cardinality_policy=cardinality_policy,
+            ttl_seconds=ttl_seconds,
         )
         self._kwargs['buckets'] = buckets
+        if native_histogram_schema is not None:
+            self._kwargs['native_histogram_schema'] = native_histogram_schema
+            self._kwargs['native_histogram_zero_threshold'] = native_histogram_zero_threshold
+            self._kwargs['native_histogram_max_buckets'] = native_histogram_max_buckets
 
     def _prepare_buckets(self, source_buckets: Sequence[Union[float, str]]) -> None:
         buckets = [float(b) for b in source_buckets]
@@ -641,27 +1045,39 @@ class Histogram(MetricWrapperBase):
             # This is probably an error on the part of the user,
             # so raise rather than sorting for them.
             raise ValueError('Buckets not in sorted order')
+        if not buckets and self._native_histogram_schema is not None:
+            # The native histogram carries the distribution, only keep +Inf.
+            buckets.append(INF)
         if buckets and buckets[-1] != INF:
             buckets.append(INF)
-        if len(buckets) < 2:
+        if len(buckets) < 2 and self._native_histogram_schema is None:
             raise ValueError('Must have at least two buckets')
         self._upper_bounds = buckets
+        # Observations are binned with a binary search over this tuple, the
+        # bucket index being the first upper bound not less than the amount.
+        self._bucket_bounds = tuple(buckets)
 
     def _metric_init(self) -> None:
-        self._buckets: List[values.ValueClass] = []
         self._created = time.time()
-        bucket_labelnames = self._labelnames + ('le',)
-        self._sum = values.ValueClass(self._type, self._name, self._name + '_sum', self._labelnames, self._labelvalues, self._documentation)
-        for b in self._upper_bounds:
-            self._buckets.append(values.ValueClass(
-                self._type,
-                self._name,
-                self._name + '_bucket',
-                bucket_labelnames,
-                self._labelvalues + (floatToGoString(b),),
-                self._documentation)
+        value_class = self._get_value_class()
+        histogram_value_class = getattr(value_class, '_histogram_value_class', None)
+        if histogram_value_class is not None:
+            self._value = histogram_value_class(len(self._upper_bounds))
+        else:
+            self._value = values.PerBucketHistogramValue(
+                value_class, self._type, self._name, self._labelnames, self._labelvalues,
+                self._documentation, self._upper_bounds)
+        self._native: Optional[values.NativeHistogramValue] = None
+        if self._native_histogram_schema is not None:
+            self._native = values.NativeHistogramValue(
+                self._native_histogram_schema,
+                self._native_histogram_zero_threshold,
+                self._native_histogram_max_buckets,
             )
 
+    def _child_values(self):
+        return (self._value,)
+
     def observe(self, amount: float, exemplar: Optional[Dict[str, str]] = None) -> None:
         """Observe the given amount.
 
@@ -673,14 +1089,53 @@ class Histogram(MetricWrapperBase):
         for details.
         """
         self._raise_if_not_observable()
-        self._sum.inc(amount)
-        for i, bound in enumerate(self._upper_bounds):
-            if amount <= bound:
-                self._buckets[i].inc(1)
-                if exemplar:
-                    _validate_exemplar(exemplar)
-                    self._buckets[i].set_exemplar(Exemplar(exemplar, amount, time.time()))
-                break
+        if amount == amount:
+            i = bisect_left(self._bucket_bounds, amount)
+        else:  # NaN is never counted in a bucket.
+            i = len(self._bucket_bounds)
+        self._value.observe(i, amount)
+        if self._native is not None:
+            self._native.observe(amount)
+        if exemplar and i < len(self._bucket_bounds):
+            _validate_exemplar(exemplar)
+            ex = Exemplar(exemplar, amount, time.time())
+            self._value.set_exemplar(i, ex)
+            if self._native is not None:
+                self._native.set_exemplar(ex)
+
+    def observe_many(self, amounts: Iterable[float]) -> None:
+        """Observe each of the given amounts.
+
+        This is equivalent to calling observe() for every amount, but the
+        whole batch is binned at once and each touched bucket is only
+        incremented once. Any iterable of numbers is accepted, including
+        array.array; NumPy arrays are binned with numpy.searchsorted.
+        """
+        self._raise_if_not_observable()
+        bounds = self._bucket_bounds
+        np = sys.modules.get('numpy')
+        if np is not None and isinstance(amounts, np.ndarray):
+            flat = np.asarray(amounts).ravel()
+            # NaN sorts after +Inf, into the extra slot which is ignored below.
+            indexes = np.searchsorted(bounds, flat, side='left')
+            counts = np.bincount(indexes, minlength=len(bounds) + 1).tolist()
+            total = float(flat.sum())
+            if self._native is not None:
+                amounts = flat.tolist()
+        else:
+            if self._native is not None:
+                # The amounts are iterated over twice.
+                amounts = list(amounts)
+            counts = [0] * (len(bounds) + 1)
+            total = 0.0
+            for amount in amounts:
+                total += amount
+                if amount == amount:  # NaN is never counted in a bucket.
+                    counts[bisect_left(bounds, amount)] += 1
+        self._value.observe_many(counts, total)
+        if self._native is not None:
+            for amount in amounts:
+                self._native.observe(amount)
 
     def time(self) -> Timer:
         """Time a block of code or function, and observe the duration in seconds.
@@ -691,13 +1146,17 @@ class Histogram(MetricWrapperBase):
 
     def _child_samples(self) -> Iterable[Sample]:
         samples = []
+        if self._native is not None:
+            samples.append(Sample('', {}, 0.0, None, None, self._native.get()))
+        buckets, sum_value = self._value.get()
+        exemplars = self._value.get_exemplars()
         acc = 0.0
-        for i, bound in enumerate(self._upper_bounds):
-            acc += self._buckets[i].get()
-            samples.append(Sample('_bucket', {'le': floatToGoString(bound)}, acc, None, self._buckets[i].get_exemplar()))
+        for bound, count, exemplar in zip(self._upper_bounds, buckets, exemplars):
+            acc += count
+            samples.append(Sample('_bucket', {'le': floatToGoString(bound)}, acc, None, exemplar))
         samples.append(Sample('_count', {}, acc, None, None))
         if self._upper_bounds[0] >= 0:
-            samples.append(Sample('_sum', {}, self._sum.get(), None, None))
+            samples.append(Sample('_sum', {}, sum_value, None, None))
         if _use_created:
             samples.append(Sample('_created', {}, self._created, None, None))
         return tuple(samples)
@@ -717,7 +1176,8 @@ class Info(MetricWrapperBase):
         i = Info('my_build', 'Description of info')
         i.info({'version': '1.2.3', 'buildhost': 'foo@bar'})
 
-     Info metrics do not work in multiprocess mode.
+     In multiprocess mode, each distinct labelset of the live processes is
+     exposed.
     """
     _type = 'info'
 
@@ -725,6 +1185,26 @@ class Info(MetricWrapperBase):
         self._labelname_set = set(self._labelnames)
         self._lock = Lock()
         self._value = {}
+        self._info_value = None
+        self._store_info()
+
+    def _store_info(self):
+        """Store the labelset in the multiprocess files. Lock must be held by caller."""
+        value_class = self._get_value_class()
+        if not getattr(value_class, '_multiprocess', False):
+            return
+        if self._info_value is not None:
+            self._info_value.remove()
+        self._info_value = value_class(
+            self._type, self._name, self._name + '_info',
+            tuple(self._labelnames) + tuple(self._value),
+            tuple(self._labelvalues) + tuple(self._value.values()),
+            self._documentation,
+        )
+        self._info_value.set(1)
+
+    def _child_values(self):
+        return () if self._info_value is None else (self._info_value,)
 
     def info(self, val: Dict[str, str]) -> None:
         """Set info metric."""
@@ -735,6 +1215,7 @@ class Info(MetricWrapperBase):
             raise ValueError('Label value cannot be None')
         with self._lock:
             self._value = dict(val)
+            self._store_info()
 
     def _child_samples(self) -> Iterable[Sample]:
         with self._lock:
@@ -752,7 +1233,8 @@ class Enum(MetricWrapperBase):
         e.state('running')
 
      The first listed state will be the default.
-     Enum metrics do not work in multiprocess mode.
+     In multiprocess mode, the state most recently set by any live process
+     is exposed.
     """
     _type = 'stateset'
 
@@ -766,7 +1248,16 @@ class Enum(MetricWrapperBase):
                  registry: Optional[CollectorRegistry] = REGISTRY,
                  _labelvalues: Optional[Sequence[str]] = None,
                  states: Optional[Sequence[str]] = None,
+                 max_children: Optional[int] = None,
+                 cardinality_policy: Optional[str] = None,
+                 ttl_seconds: Optional[float] = None,
                  ):
+        if name in labelnames:
+            raise ValueError(f'Overlapping labels for Enum metric: {name}')
+        if not states:
+            raise ValueError(f'No states provided for Enum metric: {name}')
+        # Set first, as the states are used by _metric_init().
+        self._states = states
         super().__init__(
             name=name,
             documentation=documentation,
@@ -776,22 +1267,40 @@ class Enum(MetricWrapperBase):
             unit=unit,
             registry=registry,
             _labelvalues=_labelvalues,
+            max_children=max_children,
+            cardinality_policy=cardinality_policy,
+            ttl_seconds=ttl_seconds,
         )
-        if name in labelnames:
-            raise ValueError(f'Overlapping labels for Enum metric: {name}')
-        if not states:
-            raise ValueError(f'No states provided for Enum metric: {name}')
-        self._kwargs['states'] = self._states = states
+        self._kwargs['states'] = states
 
     def _metric_init(self) -> None:
         self._value = 0
         self._lock = Lock()
+        self._state_values = []
+        value_class = self._get_value_class()
+        if getattr(value_class, '_multiprocess', False):
+            # A value per state, which is 1 for the current state, with the
+            # time the state was set.
+            self._state_values = [
+                value_class(self._type, self._name, self._name, tuple(self._labelnames) + (self._name,),
+                            tuple(self._labelvalues) + (s,), self._documentation)
+                for s in self._states
+            ]
+            # The default state has no timestamp, so any state set takes precedence.
+            self._state_values[0].set(1)
+
+    def _child_values(self):
+        return tuple(self._state_values)
 
     def state(self, state: str) -> None:
         """Set enum metric state."""
         self._raise_if_not_observable()
         with self._lock:
             self._value = self._states.index(state)
+            if self._state_values:
+                now = time.time()
+                for i, value in enumerate(self._state_values):
+                    value.set(1 if i == self._value else 0, now)
 
     def _child_samples(self) -> Iterable[Sample]:
         with self._lock:
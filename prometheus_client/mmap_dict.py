@@ -2,14 +2,47 @@ import json
 import mmap
 import os
 import struct
-from typing import List
+from typing import List, Tuple
+
+from .samples import Exemplar
 
 _INITIAL_MMAP_SIZE = 1 << 16
+_GROWTH_FACTOR = 2
+# A generous estimate of the space a series takes, with its strings, used
+# to size new files for an expected number of series.
+_SERIES_SIZE_ESTIMATE = 256
+_MAP_THRESHOLD = 1 << 18
 _pack_integer_func = struct.Struct(b'i').pack
 _pack_two_doubles_func = struct.Struct(b'dd').pack
+_pack_two_integers = struct.Struct(b'ii').pack
 _unpack_integer = struct.Struct(b'i').unpack_from
+_unpack_two_integers = struct.Struct(b'ii').unpack_from
+_unpack_four_integers = struct.Struct(b'iiii').unpack_from
 _unpack_two_doubles = struct.Struct(b'dd').unpack_from
 
+# Version 1 files have zeros where later versions store the format version,
+# in the low byte, and the generation, which is increased whenever records
+# are removed or reused.
+_FORMAT_VERSION = 2
+_VERSION_MASK = 0xff
+_GENERATION_MASK = 0xffffff
+# Kinds of version 2 records.
+_STRING_RECORD = 0
+_SERIES_RECORD = 1
+_RAW_KEY_RECORD = 2
+_EXEMPLAR_RECORD = 3
+_FREE_RECORD = 4
+# Exemplar labels are at most 128 characters, so this fits all but those
+# needing many escapes in JSON, which are not stored.
+_EXEMPLAR_LABELS_SIZE = 1024
+# The size of the labels, the value, the timestamp, and the labels.
+_exemplar_struct = struct.Struct(f'=idd{_EXEMPLAR_LABELS_SIZE}s'.encode())
+_EXEMPLAR_RECORD_SIZE = 12 + _exemplar_struct.size
+
+# A series key: metric name, sample name, (label name, label value) pairs
+# sorted by label name, and help text.
+SeriesKey = Tuple[str, str, Tuple[Tuple[str, str], ...], str]
+
 
 # struct.pack_into has atomicity issues because it will temporarily write 0 into
 # the mmap, resulting in false reads to 0 when experiencing a lot of writes.
@@ -24,90 +57,373 @@ def _pack_integer(data, pos, value):
     data[pos:pos + 4] = _pack_integer_func(value)
 
 
-def _read_all_values(data, used=0):
-    """Yield (key, value, timestamp, pos). No locking is performed."""
+def _padding(length):
+    """Return the padding needed after a field of length, to align to 8 bytes."""
+    return -length % 8
+
+
+def _read_all_values(data, used=0, pos=8, strings=None, exemplars=None, records=None, free=None,
+                     string_positions=None):
+    """Yield (key, value, timestamp, pos), starting with the entry at pos.
+
+    Keys are strings in version 1 files, and series keys or strings in
+    version 2 files. When reading a version 2 file from a later entry than
+    the first, strings must be the string table read up to that entry. It
+    is extended with the strings read. If exemplars is a dict, the position
+    of each exemplar read is added to it, by the position of its series's
+    value. If records is a dict, the position of each series's record is
+    added to it, by the position of its value. If free is a dict, the
+    positions of free records are added to it, by their size. If
+    string_positions is a list, the position of each string record read is
+    appended to it. No locking is performed."""
 
     if used <= 0:
         # If not valid `used` value is passed in, read it from the file.
         used = _unpack_integer(data, 0)[0]
 
-    pos = 8
+    if not _unpack_integer(data, 4)[0]:
+        while pos < used:
+            encoded_len = _unpack_integer(data, pos)[0]
+            # check we are not reading beyond bounds
+            if encoded_len + pos > used:
+                raise RuntimeError('Read beyond file size detected, file is corrupted.')
+            pos += 4
+            encoded_key = data[pos:pos + encoded_len]
+            padded_len = encoded_len + (8 - (encoded_len + 4) % 8)
+            pos += padded_len
+            value, timestamp = _unpack_two_doubles(data, pos)
+            yield encoded_key.decode('utf-8'), value, timestamp, pos
+            pos += 16
+        return
 
+    if strings is None:
+        strings = []
     while pos < used:
-        encoded_len = _unpack_integer(data, pos)[0]
-        # check we are not reading beyond bounds
-        if encoded_len + pos > used:
+        record_pos = pos
+        kind, length = _unpack_two_integers(data, pos)
+        start = pos + 8
+        pos = start + length + _padding(length)
+        if length < 0 or pos > used:
+            raise RuntimeError('Read beyond file size detected, file is corrupted.')
+        if kind == _STRING_RECORD:
+            strings.append(data[start:start + length].decode('utf-8'))
+            if string_positions is not None:
+                string_positions.append(record_pos)
+            continue
+        if kind == _EXEMPLAR_RECORD:
+            if exemplars is not None:
+                exemplars[_unpack_integer(data, start)[0]] = start + 4
+            continue
+        if kind == _FREE_RECORD:
+            if free is not None:
+                free.setdefault(pos - record_pos, []).append(record_pos)
+            continue
+        if kind == _SERIES_RECORD:
+            metric_name, name, help_text, label_count = _unpack_four_integers(data, start)
+            labels: Tuple[Tuple[str, str], ...] = ()
+            if label_count:
+                # Label name references, then label value lengths, then values.
+                ints = struct.unpack_from(f'{2 * label_count}i', data, start + 16)
+                value_pos = start + 16 + 8 * label_count
+                pairs = []
+                for i in range(label_count):
+                    value_end = value_pos + ints[label_count + i]
+                    pairs.append((strings[ints[i]], data[value_pos:value_end].decode('utf-8')))
+                    value_pos = value_end
+                labels = tuple(pairs)
+            key = (strings[metric_name], strings[name], labels, strings[help_text])
+        elif kind == _RAW_KEY_RECORD:
+            key = data[start:start + length].decode('utf-8')
+        else:
+            raise RuntimeError('Unknown record kind, file is corrupted.')
+        if pos + 16 > used:
             raise RuntimeError('Read beyond file size detected, file is corrupted.')
-        pos += 4
-        encoded_key = data[pos:pos + encoded_len]
-        padded_len = encoded_len + (8 - (encoded_len + 4) % 8)
-        pos += padded_len
         value, timestamp = _unpack_two_doubles(data, pos)
-        yield encoded_key.decode('utf-8'), value, timestamp, pos
+        if records is not None:
+            records[pos] = record_pos
+        yield key, value, timestamp, pos
         pos += 16
 
 
+def _pack_exemplar(exemplar):
+    """Return the packed exemplar, or None if its labels do not fit."""
+    labels = json.dumps(exemplar.labels, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(labels) > _EXEMPLAR_LABELS_SIZE:
+        return None
+    return _exemplar_struct.pack(len(labels), exemplar.value, exemplar.timestamp or 0.0, labels)
+
+
+def _read_exemplar(data, pos):
+    """Return the exemplar at pos, or None if it is being written."""
+    labels_len, value, timestamp, labels = _exemplar_struct.unpack_from(data, pos)
+    try:
+        labels = json.loads(labels[:labels_len].decode('utf-8'))
+    except ValueError:
+        return None
+    return Exemplar(labels, value, timestamp or None)
+
+
+def _read_used_data(infp):
+    """Return the used part of an open file, and how much of it is used.
+
+    Files using more than _MAP_THRESHOLD bytes are mapped read-only rather
+    than copied, and the map has to be closed with _release_data. Mapping
+    costs more than copying a few pages, which most files are.
+    """
+    # Read the first block of data, including the first 4 bytes which tell us
+    # how much of the file (which is preallocated and grown in steps) is occupied.
+    data = infp.read(mmap.PAGESIZE)
+    if len(data) < 8:
+        # Just created, and not yet initialized by its writer.
+        return bytes(8), 8
+    used = _unpack_integer(data, 0)[0]
+    if used > _MAP_THRESHOLD:
+        size = os.fstat(infp.fileno()).st_size
+        return mmap.mmap(infp.fileno(), size, access=mmap.ACCESS_READ), min(used, size)
+    if used > len(data):  # Then read in the rest, if needed.
+        data += infp.read(used - len(data))
+    return data, used
+
+
+def _release_data(data):
+    """Close data returned by _read_used_data, if it is a map."""
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+
+def _round_to_pages(size):
+    return -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+def _initial_mmap_size(expected_series=None, initial_size=_INITIAL_MMAP_SIZE):
+    """Return the size new files are created with.
+
+    This is initial_size, or the size estimated to hold expected_series
+    series if that is larger, rounded up to whole pages.
+    """
+    if initial_size < 8:
+        raise ValueError(f'initial_size must be at least 8: {initial_size}')
+    if expected_series is not None:
+        if expected_series < 0:
+            raise ValueError(f'expected_series must not be negative: {expected_series}')
+        initial_size = max(initial_size, 8 + expected_series * _SERIES_SIZE_ESTIMATE)
+    return _round_to_pages(initial_size)
+
+
+def _json_key(key: SeriesKey) -> str:
+    """Format a series key as in version 1 files."""
+    metric_name, name, labels, help_text = key
+    return json.dumps([metric_name, name, dict(labels), help_text], sort_keys=True)
+
+
+def _series_key_from_json(key: str) -> SeriesKey:
+    """Parse a series key from the format of version 1 files."""
+    metric_name, name, labels, help_text = json.loads(key)
+    return metric_name, name, tuple(sorted(labels.items())), help_text
+
+
 class MmapedDict:
     """A dict of doubles, backed by an mmapped file.
 
     The file starts with a 4 byte int, indicating how much of it is used.
-    Then 4 bytes of padding.
-    There's then a number of entries, consisting of a 4 byte int which is the
-    size of the next field, a utf-8 encoded string key, padding to a 8 byte
-    alignment, and then a 8 byte float which is the value and a 8 byte float
-    which is a UNIX timestamp in seconds.
+    Then a 4 byte int with the format version in its low byte, which is 0
+    in version 1 files, and a generation in the upper bytes which is
+    increased whenever a record is removed or reused.
+
+    In version 1 files there's then a number of entries, consisting of a 4
+    byte int which is the size of the next field, a utf-8 encoded string key,
+    padding to a 8 byte alignment, and then a 8 byte float which is the value
+    and a 8 byte float which is a UNIX timestamp in seconds. Series keys are
+    stored as JSON.
+
+    In version 2 files there's a number of records, consisting of a 4 byte
+    int with the kind of the record, a 4 byte int which is the size of the
+    next field, and the field padded to a 8 byte alignment:
+    - A string record's field is a utf-8 encoded string, which is added to
+      the file's string table. Its index is the number of string records
+      before it. Readers resolve the strings a series refers to as they
+      reach it, so series records always come after those strings.
+    - A series record's field holds 4 byte ints with the string table index
+      of the metric name, the sample name and the help text, the number of
+      labels, the index of each label name, the size of each label value,
+      followed by the utf-8 encoded label values. Label names and help texts
+      are so only stored once per file.
+    - A raw key record's field is a utf-8 encoded string key.
+    - An exemplar record's field holds a 4 byte int with the position of
+      the value of the series it belongs to, a 4 byte int which is the size
+      of the exemplar's labels, its 8 byte float value and timestamp, and
+      its labels as utf-8 encoded JSON, in a field of _EXEMPLAR_LABELS_SIZE
+      bytes. The record is only added once the series has an exemplar, and
+      is updated in place after.
+    - A free record's field is the unused space of a removed record, which
+      is reused by later series or exemplar records of the same size.
+    Series and raw key records are followed by the 8 byte float value and
+    the 8 byte float timestamp.
+
+    Keys are series keys as returned by mmap_key, or strings. New files are
+    written in version 2, and version 1 files in version 1.
 
     Not thread safe.
     """
 
-    def __init__(self, filename, read_mode=False):
+    def __init__(self, filename, read_mode=False, initial_size=_INITIAL_MMAP_SIZE, growth_factor=_GROWTH_FACTOR):
+        if not growth_factor > 1:
+            raise ValueError(f'growth_factor must be greater than 1: {growth_factor}')
+        self._growth_factor = growth_factor
         self._f = open(filename, 'rb' if read_mode else 'a+b')
         self._fname = filename
         capacity = os.fstat(self._f.fileno()).st_size
         if capacity == 0:
-            self._f.truncate(_INITIAL_MMAP_SIZE)
-            capacity = _INITIAL_MMAP_SIZE
+            capacity = _initial_mmap_size(initial_size=initial_size)
+            self._f.truncate(capacity)
         self._capacity = capacity
         self._m = mmap.mmap(self._f.fileno(), self._capacity,
                             access=mmap.ACCESS_READ if read_mode else mmap.ACCESS_WRITE)
+        # Maps replaced while growing the file on platforms that can not
+        # resize them. Values may still be written through them by threads
+        # that have not seen the new map, so they are only closed in close().
+        self._superseded = []
 
         self._positions = {}
+        self._strings = {}
+        # The position of each string record, by its index.
+        self._string_positions: List[int] = []
+        self._exemplar_positions = {}
+        # Key to the position of its series record, in version 2 files.
+        self._record_positions = {}
+        # Record size to the positions of free records.
+        self._free = {}
+        self._generation = 0
         self._used = _unpack_integer(self._m, 0)[0]
         if self._used == 0:
             self._used = 8
+            self._version = _FORMAT_VERSION
             _pack_integer(self._m, 0, self._used)
+            _pack_integer(self._m, 4, self._version)
         else:
+            version = _unpack_integer(self._m, 4)[0]
+            self._version = version & _VERSION_MASK or 1
+            self._generation = version >> 8
             if not read_mode:
-                for key, _, _, pos in self._read_all_values():
+                strings: List[str] = []
+                exemplars = {}
+                records = {}
+                for key, _, _, pos in _read_all_values(self._m, self._used, strings=strings,
+                                                       exemplars=exemplars, records=records, free=self._free,
+                                                       string_positions=self._string_positions):
+                    if self._version == 1:
+                        try:
+                            key = _series_key_from_json(key)
+                        except ValueError:
+                            pass
                     self._positions[key] = pos
+                self._strings = {s: i for i, s in enumerate(strings)}
+                for key, pos in self._positions.items():
+                    if pos in exemplars:
+                        self._exemplar_positions[key] = exemplars[pos]
+                    if pos in records:
+                        self._record_positions[key] = records[pos]
 
     @staticmethod
     def read_all_values_from_file(filename):
         with open(filename, 'rb') as infp:
-            # Read the first block of data, including the first 4 bytes which tell us
-            # how much of the file (which is preallocated to _INITIAL_MMAP_SIZE bytes) is occupied.
-            data = infp.read(mmap.PAGESIZE)
-            used = _unpack_integer(data, 0)[0]
-            if used > len(data):  # Then read in the rest, if needed.
-                data += infp.read(used - len(data))
-        return _read_all_values(data, used)
+            data, used = _read_used_data(infp)
+        try:
+            yield from _read_all_values(data, used)
+        finally:
+            _release_data(data)
 
-    def _init_value(self, key):
-        """Initialize a value. Lock must be held by caller."""
-        encoded = key.encode('utf-8')
-        # Pad to be 8-byte aligned.
-        padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
-        value = struct.pack(f'i{len(padded)}sdd'.encode(), len(encoded), padded, 0.0, 0.0)
-        while self._used + len(value) > self._capacity:
-            self._capacity *= 2
-            self._f.truncate(self._capacity)
-            self._m = mmap.mmap(self._f.fileno(), self._capacity)
-        self._m[self._used:self._used + len(value)] = value
+    def _append(self, record):
+        """Append a record to the file. Lock must be held by caller."""
+        if self._used + len(record) > self._capacity:
+            self._grow(self._used + len(record))
+        self._m[self._used:self._used + len(record)] = record
 
         # Update how much space we've used.
-        self._used += len(value)
+        self._used += len(record)
         _pack_integer(self._m, 0, self._used)
-        self._positions[key] = self._used - 16
+
+    def _grow(self, size):
+        """Grow the file and its map to hold size bytes. Lock must be held by caller."""
+        capacity = self._capacity
+        while capacity < size:
+            capacity = max(int(capacity * self._growth_factor), capacity + 1)
+        capacity = _round_to_pages(capacity)
+        try:
+            # This also grows the file, and keeps the map's address where
+            # the platform can.
+            self._m.resize(capacity)
+        except (OSError, SystemError):
+            self._f.truncate(capacity)
+            self._superseded.append(self._m)
+            self._m = mmap.mmap(self._f.fileno(), capacity)
+        self._capacity = capacity
+
+    def _write_record(self, record, after=0):
+        """Write a record, reusing a free record of the same size if there is one.
+
+        Only free records after the position after are reused. Return the
+        position of the record. Lock must be held by caller."""
+        free = self._free.get(len(record), ())
+        for i in range(len(free) - 1, -1, -1):
+            if free[i] > after:
+                pos = free.pop(i)
+                break
+        else:
+            self._append(record)
+            return self._used - len(record)
+        # Readers skip the record until its header is written.
+        self._m[pos + 8:pos + len(record)] = record[8:]
+        self._m[pos:pos + 8] = record[:8]
+        self._next_generation()
+        return pos
+
+    def _free_record(self, pos, size):
+        """Mark the record at pos as free. Lock must be held by caller."""
+        self._m[pos:pos + 8] = _pack_two_integers(_FREE_RECORD, size - 8)
+        self._free.setdefault(size, []).append(pos)
+
+    def _next_generation(self):
+        """Tell readers that cached the file's records to read them again."""
+        self._generation = (self._generation + 1) & _GENERATION_MASK
+        _pack_integer(self._m, 4, self._version | self._generation << 8)
+
+    def _intern(self, string):
+        """Return the string table index of string. Lock must be held by caller."""
+        index = self._strings.get(string)
+        if index is None:
+            encoded = string.encode('utf-8')
+            self._string_positions.append(self._used)
+            self._append(struct.pack(f'ii{len(encoded) + _padding(len(encoded))}s',
+                                     _STRING_RECORD, len(encoded), encoded))
+            index = self._strings[string] = len(self._strings)
+        return index
+
+    def _init_value(self, key):
+        """Initialize a value. Lock must be held by caller."""
+        if self._version == 1:
+            encoded = (key if isinstance(key, str) else _json_key(key)).encode('utf-8')
+            # Pad to be 8-byte aligned.
+            padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
+            self._append(struct.pack(f'i{len(padded)}sdd'.encode(), len(encoded), padded, 0.0, 0.0))
+            self._positions[key] = self._used - 16
+            return
+        after = 0
+        if isinstance(key, str):
+            kind, field = _RAW_KEY_RECORD, key.encode('utf-8')
+        else:
+            metric_name, name, labels, help_text = key
+            refs = [self._intern(metric_name), self._intern(name), self._intern(help_text), len(labels)]
+            refs.extend(self._intern(label_name) for label_name, _ in labels)
+            encoded_values = [label_value.encode('utf-8') for _, label_value in labels]
+            refs.extend(len(v) for v in encoded_values)
+            kind, field = _SERIES_RECORD, struct.pack(f'{len(refs)}i', *refs) + b''.join(encoded_values)
+            # String records are in the order of their index.
+            after = self._string_positions[max(refs[:3] + refs[4:4 + len(labels)])]
+        record = struct.pack(f'ii{len(field) + _padding(len(field))}sdd', kind, len(field), field, 0.0, 0.0)
+        pos = self._write_record(record, after)
+        self._record_positions[key] = pos
+        self._positions[key] = pos + len(record) - 16
 
     def _read_all_values(self):
         """Yield (key, value, pos). No locking is performed."""
@@ -130,16 +446,60 @@ class MmapedDict:
         pos = self._positions[key]
         _pack_two_doubles(self._m, pos, value, timestamp)
 
+    def read_exemplar(self, key):
+        pos = self._exemplar_positions.get(key)
+        if pos is None:
+            return None
+        return _read_exemplar(self._m, pos)
+
+    def write_exemplar(self, key, exemplar):
+        """Store the exemplar of the value at key.
+
+        Exemplars are not stored in version 1 files, nor if their labels do
+        not fit in an exemplar record."""
+        if self._version == 1:
+            return
+        packed = _pack_exemplar(exemplar)
+        if packed is None:
+            return
+        if key not in self._positions:
+            self._init_value(key)
+        pos = self._exemplar_positions.get(key)
+        if pos is None:
+            pos = self._write_record(_pack_two_integers(_EXEMPLAR_RECORD, 4 + len(packed))
+                                     + _pack_integer_func(self._positions[key]) + packed)
+            self._exemplar_positions[key] = pos + 12
+        else:
+            self._m[pos:pos + len(packed)] = packed
+
+    def remove_value(self, key):
+        """Remove the value at key, and its exemplar.
+
+        Their records are marked as free, so collectors skip them, and are
+        reused by later values. Values are not removed from version 1 files."""
+        if self._version == 1 or key not in self._positions:
+            return
+        pos = self._positions.pop(key)
+        record_pos = self._record_positions.pop(key)
+        self._free_record(record_pos, pos + 16 - record_pos)
+        exemplar_pos = self._exemplar_positions.pop(key, None)
+        if exemplar_pos is not None:
+            self._free_record(exemplar_pos - 12, _EXEMPLAR_RECORD_SIZE)
+        self._next_generation()
+
     def close(self):
         if self._f:
             self._m.close()
             self._m = None
+            for m in self._superseded:
+                m.close()
+            self._superseded = []
             self._f.close()
             self._f = None
 
 
-def mmap_key(metric_name: str, name: str, labelnames: List[str], labelvalues: List[str], help_text: str) -> str:
+def mmap_key(metric_name: str, name: str, labelnames: List[str], labelvalues: List[str], help_text: str) -> SeriesKey:
     """Format a key for use in the mmap file."""
     # ensure labels are in consistent order for identity
-    labels = dict(zip(labelnames, labelvalues))
-    return json.dumps([metric_name, name, labels, help_text], sort_keys=True)
+    labels = tuple(sorted(zip(labelnames, labelvalues)))
+    return metric_name, name, labels, help_text
@@ -1,12 +1,19 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import glob
 import json
 import os
+from threading import Lock
+from typing import Dict
 import warnings
 
 from .metrics import Gauge
 from .metrics_core import Metric
-from .mmap_dict import MmapedDict
+from .mmap_dict import (
+    _read_all_values, _read_exemplar, _read_used_data, _release_data,
+    _series_key_from_json, _unpack_integer, _unpack_two_doubles, MmapedDict,
+)
 from .samples import Sample
 from .utils import floatToGoString
 
@@ -15,11 +22,122 @@ try:  # Python3
 except NameError:  # Python >= 2.5
     FileNotFoundError = IOError
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+# Metric types whose values are only exposed while their process is alive.
+_LIVE_FILE_TYPES = ('info', 'stateset')
+# Stands in for the pid in the names of the files that compaction writes.
+_ARCHIVE_ID = 'archive'
+
+
+@contextmanager
+def _directory_lock(path, exclusive):
+    """Lock the directory itself, so that no lock file is left in it.
+
+    Compaction replaces files while holding the lock exclusively, and
+    collection reads files while holding it shared. Where it can not be
+    locked, compaction is not supported, see _check_compaction_supported.
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except OSError:
+            if exclusive:
+                raise
+        yield
+    finally:
+        os.close(fd)
+
+
+def _check_compaction_supported():
+    if fcntl is None:
+        raise RuntimeError('Compaction requires fcntl, which is not available on this platform.')
+
+
+class _FileCache:
+    """The parsed keys and value positions of the .db files in a directory.
+
+    Values are updated in place without changing the size or, reliably, the
+    mtime of a file, so the values have to be read again on every collection.
+    Keys are only parsed for entries added since the file was last read, as
+    long as its inode, size, mtime and version header did not change and its
+    used header did not shrink. Otherwise the file is parsed again from
+    scratch.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Path to ((inode, size, mtime), used, [(parsed key, value position)],
+        # string table, {value position: exemplar position}).
+        self._files = {}
+
+    def read_values(self, path, parse_key):
+        """Return [(parsed key, value, timestamp, exemplar)] for the file at path.
+
+        Files are parsed outside of the lock, so can be read concurrently."""
+        with open(path, 'rb') as infp:
+            stat = os.fstat(infp.fileno())
+            data, used = _read_used_data(infp)
+        try:
+            # The version header changes whenever records are removed or reused.
+            identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns, _unpack_integer(data, 4)[0])
+            with self._lock:
+                cached = self._files.get(path)
+            if cached is not None and cached[0] == identity and cached[1] <= used:
+                _, start, entries, strings, exemplars = cached
+            else:
+                start, entries, strings, exemplars = 8, [], [], {}
+            if start < used:
+                strings = list(strings)
+                exemplars = dict(exemplars)
+                entries = entries + [
+                    (parse_key(key), pos)
+                    for key, _, _, pos in _read_all_values(data, used, start, strings, exemplars)
+                ]
+                with self._lock:
+                    self._files[path] = (identity, used, entries, strings, exemplars)
+            if not exemplars:
+                return [(key, *_unpack_two_doubles(data, pos), None) for key, pos in entries]
+            return [
+                (key, *_unpack_two_doubles(data, pos),
+                 _read_exemplar(data, exemplars[pos]) if pos in exemplars else None)
+                for key, pos in entries
+            ]
+        finally:
+            _release_data(data)
+
+    def retain(self, paths):
+        """Forget the files not in paths."""
+        paths = set(paths)
+        with self._lock:
+            for path in list(self._files):
+                if path not in paths:
+                    del self._files[path]
+
+
+def _keep_most_recent(exemplars, key, exemplar):
+    current = exemplars.get(key)
+    if current is None or (exemplar.timestamp or 0) > (current.timestamp or 0):
+        exemplars[key] = exemplar
+
 
 class MultiProcessCollector:
-    """Collector for files for multi-process mode."""
+    """Collector for files for multi-process mode.
+
+    If workers is more than 1, files are read by that many threads.
+    """
+    # Shared by all collectors of a directory, as a collector is commonly
+    # created for every scrape.
+    _file_caches: Dict[str, _FileCache] = {}
 
-    def __init__(self, registry, path=None):
+    def __init__(self, registry, path=None, workers=None):
         if path is None:
             # This deprecation warning can go away in a few releases when removing the compatibility
             if 'prometheus_multiproc_dir' in os.environ and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
@@ -28,7 +146,11 @@ class MultiProcessCollector:
             path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
         if not path or not os.path.isdir(path):
             raise ValueError('env PROMETHEUS_MULTIPROC_DIR is not set or not a directory')
+        if workers is not None and workers < 1:
+            raise ValueError('workers must be at least 1')
         self._path = path
+        self._workers = workers
+        self._file_cache = self._file_caches.setdefault(os.path.abspath(path), _FileCache())
         if registry:
             registry.register(self)
 
@@ -44,33 +166,51 @@ class MultiProcessCollector:
         return MultiProcessCollector._accumulate_metrics(metrics, accumulate)
 
     @staticmethod
-    def _read_metrics(files):
+    def _read_metrics(files, file_cache=None, workers=None):
         metrics = {}
         key_cache = {}
 
         def _parse_key(key):
             val = key_cache.get(key)
             if not val:
-                metric_name, name, labels, help_text = json.loads(key)
-                labels_key = tuple(sorted(labels.items()))
+                if isinstance(key, str):
+                    # Written in version 1 of the file format.
+                    metric_name, name, labels, help_text = json.loads(key)
+                    labels_key = tuple(sorted(labels.items()))
+                else:
+                    metric_name, name, labels_key, help_text = key
+                    labels = dict(labels_key)
                 val = key_cache[key] = (metric_name, name, labels, labels_key, help_text)
             return val
 
-        for f in files:
-            parts = os.path.basename(f).split('_')
-            typ = parts[0]
+        if file_cache is None:
+            file_cache = _FileCache()
+
+        def _read_file(f):
             try:
-                file_values = MmapedDict.read_all_values_from_file(f)
+                return file_cache.read_values(f, _parse_key)
             except FileNotFoundError:
-                if typ == 'gauge' and parts[1].startswith('live'):
-                    # Files for 'live*' gauges can be deleted between the glob of collect
-                    # and now (via a mark_process_dead call) so don't fail if
-                    # the file is missing
-                    continue
+                parts = os.path.basename(f).split('_')
+                if parts[0] in _LIVE_FILE_TYPES or parts[0] == 'gauge' and parts[1].startswith('live'):
+                    # Files for 'live*' gauges, info and enums can be deleted between
+                    # the glob of collect and now (via a mark_process_dead call) so
+                    # don't fail if the file is missing
+                    return []
                 raise
-            for key, value, timestamp, _ in file_values:
-                metric_name, name, labels, labels_key, help_text = _parse_key(key)
 
+        if workers is not None and workers > 1 and len(files) > 1:
+            # Parsing holds the GIL, but reading the files does not. Values
+            # are merged in file order, so the result does not depend on
+            # which thread finishes first.
+            with ThreadPoolExecutor(max_workers=min(workers, len(files))) as executor:
+                files_values = list(executor.map(_read_file, files))
+        else:
+            files_values = map(_read_file, files)
+
+        for f, file_values in zip(files, files_values):
+            parts = os.path.basename(f).split('_')
+            typ = parts[0]
+            for (metric_name, name, labels, labels_key, help_text), value, timestamp, exemplar in file_values:
                 metric = metrics.get(metric_name)
                 if metric is None:
                     metric = Metric(metric_name, help_text, typ)
@@ -82,7 +222,7 @@ class MultiProcessCollector:
                     metric.add_sample(name, labels_key + (('pid', pid),), value, timestamp)
                 else:
                     # The duplicates and labels are fixed in the next for.
-                    metric.add_sample(name, labels_key, value)
+                    metric.add_sample(name, labels_key, value, timestamp, exemplar)
         return metrics
 
     @staticmethod
@@ -91,6 +231,12 @@ class MultiProcessCollector:
             samples = defaultdict(lambda: defaultdict(float))
             sample_timestamps = defaultdict(lambda: defaultdict(float))
             buckets = defaultdict(lambda: defaultdict(float))
+            # The most recent exemplar of each sample, or bucket.
+            exemplars = {}
+            # The states of each labelset of a stateset, and the most recently
+            # set state's (timestamp, state).
+            states = defaultdict(dict)
+            current_states = {}
             for s in metric.samples:
                 name, labels, value, timestamp, exemplar, native_histogram_value = s
 
@@ -134,13 +280,33 @@ class MultiProcessCollector:
                             # _bucket
                             without_le = tuple(l for l in labels if l[0] != 'le')
                             buckets[without_le][bucket_value] += value
+                            if exemplar is not None:
+                                _keep_most_recent(exemplars, (without_le, bucket_value), exemplar)
                             break
                     else:  # did not find the `le` key
                         # _sum/_count
                         samples[labels][(name, labels)] += value
+                elif metric.type == 'info':
+                    samples[labels][(name, labels)] = value
+                elif metric.type == 'stateset':
+                    without_state = tuple(l for l in labels if l[0] != metric.name)
+                    state = dict(labels)[metric.name]
+                    states[without_state][state] = labels
+                    if value:
+                        current = current_states.get(without_state)
+                        if current is None or timestamp > current[0]:
+                            current_states[without_state] = (timestamp, state)
                 else:
                     # Counter and Summary.
                     samples[labels][(name, labels)] += value
+                    if exemplar is not None:
+                        _keep_most_recent(exemplars, (name, labels), exemplar)
+
+            # Only the most recently set state is 1.
+            for without_state, labels_by_state in states.items():
+                current_state = current_states.get(without_state, (0, None))[1]
+                for state, labels in labels_by_state.items():
+                    samples[without_state][(metric.name, labels)] = float(state == current_state)
 
             # Accumulate bucket values.
             if metric.type == 'histogram':
@@ -151,6 +317,8 @@ class MultiProcessCollector:
                             metric.name + '_bucket',
                             labels + (('le', floatToGoString(bucket)),),
                         )
+                        if (labels, bucket) in exemplars:
+                            exemplars[sample_key] = exemplars[(labels, bucket)]
                         if accumulate:
                             acc += value
                             samples[labels][sample_key] = acc
@@ -163,21 +331,121 @@ class MultiProcessCollector:
             metric.samples = []
             for _, samples_by_labels in samples.items():
                 for (name_, labels), value in samples_by_labels.items():
-                    metric.samples.append(Sample(name_, dict(labels), value))
+                    metric.samples.append(Sample(name_, dict(labels), value, None, exemplars.get((name_, labels))))
         return metrics.values()
 
     def collect(self):
-        files = glob.glob(os.path.join(self._path, '*.db'))
-        return self.merge(files, accumulate=True)
+        with _directory_lock(self._path, exclusive=False):
+            files = glob.glob(os.path.join(self._path, '*.db'))
+            metrics = self._read_metrics(files, self._file_cache, self._workers)
+        self._file_cache.retain(files)
+        return self._accumulate_metrics(metrics, True)
 
 
 _LIVE_GAUGE_MULTIPROCESS_MODES = {m for m in Gauge._MULTIPROC_MODES if m.startswith('live')}
 
 
-def mark_process_dead(pid, path=None):
-    """Do bookkeeping for when one process dies in a multi-process setup."""
+# How values of the same series from different processes are combined into
+# the archive, for each file prefix. Gauges in 'all' mode are exposed per pid
+# so can not be combined.
+_COMPACTED_FILE_PREFIXES = {
+    'counter': 'sum',
+    'histogram': 'sum',
+    'summary': 'sum',
+    'gauge_sum': 'sum',
+    'gauge_min': 'min',
+    'gauge_max': 'max',
+    'gauge_mostrecent': 'mostrecent',
+}
+
+
+def mark_process_dead(pid, path=None, compact=False):
+    """Do bookkeeping for when one process dies in a multi-process setup.
+
+    If compact is True, the process's other files are also folded into the
+    archive files, see compact_process_files.
+    """
     if path is None:
         path = os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
+    if compact:
+        _check_compaction_supported()
     for mode in _LIVE_GAUGE_MULTIPROCESS_MODES:
         for f in glob.glob(os.path.join(path, f'gauge_{mode}_{pid}.db')):
             os.remove(f)
+    for typ in _LIVE_FILE_TYPES:
+        for f in glob.glob(os.path.join(path, f'{typ}_{pid}.db')):
+            os.remove(f)
+    if compact:
+        compact_process_files([pid], path)
+
+
+def _compacted_key(key):
+    if isinstance(key, str):
+        # Written in version 1 of the file format.
+        return _series_key_from_json(key)
+    return key
+
+
+def compact_process_files(pids, path=None):
+    """Fold the files of dead processes into one archive file per type.
+
+    Values of counters, histograms, summaries, and gauges in the sum, min,
+    max, and mostrecent modes are combined with those already in the
+    <type>_archive.db file, which is then atomically replaced, and the
+    processes' files are removed. This keeps the number of files, and so
+    the time to collect them, bounded when worker processes are recycled.
+
+    The pids must be of processes that have exited, as anything written to
+    their files afterwards is lost. Gauges in the all mode are exposed per
+    process, so their files are left in place.
+
+    Collections must not see the files while they are replaced, which is
+    ensured with fcntl, so compaction is not supported where fcntl is not
+    available, such as on Windows.
+    """
+    if path is None:
+        path = os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
+    _check_compaction_supported()
+    with _directory_lock(path, exclusive=True):
+        for prefix, combine in _COMPACTED_FILE_PREFIXES.items():
+            files = [os.path.join(path, f'{prefix}_{pid}.db') for pid in pids]
+            files = [f for f in files if os.path.exists(f)]
+            if not files:
+                continue
+            archive = os.path.join(path, f'{prefix}_{_ARCHIVE_ID}.db')
+            if os.path.exists(archive):
+                files.insert(0, archive)
+
+            combined = {}
+            exemplars = {}
+            for f in files:
+                for key, value, timestamp, exemplar in _FileCache().read_values(f, _compacted_key):
+                    if exemplar is not None:
+                        _keep_most_recent(exemplars, key, exemplar)
+                    current = combined.get(key)
+                    if current is None:
+                        combined[key] = (value, timestamp)
+                    elif combine == 'sum':
+                        combined[key] = (current[0] + value, 0.0)
+                    elif combine == 'min':
+                        combined[key] = (min(current[0], value), 0.0)
+                    elif combine == 'max':
+                        combined[key] = (max(current[0], value), 0.0)
+                    elif timestamp > current[1]:  # mostrecent
+                        combined[key] = (value, timestamp)
+
+            # The new archive is only visible once complete, and collections
+            # wait for the lock so never see both it and the removed files.
+            tmp = f'{archive}.{os.getpid()}.tmp'
+            archive_dict = MmapedDict(tmp)
+            try:
+                for key, (value, timestamp) in combined.items():
+                    archive_dict.write_value(key, value, timestamp)
+                for key, exemplar in exemplars.items():
+                    archive_dict.write_exemplar(key, exemplar)
+            finally:
+                archive_dict.close()
+            os.replace(tmp, archive)
+            for f in files:
+                if f != archive:
+                    os.remove(f)
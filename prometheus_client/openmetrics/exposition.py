@@ -4,6 +4,7 @@ from io import StringIO
 from sys import maxunicode
 from typing import Callable
 
+from ..samples import LabelSet
 from ..utils import floatToGoString, parse_version
 from ..validation import (
     _is_valid_legacy_labelname, _is_valid_legacy_metric_name,
@@ -22,6 +23,35 @@ DOTS = 'dots'
 VALUES = 'values'
 
 
+class _RenderCache:
+    """Rendered text keyed by everything it is rendered from.
+
+    Each scrape starts a new generation, and entries are carried over from the
+    previous one as they are used. Entries that were not used during the last
+    scrape, such as those of removed metrics and labelsets, are dropped.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._previous = {}
+
+    def new_scrape(self):
+        self._previous = self._entries
+        self._entries = {}
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            value = self._previous.get(key)
+            if value is not None:
+                self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        return value
+
+
 def _is_valid_exemplar_metric(metric, sample):
     if metric.type == 'counter' and sample.name.endswith('_total'):
         return True
@@ -55,34 +85,84 @@ def _compose_exemplar_string(metric, sample, exemplar):
     return exemplarstr
 
 
+# HELP, TYPE and UNIT lines of each metric family, and the rendered name and
+# labels of samples whose labels are not a LabelSet, as they rarely change
+# between scrapes. Label sets keep the renderings of their own samples.
+_headers = _RenderCache()
+_sample_prefixes = _RenderCache()
+
+
+def _render_header(metric, escaping):
+    mname = escape_metric_name(metric.name, escaping)
+    header = '# HELP {} {}\n'.format(mname, _escape(metric.documentation, ALLOWUTF8, _is_legacy_labelname_rune))
+    header += f'# TYPE {mname} {metric.type}\n'
+    if metric.unit:
+        header += f'# UNIT {mname} {metric.unit}\n'
+    return header
+
+
+def _render_labels(labels, escaping):
+    """Render labels as comma separated name="value" pairs, ordered by name.
+
+    Label sets are usually ordered already."""
+    items = labels._sorted_items() if isinstance(labels, LabelSet) else sorted(labels.items())
+    # Label values always support UTF-8
+    return ','.join(
+        ['{}="{}"'.format(
+            escape_label_name(k, escaping), _escape(v, ALLOWUTF8, _is_legacy_labelname_rune))
+            for k, v in items])
+
+
+def _render_sample_prefix(s, escaping):
+    """Render the name and labels of a sample, followed by a space."""
+    if escaping == ALLOWUTF8 and not _is_valid_legacy_metric_name(s.name):
+        labelstr = escape_metric_name(s.name, escaping)
+        if s.labels:
+            labelstr += ','
+    else:
+        labelstr = ''
+
+    if s.labels:
+        labelstr += _render_labels(s.labels, escaping)
+    if labelstr:
+        labelstr = "{" + labelstr + "}"
+    if (escaping != ALLOWUTF8) or _is_valid_legacy_metric_name(s.name):
+        return f'{_escape(s.name, escaping, _is_legacy_labelname_rune)}{labelstr} '
+    return f'{labelstr} '
+
+
 def generate_latest(registry, escaping=UNDERSCORES, version="1.0.0"):
     '''Returns the metrics from the registry in latest text format as a string.'''
-    output = []
+    return b''.join(generate_latest_chunks(registry, escaping, version))
+
+
+def generate_latest_chunks(registry, escaping=UNDERSCORES, version="1.0.0"):
+    '''Yields the metrics from the registry in latest text format, one encoded chunk per metric family.
+
+    The registry is collected while the chunks are consumed.'''
+    _headers.new_scrape()
+    _sample_prefixes.new_scrape()
     for metric in registry.collect():
+        output = []
         try:
-            mname = metric.name
-            output.append('# HELP {} {}\n'.format(
-                escape_metric_name(mname, escaping), _escape(metric.documentation, ALLOWUTF8, _is_legacy_labelname_rune)))
-            output.append(f'# TYPE {escape_metric_name(mname, escaping)} {metric.type}\n')
-            if metric.unit:
-                output.append(f'# UNIT {escape_metric_name(mname, escaping)} {metric.unit}\n')
+            key = (metric.name, metric.type, metric.documentation, metric.unit, escaping)
+            header = _headers.get(key)
+            if header is None:
+                header = _headers.put(key, _render_header(metric, escaping))
+            output.append(header)
             for s in metric.samples:
-                if escaping == ALLOWUTF8 and not _is_valid_legacy_metric_name(s.name):
-                    labelstr = escape_metric_name(s.name, escaping)
-                    if s.labels:
-                        labelstr += ','
+                labels = s.labels
+                if isinstance(labels, LabelSet):
+                    rendered = labels._renderings()
+                    key = ('openmetrics', s.name, labels._extra, escaping)
+                    prefix = rendered.get(key)
+                    if prefix is None:
+                        prefix = rendered[key] = _render_sample_prefix(s, escaping)
                 else:
-                    labelstr = ''
-
-                if s.labels:
-                    items = sorted(s.labels.items())
-                    # Label values always support UTF-8
-                    labelstr += ','.join(
-                        ['{}="{}"'.format(
-                            escape_label_name(k, escaping), _escape(v, ALLOWUTF8, _is_legacy_labelname_rune))
-                            for k, v in items])
-                if labelstr:
-                    labelstr = "{" + labelstr + "}"
+                    key = (s.name, tuple(labels.items()), escaping)
+                    prefix = _sample_prefixes.get(key)
+                    if prefix is None:
+                        prefix = _sample_prefixes.put(key, _render_sample_prefix(s, escaping))
                 if s.exemplar:
                     exemplarstr = _compose_exemplar_string(metric, s, s.exemplar)
                 else:
@@ -147,27 +227,13 @@ def generate_latest(registry, escaping=UNDERSCORES, version="1.0.0"):
                     value = native_histogram
                 elif s.value is not None:
                     value = floatToGoString(s.value)
-                if (escaping != ALLOWUTF8) or _is_valid_legacy_metric_name(s.name):
-                    output.append('{}{} {}{}{}\n'.format(
-                        _escape(s.name, escaping, _is_legacy_labelname_rune),
-                        labelstr,
-                        value,
-                        timestamp,
-                        exemplarstr
-                    ))
-                else:
-                    output.append('{} {}{}{}\n'.format(
-                        labelstr,
-                        value,
-                        timestamp,
-                        exemplarstr
-                    ))
+                output.append(f'{prefix}{value}{timestamp}{exemplarstr}\n')
         except Exception as exception:
             exception.args = (exception.args or ('',)) + (metric,)
             raise
+        yield ''.join(output).encode('utf-8')
 
-    output.append('# EOF\n')
-    return ''.join(output).encode('utf-8')
+    yield b'# EOF\n'
 
 
 def escape_metric_name(s: str, escaping: str = UNDERSCORES) -> str:
@@ -0,0 +1,345 @@
+"""Encoder of the Prometheus protobuf exposition format.
+
+The io.prometheus.client.MetricFamily messages are encoded by hand, so no
+protobuf library is needed.
+"""
+import math
+import struct
+
+from ..openmetrics.exposition import (
+    _RenderCache, ALLOWUTF8, escape_label_name, escape_metric_name,
+    UNDERSCORES,
+)
+from ..samples import LabelSet, Timestamp
+
+CONTENT_TYPE_PROTOBUF = 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited'
+"""Content type of the delimited protobuf format"""
+
+# Values of the MetricType enum.
+_COUNTER = 0
+_GAUGE = 1
+_SUMMARY = 2
+_UNTYPED = 3
+_HISTOGRAM = 4
+_GAUGE_HISTOGRAM = 5
+
+_TYPES = {
+    'counter': _COUNTER,
+    'gauge': _GAUGE,
+    'summary': _SUMMARY,
+    'histogram': _HISTOGRAM,
+    'gaugehistogram': _GAUGE_HISTOGRAM,
+    'info': _GAUGE,
+    'stateset': _GAUGE,
+    'unknown': _UNTYPED,
+}
+
+# Wire types.
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+
+_pack_double = struct.Struct('<d').pack
+
+# Encoded label pairs of each label set, and encoded created timestamps, as
+# they rarely change between scrapes.
+_label_pairs = _RenderCache()
+_created_timestamps = _RenderCache()
+
+
+_SMALL_VARINTS = [bytes((i,)) for i in range(0x80)]
+
+
+def _varint(value):
+    if 0 <= value < 0x80:
+        return _SMALL_VARINTS[value]
+    if value < 0:
+        # Negative int64 values are encoded as their two's complement.
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+# The encoded keys of fields 0 to 16, for each wire type.
+_VARINT_KEYS = [_varint(field << 3 | _VARINT) for field in range(17)]
+_FIXED64_KEYS = [_varint(field << 3 | _FIXED64) for field in range(17)]
+_LENGTH_DELIMITED_KEYS = [_varint(field << 3 | _LENGTH_DELIMITED) for field in range(17)]
+
+
+def _bytes_field(field, data):
+    return _LENGTH_DELIMITED_KEYS[field] + _varint(len(data)) + data
+
+
+def _string_field(field, value):
+    return _bytes_field(field, value.encode('utf-8'))
+
+
+def _double_field(field, value):
+    return _FIXED64_KEYS[field] + _pack_double(value)
+
+
+def _varint_field(field, value):
+    return _VARINT_KEYS[field] + _varint(value)
+
+
+def _is_integer_count(value):
+    return value >= 0 and math.isfinite(value) and value == int(value)
+
+
+def _count_fields(field, float_field, value, as_float=None):
+    """Encode a count, as an integer if it is one and as a double otherwise."""
+    if as_float is None:
+        as_float = not _is_integer_count(value)
+    if as_float:
+        return _double_field(float_field, value)
+    return _varint_field(field, int(value))
+
+
+def _timestamp(value):
+    """Encode a google.protobuf.Timestamp message."""
+    if isinstance(value, Timestamp):
+        seconds, nanos = value.sec, value.nsec
+        if nanos < 0:
+            seconds -= 1
+            nanos += 1000000000
+    else:
+        value = float(value)
+        seconds = math.floor(value)
+        nanos = int(round((value - seconds) * 1e9))
+        if nanos == 1000000000:
+            seconds += 1
+            nanos = 0
+    return _varint_field(1, seconds) + _varint_field(2, nanos)
+
+
+def _created_timestamp(value):
+    encoded = _created_timestamps.get(value)
+    if encoded is None:
+        encoded = _created_timestamps.put(value, _timestamp(value))
+    return encoded
+
+
+def _escape_name(name, escaping, escape):
+    # Names in protobuf are not quoted, so they are only escaped for the
+    # schemes that replace characters.
+    if escaping == ALLOWUTF8:
+        return name
+    return escape(name, escaping)
+
+
+def _encode_labels(labels, escaping):
+    if isinstance(labels, LabelSet):
+        rendered = labels._renderings()
+        key = ('protobuf', labels._extra, escaping)
+        encoded = rendered.get(key)
+        if encoded is None:
+            encoded = rendered[key] = _join_label_pairs(labels._sorted_items(), escaping)
+        return encoded
+    key = (tuple(labels.items()), escaping)
+    encoded = _label_pairs.get(key)
+    if encoded is None:
+        encoded = _label_pairs.put(key, _join_label_pairs(sorted(labels.items()), escaping))
+    return encoded
+
+
+def _join_label_pairs(items, escaping):
+    return b''.join(
+        _bytes_field(1, _string_field(1, _escape_name(k, escaping, escape_label_name)) + _string_field(2, v))
+        for k, v in items)
+
+
+def _exemplar(exemplar, escaping):
+    """Encode an Exemplar message."""
+    out = _encode_labels(exemplar.labels, escaping) + _double_field(2, exemplar.value)
+    if exemplar.timestamp is not None:
+        out += _bytes_field(3, _timestamp(exemplar.timestamp))
+    return out
+
+
+def _spans(field, spans):
+    return b''.join(
+        _bytes_field(field, _varint_field(1, _zigzag(offset)) + _varint_field(2, length))
+        for offset, length in spans)
+
+
+def _native_histogram(h, escaping):
+    """Encode the native histogram fields of a Histogram message."""
+    out = _varint_field(5, _zigzag(h.schema))
+    out += _double_field(6, h.zero_threshold)
+    out += _count_fields(7, 8, h.zero_count)
+    if h.neg_spans:
+        out += _spans(9, h.neg_spans)
+        out += b''.join(_varint_field(10, _zigzag(d)) for d in h.neg_deltas or ())
+    if h.pos_spans:
+        out += _spans(12, h.pos_spans)
+        out += b''.join(_varint_field(13, _zigzag(d)) for d in h.pos_deltas or ())
+    for exemplar in h.nh_exemplars or ():
+        out += _bytes_field(16, _exemplar(exemplar, escaping))
+    return out
+
+
+class _Series:
+    """The samples of one Metric message."""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = None
+        self.exemplar = None
+        self.timestamp = None
+        self.count = None
+        self.sum = None
+        self.created = None
+        self.buckets = []
+        self.quantiles = []
+        self.native_histogram = None
+
+
+def _group_samples(metric):
+    """Group the samples of a metric family into the series they belong to."""
+    series = {}
+    typ = metric.type
+    if typ in ('counter', 'summary', 'histogram', 'gaugehistogram'):
+        # Samples with the same labels, apart from the bucket or quantile,
+        # belong to the same series.
+        for s in metric.samples:
+            labels = s.labels
+            if typ == 'summary' and 'quantile' in labels or typ != 'summary' and 'le' in labels:
+                if isinstance(labels, LabelSet) and labels._base is not None and all(
+                        k in ('le', 'quantile') for k, _ in labels._extra):
+                    labels = labels._base
+                else:
+                    labels = {k: v for k, v in labels.items() if k not in ('le', 'quantile')}
+            key = labels if isinstance(labels, LabelSet) else LabelSet(labels)
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = _Series(labels)
+            suffix = s.name[len(metric.name):]
+            if s.timestamp is not None and entry.timestamp is None:
+                entry.timestamp = s.timestamp
+            if s.native_histogram is not None:
+                entry.native_histogram = s.native_histogram
+            elif suffix == '_created':
+                entry.created = s.value
+            elif suffix == '_total' or typ == 'counter' and suffix == '':
+                entry.value = s.value
+                entry.exemplar = s.exemplar
+            elif suffix == '_bucket':
+                entry.buckets.append((float(s.labels['le']), s.value, s.exemplar))
+            elif suffix in ('_count', '_gcount'):
+                entry.count = s.value
+            elif suffix in ('_sum', '_gsum'):
+                entry.sum = s.value
+            elif typ == 'summary' and 'quantile' in s.labels:
+                entry.quantiles.append((float(s.labels['quantile']), s.value))
+        return series.values()
+    # Every sample of the other types is a series of its own.
+    for s in metric.samples:
+        if s.native_histogram is not None:
+            continue
+        entry = _Series(s.labels)
+        entry.value = s.value
+        entry.timestamp = s.timestamp
+        series[len(series)] = entry
+    return series.values()
+
+
+def _metric(metric_type, entry, escaping):
+    """Encode a Metric message."""
+    out = _encode_labels(entry.labels, escaping)
+    if metric_type == _COUNTER:
+        counter = _double_field(1, entry.value if entry.value is not None else 0.0)
+        if entry.exemplar is not None:
+            counter += _bytes_field(2, _exemplar(entry.exemplar, escaping))
+        if entry.created is not None:
+            counter += _bytes_field(3, _created_timestamp(entry.created))
+        out += _bytes_field(3, counter)
+    elif metric_type == _GAUGE:
+        out += _bytes_field(2, _double_field(1, entry.value))
+    elif metric_type == _UNTYPED:
+        out += _bytes_field(5, _double_field(1, entry.value))
+    elif metric_type == _SUMMARY:
+        summary = b''
+        if entry.count is not None and math.isfinite(entry.count):
+            summary += _varint_field(1, int(entry.count))
+        if entry.sum is not None:
+            summary += _double_field(2, entry.sum)
+        for quantile, value in entry.quantiles:
+            summary += _bytes_field(3, _double_field(1, quantile) + _double_field(2, value))
+        if entry.created is not None:
+            summary += _bytes_field(4, _created_timestamp(entry.created))
+        out += _bytes_field(4, summary)
+    else:
+        h = entry.native_histogram
+        count = entry.count if entry.count is not None else h.count_value if h is not None else None
+        total = entry.sum if entry.sum is not None else h.sum_value if h is not None else None
+        # Consumers read either the integer or the float counts of a
+        # histogram, so if one of them is not an integer all are floats.
+        as_float = not all(_is_integer_count(c) for c in [count or 0] + [b[1] for b in entry.buckets])
+        histogram = b''
+        if count is not None:
+            histogram += _count_fields(1, 4, count, as_float)
+        if total is not None:
+            histogram += _double_field(2, total)
+        for upper_bound, cumulative_count, exemplar in entry.buckets:
+            bucket = _count_fields(1, 4, cumulative_count, as_float) + _double_field(2, upper_bound)
+            if exemplar is not None:
+                bucket += _bytes_field(3, _exemplar(exemplar, escaping))
+            histogram += _bytes_field(3, bucket)
+        if h is not None:
+            histogram += _native_histogram(h, escaping)
+        if entry.created is not None:
+            histogram += _bytes_field(15, _created_timestamp(entry.created))
+        out += _bytes_field(7, histogram)
+    if entry.timestamp is not None:
+        out += _varint_field(6, int(float(entry.timestamp) * 1000))
+    return out
+
+
+def _metric_family(metric, escaping):
+    """Encode a MetricFamily message, or return None if it has no series."""
+    mname = metric.name
+    if metric.type == 'counter':
+        mname += '_total'
+    elif metric.type == 'info':
+        mname += '_info'
+    metric_type = _TYPES.get(metric.type, _UNTYPED)
+    series = _group_samples(metric)
+    if not series:
+        return None
+    out = _string_field(1, _escape_name(mname, escaping, escape_metric_name))
+    out += _string_field(2, metric.documentation)
+    out += _varint_field(3, metric_type)
+    out += b''.join(_bytes_field(4, _metric(metric_type, entry, escaping)) for entry in series)
+    if metric.unit:
+        out += _string_field(5, metric.unit)
+    return out
+
+
+def generate_latest(registry, escaping=UNDERSCORES):
+    '''Returns the metrics from the registry in the delimited protobuf format.'''
+    return b''.join(generate_latest_chunks(registry, escaping))
+
+
+def generate_latest_chunks(registry, escaping=UNDERSCORES):
+    '''Yields the metrics from the registry in the delimited protobuf format, one chunk per metric family.
+
+    Each chunk is a MetricFamily message preceded by its length as a varint.
+    The registry is collected while the chunks are consumed.'''
+    _label_pairs.new_scrape()
+    _created_timestamps.new_scrape()
+    for metric in registry.collect():
+        try:
+            family = _metric_family(metric, escaping)
+        except Exception as exception:
+            exception.args = (exception.args or ('',)) + (metric,)
+            raise
+        if family is not None:
+            yield _varint(len(family)) + family
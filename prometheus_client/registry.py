@@ -4,6 +4,9 @@ from typing import Dict, Iterable, List, Optional, Protocol
 
 from .metrics_core import Metric
 
+# What a labelled metric does with a new labelset once it has max_children.
+CARDINALITY_POLICIES = ('reject', 'overflow', 'evict')
+
 
 class Collector(Protocol):
     def collect(self) -> Iterable[Metric]:
@@ -21,10 +24,20 @@ class CollectorRegistry:
     Collectors must have a no-argument method 'collect' that returns a list of
     Metric objects. The returned metrics should be consistent with the Prometheus
     exposition formats.
+
+    max_children and cardinality_policy are the defaults for labelled metrics
+    registered here which do not set their own, see MetricWrapperBase.
     """
 
     def __init__(self, auto_describe: bool = False, target_info: Optional[Dict[str, str]] = None,
-                 support_collectors_without_names: bool = False):
+                 support_collectors_without_names: bool = False,
+                 max_children: Optional[int] = None, cardinality_policy: str = 'overflow'):
+        if max_children is not None and max_children < 1:
+            raise ValueError('max_children must be at least 1')
+        if cardinality_policy not in CARDINALITY_POLICIES:
+            raise ValueError('Invalid cardinality policy: ' + cardinality_policy)
+        self._max_children = max_children
+        self._cardinality_policy = cardinality_policy
         self._collector_to_names: Dict[Collector, List[str]] = {}
         self._names_to_collectors: Dict[str, Collector] = {}
         self._auto_describe = auto_describe
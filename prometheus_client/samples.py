@@ -1,4 +1,6 @@
-from typing import Dict, NamedTuple, Optional, Sequence, Union
+from typing import (
+    Any, Dict, Iterable, Mapping, NamedTuple, Optional, Sequence, Tuple, Union,
+)
 
 
 class Timestamp:
@@ -34,6 +36,73 @@ class Timestamp:
         return self.nsec < other.nsec if self.sec == other.sec else self.sec < other.sec
 
 
+class LabelSet(Dict[str, str]):
+    """An immutable set of labels, ordered by name.
+
+    It is a dict, so it compares equal to a dict of the same labels, but it
+    is also hashable. Each child of a metric keeps the label set of its own
+    labels, which also keeps how the exposition formats rendered its samples.
+    Samples that add labels, such as le or quantile, get a label set that
+    extends it, with the added labels after its own, and uses its renderings.
+    """
+    __slots__ = ('_base', '_extra', '_hash', '_rendered')
+
+    # Renderings kept per label set. The labels that Info samples add change
+    # with the value, so old renderings are dropped once there are this many.
+    _MAX_RENDERED = 1024
+
+    def __init__(self, labels: Union[Mapping[str, str], Iterable[Tuple[str, str]]] = ()) -> None:
+        super().__init__(sorted(dict(labels).items()))
+        self._base: Optional[LabelSet] = None
+        self._extra: Tuple[Tuple[str, str], ...] = ()
+        self._hash: Optional[int] = None
+        self._rendered: Optional[Dict[Any, Any]] = None
+
+    def __hash__(self) -> int:  # type: ignore[override]
+        if self._hash is None:
+            self._hash = hash(frozenset(self.items()))
+        return self._hash
+
+    def __reduce__(self) -> Any:
+        return LabelSet, (tuple(self.items()),)
+
+    def _extend(self, extra: Tuple[Tuple[str, str], ...]) -> "LabelSet":
+        """Return these labels followed by extra ones.
+
+        Unlike other label sets, the result is not ordered by name, as it is
+        built for every sample on each collection."""
+        labelset = LabelSet.__new__(LabelSet)
+        dict.__init__(labelset, self)
+        dict.update(labelset, extra)
+        labelset._base = self
+        labelset._extra = extra
+        labelset._hash = None
+        labelset._rendered = None
+        return labelset
+
+    def _sorted_items(self) -> Iterable[Tuple[str, str]]:
+        if self._base is None:
+            return self.items()
+        return sorted(self.items())
+
+    def _renderings(self) -> Dict[Any, Any]:
+        """Return the renderings of samples with these labels.
+
+        They are keyed by the format, the sample name, the extra labels and the
+        escaping scheme, and kept by the label set that was extended."""
+        labelset = self if self._base is None else self._base
+        rendered = labelset._rendered
+        if rendered is None or len(rendered) >= self._MAX_RENDERED:
+            rendered = labelset._rendered = {}
+        return rendered
+
+    def _immutable(self, *args: Any, **kwargs: Any) -> Any:
+        raise TypeError('LabelSet is immutable, use dict(labels) for a mutable copy')
+
+    __setitem__ = __delitem__ = __ior__ = _immutable  # type: ignore
+    clear = pop = popitem = setdefault = update = _immutable  # type: ignore
+
+
 # BucketSpan is experimental and subject to change at any time.
 class BucketSpan(NamedTuple):
     offset: int
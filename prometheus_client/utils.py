@@ -6,9 +6,30 @@ MINUS_INF = float("-inf")
 NaN = float("NaN")
 
 
+# Formatted small counts, bucket bounds, quantiles and other small values,
+# which repeat between scrapes. Zero is never stored as -0.0 compares equal to
+# it, nor is NaN as it equals nothing.
+_GO_STRINGS_PRESET = {INF: '+Inf', MINUS_INF: '-Inf'}
+_GO_STRINGS_PRESET.update((float(i), f'{i}.0') for i in range(1, 1024))
+_GO_STRINGS_MAX_ENTRIES = len(_GO_STRINGS_PRESET) + (1 << 12)
+_go_strings = dict(_GO_STRINGS_PRESET)
+
+
 def floatToGoString(d):
+    s = _go_strings.get(d)
+    if s is not None:
+        return s
     d = float(d)
-    if d == INF:
+    if MINUS_INF < d < 1e6:
+        s = repr(d)
+        # Larger counts rarely repeat.
+        if d and not d.is_integer():
+            if len(_go_strings) >= _GO_STRINGS_MAX_ENTRIES:
+                _go_strings.clear()
+                _go_strings.update(_GO_STRINGS_PRESET)
+            _go_strings[d] = s
+        return s
+    elif d == INF:
         return '+Inf'
     elif d == MINUS_INF:
         return '-Inf'
@@ -19,7 +40,7 @@ def floatToGoString(d):
         dot = s.find('.')
         # Go switches to exponents sooner than Python.
         # We only need to care about positive values for le/quantile.
-        if d > 0 and dot > 6:
+        if dot > 6:
             mantissa = f'{s[0]}.{s[1:dot]}{s[dot + 1:]}'.rstrip('0.')
             return f'{mantissa}e+0{dot - 1}'
         return s
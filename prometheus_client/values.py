@@ -1,14 +1,201 @@
+from array import array
+from bisect import bisect_left
+import itertools
+import math
 import os
-from threading import Lock
+import sys
+from threading import local, Lock, RLock
+import time
 import warnings
+import weakref
 
-from .mmap_dict import mmap_key, MmapedDict
+from .mmap_dict import (
+    _GROWTH_FACTOR, _INITIAL_MMAP_SIZE, _initial_mmap_size, mmap_key,
+    MmapedDict,
+)
+from .samples import BucketSpan, NativeHistogram
+from .utils import floatToGoString
+
+
+class MutexHistogramValue:
+    """All bucket counts and the sum of a histogram, protected by a mutex.
+
+    The values are kept in a single array: the bucket counts, a slot for
+    observations that fall in no bucket (NaN), and the sum.
+    """
+
+    def __init__(self, bucket_count):
+        self._bucket_count = bucket_count
+        self._values = array('d', [0.0]) * (bucket_count + 2)
+        self._exemplars = None
+        self._lock = Lock()
+
+    def observe(self, index, amount):
+        with self._lock:
+            self._values[index] += 1
+            self._values[-1] += amount
+
+    def observe_many(self, counts, total):
+        with self._lock:
+            values = self._values
+            for i, count in enumerate(counts):
+                if count:
+                    values[i] += count
+            values[-1] += total
+
+    def set_exemplar(self, index, exemplar):
+        with self._lock:
+            if self._exemplars is None:
+                self._exemplars = [None] * self._bucket_count
+            self._exemplars[index] = exemplar
+
+    def get(self):
+        with self._lock:
+            values = self._values.tolist()
+        return values[:self._bucket_count], values[-1]
+
+    def get_exemplars(self):
+        with self._lock:
+            if self._exemplars is None:
+                return [None] * self._bucket_count
+            return list(self._exemplars)
+
+
+class _ShardOwner:
+    """Kept in the thread-local storage of a thread, so it is freed when the thread exits."""
+    __slots__ = ('__weakref__',)
+
+
+_shard_keys = itertools.count()
+
+
+def _add_shard(value, shard):
+    """Register shard as the shard of the current thread in a sharded value.
+
+    Once the thread exits its thread-local storage is freed, and the shard is
+    folded into the value, so that short-lived threads do not leave their
+    shards behind.
+    """
+    key = next(_shard_keys)
+    with value._lock:
+        value._shards[key] = shard
+    owner = _ShardOwner()
+    value._local.shard = shard
+    value._local.owner = owner
+    weakref.finalize(owner, _fold_shard, weakref.ref(value), key)
+    return shard
+
+
+def _fold_shard(value_ref, key):
+    value = value_ref()
+    if value is not None:
+        with value._lock:
+            shard = value._shards.pop(key, None)
+            if shard is not None:
+                value._fold(shard)
+
+
+class ShardedHistogramValue(MutexHistogramValue):
+    """All bucket counts and the sum of a histogram, sharded per thread.
+
+    Like ShardedValue, each thread observes into its own array without
+    taking a lock, and the arrays are only summed in get().
+    """
+
+    def __init__(self, bucket_count):
+        super().__init__(bucket_count)
+        self._shards = {}
+        self._local = local()
+
+    def _new_shard(self):
+        return _add_shard(self, array('d', [0.0]) * (self._bucket_count + 2))
+
+    def _fold(self, shard):
+        for i, value in enumerate(shard):
+            self._values[i] += value
+
+    def observe(self, index, amount):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[index] += 1
+        shard[-1] += amount
+
+    def observe_many(self, counts, total):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        for i, count in enumerate(counts):
+            if count:
+                shard[i] += count
+        shard[-1] += total
+
+    def get(self):
+        with self._lock:
+            values = self._values.tolist()
+            for shard in self._shards.values():
+                for i, value in enumerate(shard):
+                    values[i] += value
+        return values[:self._bucket_count], values[-1]
+
+
+class PerBucketHistogramValue:
+    """The buckets and sum of a histogram, each stored in a value_class.
+
+    This is used with value classes that have no dedicated histogram
+    storage, such as in multiprocess mode where every bucket has its own
+    entry in the mmaped file.
+    """
+
+    def __init__(self, value_class, typ, metric_name, labelnames, labelvalues, help_text, upper_bounds):
+        self._sum = value_class(typ, metric_name, metric_name + '_sum', labelnames, labelvalues, help_text)
+        bucket_labelnames = tuple(labelnames) + ('le',)
+        self._buckets = [
+            value_class(
+                typ,
+                metric_name,
+                metric_name + '_bucket',
+                bucket_labelnames,
+                tuple(labelvalues) + (floatToGoString(b),),
+                help_text,
+            )
+            for b in upper_bounds
+        ]
+
+    def observe(self, index, amount):
+        self._sum.inc(amount)
+        if index < len(self._buckets):
+            self._buckets[index].inc(1)
+
+    def observe_many(self, counts, total):
+        self._sum.inc(total)
+        for bucket, count in zip(self._buckets, counts):
+            if count:
+                bucket.inc(count)
+
+    def set_exemplar(self, index, exemplar):
+        self._buckets[index].set_exemplar(exemplar)
+
+    def get(self):
+        return [bucket.get() for bucket in self._buckets], self._sum.get()
+
+    def remove(self):
+        for value in [self._sum] + self._buckets:
+            remove = getattr(value, 'remove', None)
+            if remove is not None:
+                remove()
+
+    def get_exemplars(self):
+        return [bucket.get_exemplar() for bucket in self._buckets]
 
 
 class MutexValue:
     """A float protected by a mutex."""
 
     _multiprocess = False
+    _histogram_value_class = MutexHistogramValue
 
     def __init__(self, typ, metric_name, name, labelnames, labelvalues, help_text, **kwargs):
         self._value = 0.0
@@ -36,21 +223,355 @@ class MutexValue:
             return self._exemplar
 
 
-def MultiProcessValue(process_identifier=os.getpid):
+class ShardedValue:
+    """A float sharded across per-thread accumulators.
+
+    Each thread increments its own shard without taking a lock, and the
+    shards are only summed in get(), moving the cost from the hot path
+    to the scrape. The shard of a thread is folded into the value when the
+    thread exits. set() resets all shards, so increments racing with a
+    set() may be lost; this is intended for counters and histograms.
+    """
+
+    _multiprocess = False
+    _histogram_value_class = ShardedHistogramValue
+
+    def __init__(self, typ, metric_name, name, labelnames, labelvalues, help_text, **kwargs):
+        self._base = 0.0
+        self._shards = {}
+        self._local = local()
+        self._exemplar = None
+        self._lock = Lock()
+
+    def _new_shard(self):
+        return _add_shard(self, [0.0])
+
+    def _fold(self, shard):
+        self._base += shard[0]
+
+    def inc(self, amount):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[0] += amount
+
+    def set(self, value, timestamp=None):
+        with self._lock:
+            self._base = value
+            # Threads keep their shards, so they are reset in place.
+            for shard in self._shards.values():
+                shard[0] = 0.0
+
+    def set_exemplar(self, exemplar):
+        with self._lock:
+            self._exemplar = exemplar
+
+    def get(self):
+        with self._lock:
+            return self._base + sum(shard[0] for shard in self._shards.values())
+
+    def get_exemplar(self):
+        with self._lock:
+            return self._exemplar
+
+
+def _native_histogram_bounds(schema):
+    # The upper bounds of the buckets within one power of two, expressed as
+    # the fractions returned by math.frexp, which are in [0.5, 1).
+    return tuple(0.5 * 2 ** (i / (1 << schema)) for i in range(1 << schema))
+
+
+def _native_histogram_spans(buckets):
+    """Convert a sparse {index: count} map to spans and deltas.
+
+    Gaps of up to two empty buckets are filled with zeros rather than
+    starting a new span, as that encodes more compactly.
+    """
+    spans = []
+    deltas = []
+    previous_index = None
+    previous_count = 0
+    for index in sorted(buckets):
+        count = buckets[index]
+        if previous_index is None:
+            spans.append([index, 0])
+        else:
+            gap = index - previous_index - 1
+            if gap > 2:
+                spans.append([gap, 0])
+            else:
+                for _ in range(gap):
+                    deltas.append(-previous_count)
+                    previous_count = 0
+                spans[-1][1] += gap
+        spans[-1][1] += 1
+        deltas.append(count - previous_count)
+        previous_index = index
+        previous_count = count
+    return tuple(BucketSpan(offset, length) for offset, length in spans), tuple(deltas)
+
+
+class NativeHistogramValue:
+    """A sparse exponential histogram protected by a mutex.
+
+    Observations are counted in buckets whose boundaries grow by a factor of
+    2 ** (2 ** -schema). Only buckets that have been observed into are kept.
+    Whenever more than max_buckets buckets are populated the schema is
+    reduced, merging neighbouring buckets pairwise, until they fit.
+    """
+
+    def __init__(self, schema, zero_threshold, max_buckets):
+        self._schema = schema
+        self._zero_threshold = zero_threshold
+        self._max_buckets = max_buckets
+        self._count = 0
+        self._sum = 0.0
+        self._zero_count = 0
+        self._positive = {}
+        self._negative = {}
+        self._exemplar = None
+        self._lock = Lock()
+        self._set_schema(schema)
+
+    def _set_schema(self, schema):
+        self._schema = schema
+        self._bounds = _native_histogram_bounds(schema) if schema > 0 else None
+
+    def _index(self, amount):
+        if amount == math.inf:
+            amount = sys.float_info.max
+        frac, exp = math.frexp(amount)
+        if self._bounds is not None:
+            return bisect_left(self._bounds, frac) + (exp - 1) * len(self._bounds)
+        if frac == 0.5:
+            exp -= 1
+        shift = -self._schema
+        return (exp + (1 << shift) - 1) >> shift
+
+    def _reduce_schema(self):
+        while len(self._positive) + len(self._negative) > self._max_buckets and self._schema > -4:
+            self._set_schema(self._schema - 1)
+            for old in (self._positive, self._negative):
+                merged = {}
+                for index, count in old.items():
+                    # Bucket i of the old schema lies within bucket ceil(i / 2).
+                    new_index = (index + 1) >> 1
+                    merged[new_index] = merged.get(new_index, 0) + count
+                old.clear()
+                old.update(merged)
+
+    def observe(self, amount):
+        with self._lock:
+            self._sum += amount
+            # Like the classic buckets, the count leaves NaN out, so that
+            # both counts of a histogram agree.
+            if amount != amount:
+                return
+            self._count += 1
+            if abs(amount) <= self._zero_threshold:
+                self._zero_count += 1
+                return
+            buckets = self._positive if amount > 0 else self._negative
+            index = self._index(abs(amount))
+            if index in buckets:
+                buckets[index] += 1
+            else:
+                buckets[index] = 1
+                self._reduce_schema()
+
+    def set_exemplar(self, exemplar):
+        with self._lock:
+            self._exemplar = exemplar
+
+    def get(self):
+        with self._lock:
+            pos_spans, pos_deltas = _native_histogram_spans(self._positive)
+            neg_spans, neg_deltas = _native_histogram_spans(self._negative)
+            return NativeHistogram(
+                count_value=self._count,
+                sum_value=self._sum,
+                schema=self._schema,
+                zero_threshold=self._zero_threshold,
+                zero_count=self._zero_count,
+                pos_spans=pos_spans or None,
+                neg_spans=neg_spans or None,
+                pos_deltas=pos_deltas or None,
+                neg_deltas=neg_deltas or None,
+                nh_exemplars=(self._exemplar,) if self._exemplar else None,
+            )
+
+
+class _DDSketch:
+    """A DDSketch: counts in logarithmically sized bins.
+
+    A value x > 0 is counted in bin ceil(log(x) / log(gamma)). Every value
+    within a bin is within the configured relative accuracy of the bin's
+    representative value, so quantiles are estimated to that accuracy.
+    When more than max_bins bins are in use, the lowest ones are collapsed.
+    """
+
+    def __init__(self, log_gamma, max_bins):
+        self._log_gamma = log_gamma
+        self._max_bins = max_bins
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _index(self, amount):
+        if amount == math.inf:
+            amount = sys.float_info.max
+        return math.ceil(math.log(amount) / self._log_gamma)
+
+    def add(self, amount):
+        if amount > 0:
+            bins = self.positive
+            index = self._index(amount)
+        elif amount < 0:
+            bins = self.negative
+            index = self._index(-amount)
+        else:
+            self.zero_count += 1
+            self.count += 1
+            return
+        if index in bins:
+            bins[index] += 1
+        else:
+            bins[index] = 1
+            if len(self.positive) + len(self.negative) > self._max_bins:
+                self._collapse(bins)
+        self.count += 1
+
+    def _collapse(self, bins):
+        # Fold the bins closest to zero into their neighbour, giving up
+        # accuracy for the smallest magnitudes first.
+        indexes = sorted(bins)
+        excess = len(self.positive) + len(self.negative) - self._max_bins
+        if excess >= len(indexes):
+            excess = len(indexes) - 1
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            bins[target] += bins.pop(index)
+
+
+class QuantileValue:
+    """Quantile estimates over a sliding time window, protected by a mutex.
+
+    Observations go into the newest of age_buckets sketches, and every
+    max_age_seconds / age_buckets the oldest sketch is discarded. Quantiles
+    are computed by merging all of the sketches, so they cover between
+    max_age_seconds * (age_buckets - 1) / age_buckets and max_age_seconds
+    of observations.
+    """
+
+    def __init__(self, quantiles, relative_accuracy=0.01, max_age_seconds=600, age_buckets=5, max_bins=2048):
+        self._quantiles = tuple(quantiles)
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._gamma = gamma
+        self._log_gamma = math.log(gamma)
+        self._max_bins = max_bins
+        self._sketches = [_DDSketch(self._log_gamma, max_bins) for _ in range(age_buckets)]
+        self._head = 0
+        self._rotate_interval = max_age_seconds / age_buckets
+        self._next_rotation = time.monotonic() + self._rotate_interval
+        self._lock = Lock()
+
+    def _rotate(self, now):
+        """Discard the sketches that aged out of the window. Lock must be held by caller."""
+        rotations = int((now - self._next_rotation) // self._rotate_interval) + 1
+        for _ in range(min(rotations, len(self._sketches))):
+            self._head = (self._head + 1) % len(self._sketches)
+            self._sketches[self._head] = _DDSketch(self._log_gamma, self._max_bins)
+        self._next_rotation += rotations * self._rotate_interval
+
+    def observe(self, amount):
+        if amount != amount:  # NaN can not be ranked.
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_rotation:
+                self._rotate(now)
+            self._sketches[self._head].add(amount)
+
+    def _value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def get(self):
+        """Return a list of (quantile, value), NaN if nothing was observed."""
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_rotation:
+                self._rotate(now)
+            positive = {}
+            negative = {}
+            zero_count = 0
+            count = 0
+            for sketch in self._sketches:
+                for index, c in sketch.positive.items():
+                    positive[index] = positive.get(index, 0) + c
+                for index, c in sketch.negative.items():
+                    negative[index] = negative.get(index, 0) + c
+                zero_count += sketch.zero_count
+                count += sketch.count
+        if not count:
+            return [(q, math.nan) for q in self._quantiles]
+
+        # Walk the bins in ascending order of value.
+        ordered = [(-self._value(index), c) for index, c in sorted(negative.items(), reverse=True)]
+        if zero_count:
+            ordered.append((0.0, zero_count))
+        ordered.extend((self._value(index), c) for index, c in sorted(positive.items()))
+
+        result = []
+        for q in self._quantiles:
+            rank = q * (count - 1)
+            seen = 0
+            for value, c in ordered:
+                seen += c
+                if seen > rank:
+                    break
+            result.append((q, value))
+        return result
+
+
+def MultiProcessValue(process_identifier=os.getpid, initial_size=_INITIAL_MMAP_SIZE,
+                      growth_factor=_GROWTH_FACTOR, expected_series=None):
     """Returns a MmapedValue class based on a process_identifier function.
 
     The 'process_identifier' function MUST comply with this simple rule:
     when called in simultaneously running processes it MUST return distinct values.
 
     Using a different function than the default 'os.getpid' is at your own risk.
+
+    Files are created with 'initial_size' bytes, or enough for
+    'expected_series' series per file if that is larger, and grow by
+    'growth_factor' whenever they are full.
     """
+    initial_size = _initial_mmap_size(expected_series, initial_size)
+    if not growth_factor > 1:
+        raise ValueError(f'growth_factor must be greater than 1: {growth_factor}')
     files = {}
-    values = []
-    pid = {'value': process_identifier()}
-    # Use a single global lock when in multi-processing mode
-    # as we presume this means there is no threading going on.
-    # This avoids the need to also have mutexes in __MmapDict.
-    lock = Lock()
+    # The lock of each file, held while adding or removing records.
+    file_locks = {}
+    # Used as an ordered set, so removed values can be dropped.
+    values = {}
+    pid = {'value': process_identifier(), 'forked': False}
+    # With the default process identifier, forks are detected by a hook rather
+    # than by calling it on every update. Each value then has its own lock.
+    # Otherwise a single global lock is used, as before.
+    detect_forks = process_identifier is os.getpid and hasattr(os, 'register_at_fork')
+    # Held while opening files, and by all values if forks are not detected.
+    lock = RLock()
+
+    if detect_forks:
+        def after_fork():
+            nonlocal lock
+            # Locks may have been held by threads which do not exist in the child.
+            lock = RLock()
+            pid['forked'] = True
+
+        os.register_at_fork(after_in_child=after_fork)
 
     class MmapedValue:
         """A float protected by a mutex backed by a per-process mmaped file."""
@@ -59,14 +580,15 @@ def MultiProcessValue(process_identifier=os.getpid):
 
         def __init__(self, typ, metric_name, name, labelnames, labelvalues, help_text, multiprocess_mode='', **kwargs):
             self._params = typ, metric_name, name, labelnames, labelvalues, help_text, multiprocess_mode
+            self._removed = False
             # This deprecation warning can go away in a few releases when removing the compatibility
             if 'prometheus_multiproc_dir' in os.environ and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
                 os.environ['PROMETHEUS_MULTIPROC_DIR'] = os.environ['prometheus_multiproc_dir']
                 warnings.warn("prometheus_multiproc_dir variable has been deprecated in favor of the upper case naming PROMETHEUS_MULTIPROC_DIR", DeprecationWarning)
+            self.__check_for_pid_change()
             with lock:
-                self.__check_for_pid_change()
                 self.__reset()
-                values.append(self)
+                values[self] = None
 
         def __reset(self):
             typ, metric_name, name, labelnames, labelvalues, help_text, multiprocess_mode = self._params
@@ -79,48 +601,81 @@ def MultiProcessValue(process_identifier=os.getpid):
                     os.environ.get('PROMETHEUS_MULTIPROC_DIR'),
                     '{}_{}.db'.format(file_prefix, pid['value']))
 
-                files[file_prefix] = MmapedDict(filename)
+                files[file_prefix] = MmapedDict(filename, initial_size=initial_size, growth_factor=growth_factor)
+                file_locks[file_prefix] = Lock() if detect_forks else lock
             self._file = files[file_prefix]
+            self._file_lock = file_locks[file_prefix]
+            self._lock = Lock() if detect_forks else lock
             self._key = mmap_key(metric_name, name, labelnames, labelvalues, help_text)
-            self._value, self._timestamp = self._file.read_value(self._key)
+            with self._file_lock:
+                self._value, self._timestamp = self._file.read_value(self._key)
+                self._exemplar = self._file.read_exemplar(self._key)
 
         def __check_for_pid_change(self):
-            actual_pid = process_identifier()
-            if pid['value'] != actual_pid:
-                pid['value'] = actual_pid
-                # There has been a fork(), reset all the values.
-                for f in files.values():
-                    f.close()
-                files.clear()
-                for value in values:
-                    value.__reset()
+            if detect_forks:
+                if not pid['forked']:
+                    return
+            elif pid['value'] == process_identifier():
+                return
+            with lock:
+                actual_pid = process_identifier()
+                if pid['value'] != actual_pid:
+                    pid['value'] = actual_pid
+                    pid['forked'] = False
+                    # There has been a fork(), reset all the values.
+                    for f in files.values():
+                        f.close()
+                    files.clear()
+                    file_locks.clear()
+                    for value in values:
+                        value.__reset()
 
         def inc(self, amount):
-            with lock:
-                self.__check_for_pid_change()
+            self.__check_for_pid_change()
+            with self._lock:
                 self._value += amount
                 self._timestamp = 0.0
-                self._file.write_value(self._key, self._value, self._timestamp)
+                if not self._removed:
+                    # The value's record exists, so only the value is written.
+                    self._file.write_value(self._key, self._value, self._timestamp)
 
         def set(self, value, timestamp=None):
-            with lock:
-                self.__check_for_pid_change()
+            self.__check_for_pid_change()
+            with self._lock:
                 self._value = value
                 self._timestamp = timestamp or 0.0
-                self._file.write_value(self._key, self._value, self._timestamp)
+                if not self._removed:
+                    self._file.write_value(self._key, self._value, self._timestamp)
 
         def set_exemplar(self, exemplar):
-            # TODO: Implement exemplars for multiprocess mode.
-            return
+            self.__check_for_pid_change()
+            with self._lock:
+                self._exemplar = exemplar
+                if not self._removed:
+                    with self._file_lock:
+                        self._file.write_exemplar(self._key, exemplar)
 
         def get(self):
-            with lock:
-                self.__check_for_pid_change()
+            self.__check_for_pid_change()
+            with self._lock:
                 return self._value
 
+        def remove(self):
+            """Remove the value from the file. Later updates are not written."""
+            self.__check_for_pid_change()
+            with self._lock:
+                if self._removed:
+                    return
+                self._removed = True
+                with lock:
+                    del values[self]
+                with self._file_lock:
+                    self._file.remove_value(self._key)
+
         def get_exemplar(self):
-            # TODO: Implement exemplars for multiprocess mode.
-            return None
+            self.__check_for_pid_change()
+            with self._lock:
+                return self._exemplar
 
     return MmapedValue
 
@@ -131,7 +686,12 @@ def get_value_class():
     # and as that may be in some arbitrary library the user/admin has
     # no control over we use an environment variable.
     if 'prometheus_multiproc_dir' in os.environ or 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        expected_series = os.environ.get('PROMETHEUS_MULTIPROC_EXPECTED_SERIES')
+        if expected_series:
+            return MultiProcessValue(expected_series=int(expected_series))
         return MultiProcessValue()
+    elif os.environ.get('PROMETHEUS_SHARDED_VALUES', 'False').lower() in ('true', '1', 't'):
+        return ShardedValue
     else:
         return MutexValue
 
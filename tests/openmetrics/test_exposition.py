@@ -13,7 +13,7 @@ from prometheus_client.core import (
 )
 from prometheus_client.openmetrics.exposition import (
     ALLOWUTF8, DOTS, escape_label_name, escape_metric_name, generate_latest,
-    UNDERSCORES, VALUES,
+    generate_latest_chunks, UNDERSCORES, VALUES,
 )
 
 
@@ -122,6 +122,23 @@ nh {count:24,sum:100,schema:0,zero_threshold:0.001,zero_count:4,negative_spans:[
 # EOF
 """, generate_latest(self.registry, version="2.0.0"))
     
+    def test_native_histogram_instrumented(self) -> None:
+        h = Histogram('nh', 'help', ['l'], registry=self.registry, buckets=(), native_histogram_schema=0)
+        h.labels('a').observe(0.75)
+        h.labels('a').observe(3)
+        h.labels('a').observe(-3)
+        self.assertEqual(b"""# HELP nh help
+# TYPE nh histogram
+nh{l="a"} {count:3,sum:0.75,schema:0,zero_threshold:2.938735877055719e-39,zero_count:0,negative_spans:[2:1],negative_deltas:[1],positive_spans:[0:3],positive_deltas:[1,-1,1]}
+nh_bucket{l="a",le="+Inf"} 3.0
+nh_count{l="a"} 3.0
+nh_sum{l="a"} 0.75
+nh_created{l="a"} 123.456
+# EOF
+""", generate_latest(self.registry, version="2.0.0"))
+        # Native histograms are left out of older versions.
+        self.assertNotIn(b'schema', generate_latest(self.registry))
+
     def test_nh_histogram_with_exemplars(self) -> None:
         hfm = HistogramMetricFamily("nh", "nh")
         hfm.add_sample("nh", {}, 0, None, None, NativeHistogram(24, 100, 0, 0.001, 4, (BucketSpan(0, 2), BucketSpan(1, 2)), (BucketSpan(0, 2), BucketSpan(1, 2)), (2, 1, -3, 3), (2, 1, -2, 3), (Exemplar({"trace_id": "KOO5S4vxi0o"}, 0.67), Exemplar({"trace_id": "oHg5SJYRHA0"}, 9.8, float(Timestamp(1520879607, 0.789 * 1e9))))))
@@ -452,6 +469,14 @@ ts{foo="f"} 0.0 123.000000456
 # EOF
 """, generate_latest(self.registry, version="1.0.0"))
 
+    def test_chunks(self) -> None:
+        Gauge('g', 'help', registry=self.registry).set(1)
+        Counter('c', 'help', registry=self.registry).inc()
+        chunks = list(generate_latest_chunks(self.registry))
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(b'# EOF\n', chunks[-1])
+        self.assertEqual(generate_latest(self.registry), b''.join(chunks))
+
     def test_native_histogram_version_comparison(self) -> None:
         hfm = HistogramMetricFamily("nh_version", "nh version test")
         hfm.add_sample("nh_version", {}, 0, None, None, NativeHistogram(5, 10, 0, 0.01, 2, (BucketSpan(0, 1),), (BucketSpan(0, 1),), (3,), (4,)))
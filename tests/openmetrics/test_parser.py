@@ -218,6 +218,18 @@ nativehistogram {count:24,sum:100,schema:0,zero_threshold:0.001,zero_count:4,pos
         hfm.add_sample("nativehistogram", None, None, None, None, NativeHistogram(24, 100, 0, 0.001, 4, (BucketSpan(0, 2), BucketSpan(1, 2)), (BucketSpan(0, 2), BucketSpan(1, 2)), (2, 1, -3, 3), (2, 1, -2, 3)))
         self.assertEqual([hfm], families)
 
+    def test_native_histogram_negative_offset_and_float_sum(self):
+        families = text_string_to_metric_families("""# TYPE nh histogram
+# HELP nh help
+nh {count:3,sum:0.75,schema:0,zero_threshold:2.938735877055719e-39,zero_count:0,negative_spans:[2:1],negative_deltas:[1],positive_spans:[-1:3],positive_deltas:[1,-1,1]}
+# EOF
+""")
+        families = list(families)
+
+        hfm = HistogramMetricFamily("nh", "help")
+        hfm.add_sample("nh", None, None, None, None, NativeHistogram(3, 0.75, 0, 2.938735877055719e-39, 0, (BucketSpan(-1, 3),), (BucketSpan(2, 1),), (1, -1, 1), (1,)))
+        self.assertEqual([hfm], families)
+
     def test_native_histogram_utf8(self):
         families = text_string_to_metric_families("""# TYPE "native{histogram" histogram
 # HELP "native{histogram" Is a basic example of a native histogram
@@ -0,0 +1,237 @@
+import struct
+import time
+from typing import Any
+import unittest
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Enum, Gauge, Histogram, Info, Summary,
+)
+from prometheus_client.core import (
+    BucketSpan, Exemplar, GaugeHistogramMetricFamily, HistogramMetricFamily,
+    NativeHistogram, Timestamp,
+)
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.openmetrics.exposition import ALLOWUTF8
+from prometheus_client.protobuf.exposition import (
+    _timestamp, CONTENT_TYPE_PROTOBUF, generate_latest,
+)
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return result, pos
+
+
+def decode(data):
+    """Decode a protobuf message into a dict of field number to values."""
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value = struct.unpack_from('<d', data, pos)[0]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError(f'Unexpected wire type {wire_type}')
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def decode_delimited(data):
+    messages = []
+    pos = 0
+    while pos < len(data):
+        length, pos = read_varint(data, pos)
+        messages.append(decode(data[pos:pos + length]))
+        pos += length
+    return messages
+
+
+def labels(metric):
+    return {decode(p)[1][0].decode(): decode(p)[2][0].decode() for p in metric.get(1, [])}
+
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+class TestGenerateProtobuf(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+
+        # Mock time so _created values are fixed.
+        self.old_time = time.time
+        time.time = lambda: 123.456
+
+    def tearDown(self):
+        time.time = self.old_time
+
+    def custom_collector(self, metric_family: Any) -> None:
+        class CustomCollector:
+            def collect(self):
+                return [metric_family]
+
+        self.registry.register(CustomCollector())
+
+    def families(self, **kwargs):
+        return decode_delimited(generate_latest(self.registry, **kwargs))
+
+    def test_counter(self):
+        c = Counter('cc', 'A counter', ['a'], registry=self.registry)
+        c.labels('x').inc(2, exemplar={'trace_id': 'abc'})
+        [family] = self.families()
+        self.assertEqual([b'cc_total'], family[1])
+        self.assertEqual([b'A counter'], family[2])
+        self.assertEqual([0], family[3])
+        [metric] = [decode(m) for m in family[4]]
+        self.assertEqual({'a': 'x'}, labels(metric))
+        counter = decode(metric[3][0])
+        self.assertEqual([2.0], counter[1])
+        exemplar = decode(counter[2][0])
+        self.assertEqual({'trace_id': 'abc'}, labels(exemplar))
+        self.assertEqual([2.0], exemplar[2])
+        self.assertEqual({1: [123], 2: [456000000]}, decode(exemplar[3][0]))
+        self.assertEqual({1: [123], 2: [456000000]}, decode(counter[3][0]))
+
+    def test_gauge(self):
+        g = Gauge('gg', 'A gauge', registry=self.registry)
+        g.set(-17)
+        [family] = self.families()
+        self.assertEqual([b'gg'], family[1])
+        self.assertEqual([1], family[3])
+        [metric] = [decode(m) for m in family[4]]
+        self.assertEqual({}, labels(metric))
+        self.assertEqual({1: [-17.0]}, decode(metric[2][0]))
+
+    def test_summary(self):
+        s = Summary('ss', 'A summary', ['a', 'b'], registry=self.registry)
+        s.labels('c', 'd').observe(17)
+        [family] = self.families()
+        self.assertEqual([2], family[3])
+        [metric] = [decode(m) for m in family[4]]
+        self.assertEqual({'a': 'c', 'b': 'd'}, labels(metric))
+        summary = decode(metric[4][0])
+        self.assertEqual([1], summary[1])
+        self.assertEqual([17.0], summary[2])
+        self.assertEqual({1: [123], 2: [456000000]}, decode(summary[4][0]))
+
+    def test_histogram(self):
+        h = Histogram('hh', 'A histogram', buckets=(1, 2, float('inf')), registry=self.registry)
+        h.observe(0.5)
+        h.observe(1.5, {'trace_id': 'abc'})
+        [family] = self.families()
+        self.assertEqual([4], family[3])
+        [metric] = [decode(m) for m in family[4]]
+        histogram = decode(metric[7][0])
+        self.assertEqual([2], histogram[1])
+        self.assertEqual([2.0], histogram[2])
+        buckets = [decode(b) for b in histogram[3]]
+        self.assertEqual([(1, 1.0), (2, 2.0), (2, float('inf'))], [(b[1][0], b[2][0]) for b in buckets])
+        self.assertEqual({'trace_id': 'abc'}, labels(decode(buckets[1][3][0])))
+        self.assertEqual({1: [123], 2: [456000000]}, decode(histogram[15][0]))
+
+    def test_native_histogram(self):
+        hfm = HistogramMetricFamily('nh', 'nh')
+        hfm.add_sample('nh', {'a': 'b'}, 0, None, None, NativeHistogram(
+            24, 100, 0, 0.001, 4, (BucketSpan(0, 2), BucketSpan(1, 2)), (BucketSpan(-2, 1),), (2, 1, -3, 3), (3,),
+            (Exemplar({'trace_id': 'abc'}, 1.5, Timestamp(1, 5)),)))
+        self.custom_collector(hfm)
+        [family] = self.families()
+        [metric] = [decode(m) for m in family[4]]
+        self.assertEqual({'a': 'b'}, labels(metric))
+        histogram = decode(metric[7][0])
+        self.assertEqual([24], histogram[1])
+        self.assertEqual([100.0], histogram[2])
+        self.assertEqual([0], [zigzag(v) for v in histogram[5]])
+        self.assertEqual([0.001], histogram[6])
+        self.assertEqual([4], histogram[7])
+        self.assertEqual([(-2, 1)], [(zigzag(decode(s)[1][0]), decode(s)[2][0]) for s in histogram[9]])
+        self.assertEqual([3], [zigzag(v) for v in histogram[10]])
+        self.assertEqual([(0, 2), (1, 2)], [(zigzag(decode(s)[1][0]), decode(s)[2][0]) for s in histogram[12]])
+        self.assertEqual([2, 1, -3, 3], [zigzag(v) for v in histogram[13]])
+        exemplar = decode(histogram[16][0])
+        self.assertEqual([1.5], exemplar[2])
+        self.assertEqual({1: [1], 2: [5]}, decode(exemplar[3][0]))
+
+    def test_gaugehistogram(self):
+        self.custom_collector(GaugeHistogramMetricFamily('gh', 'help', buckets=[('1.0', 4), ('+Inf', 5.5)], gsum_value=7))
+        [family] = self.families()
+        self.assertEqual([5], family[3])
+        histogram = decode(decode(family[4][0])[7][0])
+        # If a count is not an integer, all counts are sent as floats.
+        self.assertEqual([5.5], histogram[4])
+        self.assertEqual([7.0], histogram[2])
+        self.assertEqual([4.0, 5.5], [decode(b)[4][0] for b in histogram[3]])
+
+    def test_info_and_enum(self):
+        Info('ii', 'An info', registry=self.registry).info({'a': 'b'})
+        Enum('ee', 'An enum', states=['x', 'y'], registry=self.registry)
+        info, enum = self.families()
+        self.assertEqual([b'ii_info'], info[1])
+        self.assertEqual([1], info[3])
+        self.assertEqual({'a': 'b'}, labels(decode(info[4][0])))
+        self.assertEqual([b'ee'], enum[1])
+        self.assertEqual(
+            [({'ee': 'x'}, 1.0), ({'ee': 'y'}, 0.0)],
+            [(labels(decode(m)), decode(decode(m)[2][0])[1][0]) for m in enum[4]])
+
+    def test_labels_ordered(self):
+        e = Enum('ee', 'An enum', ['z'], states=['x', 'y'], registry=self.registry)
+        e.labels('a').state('y')
+        for _ in range(2):
+            [family] = self.families()
+            self.assertEqual(
+                [[b'ee', b'z']] * 2,
+                [[decode(p)[1][0] for p in decode(m)[1]] for m in family[4]])
+
+    def test_timestamp(self):
+        g = HistogramMetricFamily('ts', 'help', labels=['a'])
+        g.add_metric(['b'], buckets=[('+Inf', 1)], sum_value=1, timestamp=Timestamp(123, 456000000))
+        self.custom_collector(g)
+        [family] = self.families()
+        self.assertEqual([123456], decode(family[4][0])[6])
+        self.assertEqual({1: [2**64 - 2], 2: [500000000]}, decode(_timestamp(Timestamp(-1, 500000000))))
+        self.assertEqual({1: [2**64 - 2], 2: [500000000]}, decode(_timestamp(-1.5)))
+
+    def test_escaping(self):
+        c = Counter('my.counter', 'help', ['l.b'], registry=self.registry)
+        c.labels('v').inc()
+        [family] = self.families()
+        self.assertEqual([b'my_counter_total'], family[1])
+        self.assertEqual({'l_b': 'v'}, labels(decode(family[4][0])))
+        [family] = self.families(escaping=ALLOWUTF8)
+        self.assertEqual([b'my.counter_total'], family[1])
+        self.assertEqual({'l.b': 'v'}, labels(decode(family[4][0])))
+
+    def test_empty_family_skipped(self):
+        Counter('cc', 'A counter', ['a'], registry=self.registry)
+        self.assertEqual(b'', generate_latest(self.registry))
+
+    def test_choose_encoder(self):
+        Gauge('gg', 'A gauge', registry=self.registry).set(1)
+        encoder, content_type = choose_encoder(
+            'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,'
+            'text/plain;version=0.0.4;q=0.3')
+        self.assertEqual(CONTENT_TYPE_PROTOBUF + '; escaping=underscores', content_type)
+        self.assertEqual(generate_latest(self.registry), encoder(self.registry))
+        # Other encodings of the protobuf format are not supported.
+        _, content_type = choose_encoder(
+            'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=text')
+        self.assertNotIn('protobuf', content_type)
+
+
+if __name__ == '__main__':
+    unittest.main()
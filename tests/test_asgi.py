@@ -4,7 +4,9 @@ from unittest import TestCase
 
 from asgiref.testing import ApplicationCommunicator
 
-from prometheus_client import CollectorRegistry, Counter, make_asgi_app
+from prometheus_client import (
+    CollectorRegistry, Counter, generate_latest, make_asgi_app,
+)
 from prometheus_client.exposition import CONTENT_TYPE_PLAIN_0_0_4
 
 
@@ -172,6 +174,33 @@ class ASGITest(TestCase):
         outputs = self.get_all_output()
         self.assert_outputs(outputs, metric_name, help_text, increments, compressed=False)
 
+    def test_cache(self):
+        c = Counter('counter', 'A counter', registry=self.registry)
+        c.inc()
+        app = make_asgi_app(self.registry, cache_max_age=60)
+        for _ in range(2):
+            self.seed_app(app)
+            self.send_default_request()
+            outputs = self.get_all_output()
+            self.assert_outputs(outputs, 'counter', 'A counter', 1, compressed=False)
+            asyncio.new_event_loop().run_until_complete(
+                self.communicator.wait()
+            )
+            c.inc()
+
+    def test_streaming(self):
+        for i in range(2000):
+            Counter(f'c{i}', 'help ' * 20, registry=self.registry).inc()
+        expected = generate_latest(self.registry)
+        self.seed_app(make_asgi_app(self.registry))
+        self.send_default_request()
+        outputs = self.get_all_output()
+        bodies = [o for o in outputs if o['type'] == 'http.response.body']
+        self.assertGreater(len(bodies), 1)
+        self.assertEqual([True] * (len(bodies) - 1), [b['more_body'] for b in bodies[:-1]])
+        self.assertFalse(bodies[-1].get('more_body', False))
+        self.assertEqual(expected, b''.join(b['body'] for b in bodies))
+
     def test_openmetrics_encoding(self):
         """Response content type is application/openmetrics-text when appropriate Accept header is in request"""
         app = make_asgi_app(self.registry)
@@ -1,22 +1,34 @@
+from array import array
 from concurrent.futures import ThreadPoolExecutor
+import math
 import os
+import threading
 import time
+import tracemalloc
 import unittest
+from unittest import mock
 
 import pytest
 
 from prometheus_client import metrics
 from prometheus_client.core import (
-    CollectorRegistry, Counter, CounterMetricFamily, Enum, Gauge,
+    BucketSpan, CollectorRegistry, Counter, CounterMetricFamily, Enum, Gauge,
     GaugeHistogramMetricFamily, GaugeMetricFamily, Histogram,
-    HistogramMetricFamily, Info, InfoMetricFamily, Metric, Sample,
+    HistogramMetricFamily, Info, InfoMetricFamily, LabelSet, Metric, Sample,
     StateSetMetricFamily, Summary, SummaryMetricFamily, UntypedMetricFamily,
 )
 from prometheus_client.decorator import getargspec
-from prometheus_client.metrics import _get_use_created
+from prometheus_client.exposition import generate_latest
+from prometheus_client.metrics import (
+    _get_use_created, exponential_buckets, linear_buckets,
+)
+from prometheus_client.utils import floatToGoString
 from prometheus_client.validation import (
     disable_legacy_validation, enable_legacy_validation,
 )
+from prometheus_client.values import (
+    MutexHistogramValue, ShardedHistogramValue, ShardedValue,
+)
 
 
 def assert_not_observable(fn, *args, **kwargs):
@@ -395,6 +407,70 @@ class TestSummary(unittest.TestCase):
 
         assert_not_observable(manager)
 
+    def test_quantiles(self):
+        s = Summary('sq', 'help', registry=self.registry, quantiles=(0, 0.5, 0.9, 1))
+        self.assertTrue(math.isnan(self.registry.get_sample_value('sq', {'quantile': '0.5'})))
+        for i in range(1, 1001):
+            s.observe(i)
+        self.assertEqual(1000, self.registry.get_sample_value('sq_count'))
+        for q, expected in (('0.0', 1), ('0.5', 500), ('0.9', 900), ('1.0', 1000)):
+            value = self.registry.get_sample_value('sq', {'quantile': q})
+            self.assertAlmostEqual(expected, value, delta=expected * 0.01 + 1)
+
+    def test_quantiles_negative_and_zero(self):
+        s = Summary('sq', 'help', registry=self.registry, quantiles=(0, 0.5, 1))
+        for amount in (-10, -1, 0, 0, 0, 1, 10, float('nan')):
+            s.observe(amount)
+        self.assertAlmostEqual(-10, self.registry.get_sample_value('sq', {'quantile': '0.0'}), delta=0.1)
+        self.assertEqual(0, self.registry.get_sample_value('sq', {'quantile': '0.5'}))
+        self.assertAlmostEqual(10, self.registry.get_sample_value('sq', {'quantile': '1.0'}), delta=0.1)
+
+    def test_quantiles_sliding_window(self):
+        now = [1000.0]
+        with mock.patch('time.monotonic', lambda: now[0]):
+            s = Summary('sq', 'help', registry=self.registry, quantiles=(0.5,), max_age_seconds=10, age_buckets=5)
+            s.observe(1)
+            now[0] += 4
+            s.observe(100)
+            s.observe(100)
+            self.assertAlmostEqual(100, self.registry.get_sample_value('sq', {'quantile': '0.5'}), delta=1)
+            now[0] += 7
+            # The first observation has aged out of the window.
+            s.observe(1)
+            self.assertAlmostEqual(100, self.registry.get_sample_value('sq', {'quantile': '0.5'}), delta=1)
+            now[0] += 100
+            self.assertTrue(math.isnan(self.registry.get_sample_value('sq', {'quantile': '0.5'})))
+        self.assertEqual(4, self.registry.get_sample_value('sq_count'))
+
+    def test_quantiles_bounded_memory(self):
+        s = Summary('sq', 'help', registry=self.registry, quantiles=(0.5,))
+        for i in range(100000):
+            s.observe(i * 0.001)
+        sketch = s._quantile_value._sketches[s._quantile_value._head]
+        # Bins are logarithmic, so 1e-3 to 1e2 at 1% accuracy needs under 600.
+        self.assertLess(len(sketch.positive), 600)
+
+        s = Summary('sq2', 'help', registry=self.registry, quantiles=(0.5,))
+        s._quantile_value._max_bins = 10
+        for sketch in s._quantile_value._sketches:
+            sketch._max_bins = 10
+        for i in range(1, 1000):
+            s.observe(2 ** (i % 100))
+        sketch = s._quantile_value._sketches[s._quantile_value._head]
+        self.assertEqual(10, len(sketch.positive))
+        self.assertEqual(999, sum(sketch.positive.values()))
+
+    def test_quantiles_labels(self):
+        s = Summary('sq', 'help', ['l'], registry=self.registry, quantiles=(0.5,))
+        s.labels('a').observe(3)
+        self.assertAlmostEqual(3, self.registry.get_sample_value('sq', {'l': 'a', 'quantile': '0.5'}), delta=0.03)
+
+    def test_quantiles_invalid(self):
+        self.assertRaises(ValueError, Summary, 'sq', 'help', registry=None, quantiles=(1.5,))
+        self.assertRaises(ValueError, Summary, 'sq', 'help', registry=None, quantiles=(0.5,), max_age_seconds=0)
+        self.assertRaises(ValueError, Summary, 'sq', 'help', registry=None, quantiles=(0.5,), age_buckets=0)
+        self.assertRaises(ValueError, Summary, 'sq', 'help', registry=None, quantiles=(0.5,), quantile_relative_accuracy=1)
+
 
 class TestHistogram(unittest.TestCase):
     def setUp(self):
@@ -442,6 +518,53 @@ class TestHistogram(unittest.TestCase):
         """.observe() must fail if the Summary is not observable."""
         assert_not_observable(self.labels.observe, 1)
 
+    def test_compact_storage(self):
+        self.assertIsInstance(self.histogram._value, MutexHistogramValue)
+        self.histogram.observe(0.3)
+        self.histogram.observe(0.3, {'trace_id': 'abc'})
+        self.histogram.observe(float("nan"), {'trace_id': 'nan'})
+        buckets, sum_value = self.histogram._value.get()
+        self.assertEqual(len(self.histogram._upper_bounds), len(buckets))
+        self.assertEqual(2, sum(buckets))
+        self.assertTrue(math.isnan(sum_value))
+        exemplars = self.histogram._value.get_exemplars()
+        self.assertEqual('abc', exemplars[self.histogram._upper_bounds.index(0.5)].labels['trace_id'])
+        self.assertEqual(1, len([e for e in exemplars if e]))
+
+    def test_observe_many(self):
+        amounts = [0.001, 0.005, 0.3, 2, 2.5, 7, 100, float("inf"), float("nan")]
+        expected = Histogram('expected', 'help', registry=self.registry)
+        for amount in amounts:
+            expected.observe(amount)
+
+        self.histogram.observe_many(amounts)
+        self.histogram.observe_many(array('d', amounts))
+        self.histogram.observe_many(a for a in [])
+        for bound in expected._upper_bounds:
+            le = {'le': floatToGoString(bound)}
+            self.assertEqual(
+                2 * self.registry.get_sample_value('expected_bucket', le),
+                self.registry.get_sample_value('h_bucket', le))
+        self.assertEqual(16, self.registry.get_sample_value('h_count'))
+
+        h = Histogram('h2', 'help', registry=self.registry, buckets=[1, 2])
+        h.observe_many([0, 1, 1.5, 3])
+        self.assertEqual(2, self.registry.get_sample_value('h2_bucket', {'le': '1.0'}))
+        self.assertEqual(3, self.registry.get_sample_value('h2_bucket', {'le': '2.0'}))
+        self.assertEqual(4, self.registry.get_sample_value('h2_bucket', {'le': '+Inf'}))
+        self.assertEqual(5.5, self.registry.get_sample_value('h2_sum'))
+
+    def test_observe_many_numpy(self):
+        np = pytest.importorskip('numpy')
+        self.histogram.observe_many(np.array([[0.001, 0.3], [2.5, np.nan]]))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '0.005'}))
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '0.5'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_bucket', {'le': '2.5'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_count'))
+
+    def test_observe_many_not_observable(self):
+        assert_not_observable(self.labels.observe_many, [1])
+
     def test_setting_buckets(self):
         h = Histogram('h', 'help', registry=None, buckets=[0, 1, 2])
         self.assertEqual([0.0, 1.0, 2.0, float("inf")], h._upper_bounds)
@@ -453,6 +576,125 @@ class TestHistogram(unittest.TestCase):
         self.assertRaises(ValueError, Histogram, 'h', 'help', registry=None, buckets=[float("inf")])
         self.assertRaises(ValueError, Histogram, 'h', 'help', registry=None, buckets=[3, 1])
 
+    def test_observe_on_bucket_boundaries(self):
+        h = Histogram('hb', 'help', registry=self.registry, buckets=[1, 2, 3])
+        for amount in (-1, 1, 1.5, 2, 3, 3.5, float("nan")):
+            h.observe(amount)
+        self.assertEqual(2, self.registry.get_sample_value('hb_bucket', {'le': '1.0'}))
+        self.assertEqual(4, self.registry.get_sample_value('hb_bucket', {'le': '2.0'}))
+        self.assertEqual(5, self.registry.get_sample_value('hb_bucket', {'le': '3.0'}))
+        self.assertEqual(6, self.registry.get_sample_value('hb_bucket', {'le': '+Inf'}))
+
+    def test_native_histogram(self):
+        registry = CollectorRegistry()
+        h = Histogram('nh', 'help', registry=registry, buckets=(), native_histogram_schema=0)
+        for amount in (0, 0.6, 1, 2, 3, 4, -1.5, -2, float("nan")):
+            h.observe(amount)
+        native = list(registry.collect())[0].samples[0]
+        self.assertEqual('nh', native.name)
+        nh = native.native_histogram
+        # NaN is added to the sum, but not counted.
+        self.assertEqual(8, nh.count_value)
+        self.assertTrue(math.isnan(nh.sum_value))
+        self.assertEqual(0, nh.schema)
+        self.assertEqual(Histogram.DEFAULT_NATIVE_HISTOGRAM_ZERO_THRESHOLD, nh.zero_threshold)
+        self.assertEqual(1, nh.zero_count)
+        # Buckets (0.5, 1], (1, 2], (2, 4] hold 2, 1 and 2 observations.
+        self.assertEqual((BucketSpan(0, 3),), nh.pos_spans)
+        self.assertEqual((2, -1, 1), nh.pos_deltas)
+        # Both negative observations fall into (1, 2].
+        self.assertEqual((BucketSpan(1, 1),), nh.neg_spans)
+        self.assertEqual((2,), nh.neg_deltas)
+        # Only the +Inf classic bucket is kept, which does not count NaN either.
+        self.assertEqual(8, registry.get_sample_value('nh_bucket', {'le': '+Inf'}))
+        self.assertEqual(8, registry.get_sample_value('nh_count'))
+        self.assertEqual(None, registry.get_sample_value('nh_bucket', {'le': '1.0'}))
+
+    def test_native_histogram_nan(self):
+        h = Histogram('nh', 'help', registry=self.registry, native_histogram_schema=0)
+        h.observe(float("nan"))
+        h.observe_many([1, float("nan")])
+        nh = h._native.get()
+        self.assertEqual(1, nh.count_value)
+        self.assertTrue(math.isnan(nh.sum_value))
+        self.assertEqual(1, self.registry.get_sample_value('nh_count'))
+        self.assertTrue(math.isnan(self.registry.get_sample_value('nh_sum')))
+
+    def test_native_histogram_schemas(self):
+        h = Histogram('nh', 'help', registry=None, native_histogram_schema=3)
+        h.observe(1)
+        h.observe(1.1)
+        nh = h._native.get()
+        # 1.1 lies in (2 ** (1 / 8), 2 ** (2 / 8)].
+        self.assertEqual((BucketSpan(0, 3),), nh.pos_spans)
+        self.assertEqual((1, -1, 1), nh.pos_deltas)
+
+        h = Histogram('nh', 'help', registry=None, native_histogram_schema=-1)
+        for amount in (1, 3, 5, 17):
+            h.observe(amount)
+        nh = h._native.get()
+        # Buckets are (0.25, 1], (1, 4], (4, 16] and (16, 64].
+        self.assertEqual((BucketSpan(0, 4),), nh.pos_spans)
+        self.assertEqual((1, 0, 0, 0), nh.pos_deltas)
+
+    def test_native_histogram_sparse_spans(self):
+        h = Histogram('nh', 'help', registry=None, native_histogram_schema=0)
+        for amount in (1, 8, 1024):
+            h.observe(amount)
+        nh = h._native.get()
+        # The gap of two empty buckets is filled, the larger one starts a new span.
+        self.assertEqual((BucketSpan(0, 4), BucketSpan(6, 1)), nh.pos_spans)
+        self.assertEqual((1, -1, 0, 1, 0), nh.pos_deltas)
+
+    def test_native_histogram_schema_reduction(self):
+        h = Histogram('nh', 'help', registry=None, native_histogram_schema=2, native_histogram_max_buckets=4)
+        for amount in (1, 1.1, 1.2, 1.5, 1.7, 2):
+            h.observe(amount)
+        nh = h._native.get()
+        # Five buckets were populated at schema 2, pairs of them are merged.
+        self.assertEqual(1, nh.schema)
+        self.assertEqual((BucketSpan(0, 3),), nh.pos_spans)
+        self.assertEqual((1, 1, 1), nh.pos_deltas)
+
+    def test_native_histogram_observe_many_and_exemplar(self):
+        h = Histogram('nh', 'help', ['l'], registry=self.registry, native_histogram_schema=0)
+        h.labels('a').observe_many([1, 2, 3])
+        h.labels('a').observe(4, {'trace_id': 'abc'})
+        nh = h.labels('a')._native.get()
+        self.assertEqual(4, nh.count_value)
+        self.assertEqual((1, 0, 1), nh.pos_deltas)
+        self.assertEqual('abc', nh.nh_exemplars[0].labels['trace_id'])
+        self.assertEqual(4, self.registry.get_sample_value('nh_bucket', {'l': 'a', 'le': '5.0'}))
+
+    def test_native_histogram_invalid_settings(self):
+        self.assertRaises(ValueError, Histogram, 'nh', 'help', registry=None, native_histogram_schema=9)
+        self.assertRaises(ValueError, Histogram, 'nh', 'help', registry=None, native_histogram_schema=0,
+                          native_histogram_zero_threshold=-1)
+        self.assertRaises(ValueError, Histogram, 'nh', 'help', registry=None, native_histogram_schema=0,
+                          native_histogram_max_buckets=0)
+        self.assertRaises(ValueError, Histogram, 'h', 'help', registry=None, buckets=())
+
+    def test_linear_buckets(self):
+        self.assertEqual((0.1, 0.2, 0.3, 0.4), linear_buckets(0.1, 0.1, 4))
+        self.assertEqual((-1.0, 1.0, 3.0), linear_buckets(-1, 2, 3))
+        self.assertRaises(ValueError, linear_buckets, 0, 1, 0)
+        self.assertRaises(ValueError, linear_buckets, 0, 0, 3)
+        # Bounds must still differ once rounded.
+        self.assertRaises(ValueError, linear_buckets, 1, 1e-15, 3)
+
+        h = Histogram('hlin', 'help', registry=self.registry, buckets=linear_buckets(0.1, 0.1, 4))
+        self.assertEqual([0.1, 0.2, 0.3, 0.4, float("inf")], h._upper_bounds)
+        h.observe(0.3)
+        self.assertEqual(1, self.registry.get_sample_value('hlin_bucket', {'le': '0.3'}))
+
+    def test_exponential_buckets(self):
+        self.assertEqual((0.001, 0.002, 0.004, 0.008), exponential_buckets(0.001, 2, 4))
+        self.assertEqual((1.0, 1.1, 1.21, 1.331), exponential_buckets(1, 1.1, 4))
+        self.assertRaises(ValueError, exponential_buckets, 1, 2, 0)
+        self.assertRaises(ValueError, exponential_buckets, 0, 2, 3)
+        self.assertRaises(ValueError, exponential_buckets, 1, 1, 3)
+        self.assertRaises(ValueError, exponential_buckets, 1, 1 + 1e-15, 3)
+
     def test_labels(self):
         self.assertRaises(ValueError, Histogram, 'h', 'help', registry=None, labelnames=['le'])
 
@@ -558,6 +800,19 @@ class TestInfo(unittest.TestCase):
         self.labels.labels('a').info({'foo': 'bar'})
         self.assertEqual(1, self.registry.get_sample_value('il_info', {'l': 'a', 'foo': 'bar'}))
 
+    def test_labelsets(self):
+        self.info.info({'a': 'b'})
+        labels = list(self.registry.collect())[0].samples[0].labels
+        self.assertIsInstance(labels, LabelSet)
+        self.assertIs(labels._base, list(self.registry.collect())[0].samples[0].labels._base)
+
+        # Renderings of former values are dropped.
+        with mock.patch.object(LabelSet, '_MAX_RENDERED', 2):
+            for i in range(5):
+                self.info.info({'a': str(i)})
+                self.assertEqual(b'i_info{a="%d"} 1.0\n' % i, generate_latest(self.registry).splitlines(True)[2])
+                self.assertLessEqual(len(self.info._labelset._rendered), 2)
+
 
 class TestEnum(unittest.TestCase):
     def setUp(self):
@@ -590,6 +845,83 @@ class TestEnum(unittest.TestCase):
             Enum('e', 'help', registry=None, labelnames=['e'])
 
 
+class TestShardedValue(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+
+    def test_counter(self):
+        c = Counter('c_total', 'help', registry=self.registry, value_class=ShardedValue)
+        self.assertIsInstance(c._value, ShardedValue)
+        c.inc()
+        c.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+        c.reset()
+        self.assertEqual(0, self.registry.get_sample_value('c_total'))
+
+    def test_increments_from_many_threads(self):
+        c = Counter('c_total', 'help', registry=self.registry, value_class=ShardedValue)
+
+        def f():
+            for _ in range(1000):
+                c.inc()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            for _ in range(8):
+                pool.submit(f)
+        self.assertEqual(8000, self.registry.get_sample_value('c_total'))
+
+    def test_shards_of_exited_threads_are_folded(self):
+        c = Counter('c_total', 'help', registry=self.registry, value_class=ShardedValue)
+        h = Histogram('h', 'help', registry=self.registry, value_class=ShardedValue)
+
+        def f():
+            c.inc()
+            h.observe(2)
+
+        for _ in range(20):
+            t = threading.Thread(target=f)
+            t.start()
+            t.join()
+        self.assertEqual(0, len(c._value._shards))
+        self.assertEqual(0, len(h._value._shards))
+        self.assertEqual(20, self.registry.get_sample_value('c_total'))
+        self.assertEqual(20, self.registry.get_sample_value('h_count'))
+        self.assertEqual(40, self.registry.get_sample_value('h_sum'))
+
+        # The shard of a live thread is reset by set().
+        c.inc()
+        c._value.set(5)
+        c.inc()
+        self.assertEqual(6, self.registry.get_sample_value('c_total'))
+
+    def test_children_inherit_value_class(self):
+        h = Histogram('h', 'help', ['l'], registry=self.registry, value_class=ShardedValue)
+        child = h.labels('a')
+        self.assertIsInstance(child._value, ShardedHistogramValue)
+        child.observe(2)
+        self.assertEqual(1, self.registry.get_sample_value('h_count', {'l': 'a'}))
+        self.assertEqual(2, self.registry.get_sample_value('h_sum', {'l': 'a'}))
+
+    def test_gauge_set(self):
+        g = Gauge('g', 'help', registry=self.registry, value_class=ShardedValue)
+        g.inc(5)
+        g.set(2)
+        g.inc()
+        self.assertEqual(3, self.registry.get_sample_value('g'))
+
+    def test_multiprocess_takes_precedence(self):
+        class FakeMultiProcessValue(ShardedValue):
+            _multiprocess = True
+
+        original = metrics.values.ValueClass
+        metrics.values.ValueClass = FakeMultiProcessValue
+        try:
+            c = Counter('c_total', 'help', registry=self.registry, value_class=ShardedValue)
+        finally:
+            metrics.values.ValueClass = original
+        self.assertIsInstance(c._value, FakeMultiProcessValue)
+
+
 class TestMetricWrapper(unittest.TestCase):
     def setUp(self):
         self.registry = CollectorRegistry()
@@ -638,6 +970,40 @@ class TestMetricWrapper(unittest.TestCase):
         self.counter.remove(None)
         self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'None'}))
 
+    def test_labelsets(self):
+        self.two_labels.labels('x', 'y').inc()
+        samples = list(self.registry.collect())[-1].samples
+        self.assertEqual([LabelSet({'a': 'x', 'b': 'y'})] * 2, [s.labels for s in samples])
+        self.assertIsInstance(samples[0].labels, LabelSet)
+        # The samples of a child share its label sets between collections.
+        self.assertIs(samples[0].labels, samples[1].labels)
+        self.assertIs(samples[0].labels, list(self.registry.collect())[-1].samples[0].labels)
+
+        # Samples that add labels extend the label set of the child.
+        histogram = Histogram('h', 'help', labelnames=['l'], registry=self.registry)
+        histogram.labels('x').observe(1)
+        samples = list(self.registry.collect())[-1].samples
+        self.assertEqual({'l': 'x', 'le': '0.005'}, samples[0].labels)
+        self.assertEqual(['l', 'le'], list(samples[0].labels))
+        self.assertIs(samples[-1].labels, samples[0].labels._base)
+
+    def test_labels_kwargs(self):
+        self.two_labels.labels(b='y', a='x').inc()
+        self.assertIs(self.two_labels.labels('x', 'y'), self.two_labels.labels(a='x', b='y'))
+        self.assertEqual(1, self.registry.get_sample_value('two_total', {'a': 'x', 'b': 'y'}))
+        self.assertRaises(ValueError, self.two_labels.labels, a='x')
+        self.assertRaises(ValueError, self.two_labels.labels, a='x', c='y')
+        self.assertRaises(ValueError, self.two_labels.labels, a='x', b='y', c='z')
+        self.assertRaises(ValueError, self.two_labels.labels, 'x', b='y')
+
+    def test_bind(self):
+        child = self.two_labels.bind('x', 'y')
+        self.assertIs(child, self.two_labels.labels('x', 'y'))
+        self.assertIs(child, self.two_labels.bind(a='x', b='y'))
+        child.inc()
+        self.assertEqual(1, self.registry.get_sample_value('two_total', {'a': 'x', 'b': 'y'}))
+        self.assertRaises(ValueError, child.bind, 'z')
+
     def test_remove_by_labels(self):
         from prometheus_client import Counter
 
@@ -738,6 +1104,188 @@ class TestMetricWrapper(unittest.TestCase):
         self.assertEqual(c._name, 'b_total')
 
 
+class TestCardinalityLimit(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+
+    def test_overflow(self):
+        c = Counter('c', 'help', ['l'], registry=self.registry, max_children=2)
+        c.labels('a').inc()
+        c.labels('b').inc()
+        c.labels('c').inc()
+        c.labels('d').inc(2)
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'c'}))
+        self.assertEqual(3, self.registry.get_sample_value('c_total', {'l': '__overflow__'}))
+        self.assertEqual(2, self.registry.get_sample_value('c_dropped_labelsets_total'))
+        # The overflow child does not count towards the limit.
+        self.assertIs(c.labels('b'), c.labels(l='b'))
+
+    def test_dropped_labelsets_counted_once(self):
+        c = Counter('c', 'help', ['l'], registry=self.registry, max_children=1)
+        c.labels('a').inc()
+        overflow = c.labels('b')
+        with mock.patch.object(c, '_lock') as lock:
+            # Repeated labelsets do not take the lock.
+            for _ in range(3):
+                self.assertIs(overflow, c.labels('b'))
+            lock.__enter__.assert_not_called()
+        c.labels('c')
+        self.assertEqual(2, self.registry.get_sample_value('c_dropped_labelsets_total'))
+
+        # Removing a child makes room for a dropped labelset.
+        c.remove('a')
+        c.labels('b').inc(2)
+        self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'b'}))
+
+        g = Gauge('g', 'help', ['l'], registry=self.registry, max_children=1, cardinality_policy='reject')
+        g.labels('a')
+        for _ in range(3):
+            g.labels('b').set(1)
+        self.assertEqual(1, self.registry.get_sample_value('g_dropped_labelsets_total'))
+
+        c._MAX_DROPPED_CHILDREN = 2
+        for label in 'defg':
+            c.labels(label)
+        self.assertLessEqual(len(c._dropped_children), 2)
+
+    def test_reject(self):
+        g = Gauge('g', 'help', ['l'], registry=self.registry, max_children=1, cardinality_policy='reject')
+        g.labels('a').set(1)
+        g.labels('b').set(2)
+        g.labels('c').set(3)
+        self.assertEqual(1, self.registry.get_sample_value('g', {'l': 'a'}))
+        self.assertEqual(None, self.registry.get_sample_value('g', {'l': 'b'}))
+        self.assertEqual(None, self.registry.get_sample_value('g', {'l': 'c'}))
+        self.assertEqual(None, self.registry.get_sample_value('g', {'l': '__overflow__'}))
+        self.assertEqual(2, self.registry.get_sample_value('g_dropped_labelsets_total'))
+
+    def test_evict(self):
+        h = Histogram('h', 'help', ['l'], registry=self.registry, max_children=2, cardinality_policy='evict')
+        h.labels('a').observe(1)
+        h.labels('b').observe(1)
+        h.labels('a')
+        h.labels('c').observe(1)
+        self.assertEqual(1, self.registry.get_sample_value('h_count', {'l': 'a'}))
+        self.assertEqual(None, self.registry.get_sample_value('h_count', {'l': 'b'}))
+        self.assertEqual(1, self.registry.get_sample_value('h_count', {'l': 'c'}))
+        self.assertEqual(1, self.registry.get_sample_value('h_dropped_labelsets_total'))
+
+    def test_evict_skips_bound_children(self):
+        c = Counter('c', 'help', ['l'], registry=self.registry, max_children=1, cardinality_policy='evict')
+        bound = c.bind('a')
+        bound.inc()
+        c.labels('b').inc()
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'b'}))
+        c.remove('a')
+        c.labels('b').inc()
+        c.labels('c').inc()
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'b'}))
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'c'}))
+
+    def test_registry_default(self):
+        registry = CollectorRegistry(max_children=1, cardinality_policy='reject')
+        c = Counter('c', 'help', ['l'], registry=registry)
+        o = Counter('o', 'help', ['l'], registry=registry, cardinality_policy='overflow')
+        u = Counter('u', 'help', ['l'], registry=registry, max_children=3)
+        for label in 'abc':
+            c.labels(label).inc()
+            o.labels(label).inc()
+            u.labels(label).inc()
+        self.assertEqual(2, registry.get_sample_value('c_dropped_labelsets_total'))
+        self.assertEqual(2, registry.get_sample_value('o_total', {'l': '__overflow__'}))
+        self.assertEqual(0, registry.get_sample_value('u_dropped_labelsets_total'))
+
+    def test_no_limit(self):
+        c = Counter('c', 'help', ['l'], registry=self.registry)
+        for i in range(100):
+            c.labels(str(i))
+        self.assertEqual(['c'], [m.name for m in self.registry.collect()])
+
+    def test_dropped_labelsets_name_collision(self):
+        Counter('c', 'help', ['l'], registry=self.registry, max_children=1)
+        self.assertRaises(ValueError, Counter, 'c_dropped_labelsets', 'help', registry=self.registry)
+
+    def test_ttl(self):
+        now = [1000.0]
+        with mock.patch('time.monotonic', lambda: now[0]):
+            c = Counter('c', 'help', ['l'], registry=self.registry, ttl_seconds=60)
+            c.labels('a').inc()
+            c.labels('b').inc()
+            bound = c.bind('c')
+            bound.inc()
+            now[0] += 40
+            c.labels('a').inc()
+            now[0] += 40
+            self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'a'}))
+            self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'b'}))
+            self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'c'}))
+            now[0] += 100
+            c.remove_expired()
+            self.assertEqual([('c',)], list(c._metrics))
+
+    def test_ttl_concurrent_labels(self):
+        now = [1000.0]
+        with mock.patch('time.monotonic', lambda: now[0]):
+            c = Counter('c', 'help', ['l'], registry=None, ttl_seconds=60)
+            a = c.labels('a')
+            now[0] += 100
+
+            # labels() returned the child after remove_expired() read its
+            # access time, so it is kept.
+            class AccessedWhileExpiring:
+                checks = 0
+
+                def __lt__(self, other):
+                    self.checks += 1
+                    return self.checks == 1
+
+            a._last_access = AccessedWhileExpiring()
+            c.remove_expired()
+            self.assertIs(a, c._metrics[('a',)])
+            self.assertFalse(a._expiring)
+
+            # remove_expired() removed the child right after labels() found
+            # it, so the labelset is looked up again.
+            class RemovedAfterLookup(dict):
+                def get(self, key, default=None):
+                    child = super().get(key, default)
+                    if child is a:
+                        a._expiring = True
+                        del self[key]
+                    return child
+
+            c._metrics = RemovedAfterLookup(c._metrics)
+            child = c.labels('a')
+            self.assertIsNot(a, child)
+            self.assertIs(child, c._metrics[('a',)])
+
+    def test_ttl_without_collection(self):
+        now = [1000.0]
+        with mock.patch('time.monotonic', lambda: now[0]):
+            g = Gauge('g', 'help', ['l'], registry=None, ttl_seconds=1)
+            for i in range(10):
+                g.labels(str(i)).set(i)
+            now[0] += 0.5
+            g.labels('0')
+            now[0] += 0.6
+            g.remove_expired()
+        self.assertEqual([('0',)], list(g._metrics))
+        # Metrics without a TTL keep their children.
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('a')
+        c.remove_expired()
+        self.assertEqual([('a',)], list(c._metrics))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Counter, 'c', 'help', ['l'], registry=None, ttl_seconds=0)
+        self.assertRaises(ValueError, Counter, 'c', 'help', ['l'], registry=None, max_children=0)
+        self.assertRaises(ValueError, Counter, 'c', 'help', ['l'], registry=None, cardinality_policy='drop')
+        self.assertRaises(ValueError, CollectorRegistry, max_children=0)
+        self.assertRaises(ValueError, CollectorRegistry, cardinality_policy='drop')
+
+
 class TestMetricFamilies(unittest.TestCase):
     def setUp(self):
         self.registry = CollectorRegistry()
@@ -1064,6 +1612,46 @@ class TestCollectorRegistry(unittest.TestCase):
             self.assertFalse(registry._lock.locked())
 
 
+def test_benchmark_labels_existing_child(benchmark):
+    c = Counter('c', 'help', ['method', 'route', 'status'], registry=None)
+    c.labels('get', '/', 200)
+
+    @benchmark
+    def _():
+        for _ in range(1000):
+            c.labels('get', '/', 200)
+
+
+def test_benchmark_summary_quantiles_observe(benchmark):
+    s = Summary('sq', 'help', registry=None, quantiles=(0.5, 0.9, 0.99))
+    amounts = [i * 0.0001 for i in range(1000)]
+
+    @benchmark
+    def _():
+        for amount in amounts:
+            s.observe(amount)
+
+
+def test_benchmark_summary_quantiles_memory_per_child(benchmark):
+    s = Summary('sq', 'help', ['l'], registry=None, quantiles=(0.5, 0.9, 0.99))
+    children = iter(range(10 ** 9))
+
+    @benchmark
+    def _():
+        child = s.labels(str(next(children)))
+        for i in range(1000):
+            child.observe(i * 0.001)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    child = s.labels('measured')
+    for i in range(100000):
+        child.observe(i * 0.001)
+    benchmark.extra_info['bytes_per_child'] = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert benchmark.extra_info['bytes_per_child'] < 100000
+
+
 class LegacyValidationContextManager:
     def __enter__(self):
         enable_legacy_validation()
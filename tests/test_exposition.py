@@ -1,4 +1,5 @@
 import gzip
+import http.client
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import os
 import threading
@@ -13,12 +14,16 @@ from prometheus_client import (
     generate_latest, Histogram, Info, instance_ip_grouping_key, Metric,
     push_to_gateway, pushadd_to_gateway, Summary,
 )
-from prometheus_client.core import GaugeHistogramMetricFamily, Timestamp
+from prometheus_client.core import (
+    GaugeHistogramMetricFamily, LabelSet, Timestamp,
+)
 from prometheus_client.exposition import (
-    basic_auth_handler, choose_encoder, default_handler, MetricsHandler,
-    passthrough_redirect_handler, tls_auth_handler,
+    basic_auth_handler, choose_encoder, default_handler,
+    generate_latest_chunks, MetricsHandler, passthrough_redirect_handler,
+    tls_auth_handler,
 )
 import prometheus_client.openmetrics.exposition as openmetrics
+import prometheus_client.protobuf.exposition as protobuf
 
 
 class TestGenerateText(unittest.TestCase):
@@ -109,6 +114,19 @@ ss_sum{a="c",b="d"} 17.0
 # HELP ss_created A summary
 # TYPE ss_created gauge
 ss_created{a="c",b="d"} 123.456
+""", generate_latest(self.registry))
+
+    def test_native_histogram_skipped(self):
+        h = Histogram('nh', 'A histogram', registry=self.registry, buckets=(), native_histogram_schema=0)
+        h.observe(1)
+        self.assertEqual(b"""# HELP nh A histogram
+# TYPE nh histogram
+nh_bucket{le="+Inf"} 1.0
+nh_count 1.0
+nh_sum 1.0
+# HELP nh_created A histogram
+# TYPE nh_created gauge
+nh_created 123.456
 """, generate_latest(self.registry))
 
     def test_histogram(self):
@@ -219,6 +237,59 @@ ts{foo="f"} 0.0 123000
 """, generate_latest(self.registry))
 
 
+    def test_render_cache(self):
+        doc = ['help']
+
+        class MyCollector:
+            def collect(self):
+                metric = Metric("m", doc[0], 'gauge')
+                metric.add_sample("m", {"a": "1", "b": "2"}, 1)
+                metric.add_sample("m", {"b": "2", "a": "1"}, 2)
+                yield metric
+
+        self.registry.register(MyCollector())
+        expected = b'# HELP m help\n# TYPE m gauge\nm{a="1",b="2"} 1.0\nm{a="1",b="2"} 2.0\n'
+        self.assertEqual(expected, generate_latest(self.registry))
+        self.assertEqual(expected, generate_latest(self.registry))
+        doc[0] = 'other'
+        self.assertEqual(expected.replace(b'help', b'other'), generate_latest(self.registry))
+        self.assertEqual(
+            b'# HELP m other\n# TYPE m gauge\nm{a="1",b="2"} 1.0\nm{a="1",b="2"} 2.0\n# EOF\n',
+            openmetrics.generate_latest(self.registry))
+        labels = LabelSet({'b': '2', 'a': '1'})
+        self.assertEqual('a="1",b="2"', openmetrics._render_labels(labels, openmetrics.UNDERSCORES))
+
+        # Children keep the renderings of their samples.
+        g = Gauge('g', 'help', ['l'], registry=self.registry)
+        g.labels('x').set(1)
+        generate_latest(self.registry)
+        self.assertEqual(
+            {('text', 'g', (), openmetrics.UNDERSCORES): 'g{l="x"} '},
+            g.labels('x')._labelset._rendered)
+
+        # Labels that samples add are rendered in order too.
+        h = Histogram('h', 'help', ['z'], registry=self.registry, buckets=[1])
+        h.labels('x').observe(1)
+        self.assertIn(b'h_bucket{le="1.0",z="x"} 1.0\n', generate_latest(self.registry))
+        self.assertIn(b'h_bucket{le="1.0",z="x"} 1.0\n', openmetrics.generate_latest(self.registry))
+        cache = openmetrics._RenderCache()
+        cache.put('a', 'x')
+        cache.put('b', 'y')
+        cache.new_scrape()
+        self.assertEqual('y', cache.get('b'))
+        cache.new_scrape()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual('y', cache.get('b'))
+
+    def test_chunks(self):
+        Gauge('g', 'help', registry=self.registry).set(1)
+        Counter('c', 'help', registry=self.registry).inc()
+        chunks = list(generate_latest_chunks(self.registry))
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(b'# HELP g help\n# TYPE g gauge\ng 1.0\n', chunks[0])
+        self.assertEqual(generate_latest(self.registry), b''.join(chunks))
+
+
 class TestPushGateway(unittest.TestCase):
     def setUp(self):
         redirect_flag = 'testFlag'
@@ -443,12 +514,41 @@ class TestPushGateway(unittest.TestCase):
         handler = MetricsHandler.factory(self.registry)
         self.assertEqual(handler.registry, self.registry)
 
+    def test_metrics_handler_cache(self):
+        self.assertIsNone(MetricsHandler.factory(self.registry)._output_cache)
+        handler = MetricsHandler.factory(self.registry, cache_max_age=10)
+        self.assertIsNotNone(handler._output_cache)
+        self.assertIsNot(handler._output_cache, MetricsHandler.factory(self.registry, cache_max_age=10)._output_cache)
+
     def test_metrics_handler_subclassing(self):
         subclass = type('MetricsHandlerSubclass', (MetricsHandler, object), {})
         handler = subclass.factory(self.registry)
 
         self.assertTrue(issubclass(handler, (MetricsHandler, subclass)))
 
+    def test_metrics_handler_streams_chunks(self):
+        for i in range(2000):
+            Gauge(f'g{i}', 'help ' * 20, registry=self.registry).set(i)
+        handler = type('ChunkedMetricsHandler', (MetricsHandler.factory(self.registry),), {'protocol_version': 'HTTP/1.1'})
+        for handler_class in MetricsHandler.factory(self.registry), handler:
+            httpd = HTTPServer(('localhost', 0), handler_class)
+            thread = threading.Thread(target=httpd.handle_request)
+            thread.start()
+            try:
+                conn = http.client.HTTPConnection('localhost', httpd.server_port)
+                conn.request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+                self.assertEqual(200, response.status)
+                self.assertEqual('gzip', response.getheader('Content-Encoding'))
+                self.assertEqual(
+                    'chunked' if handler_class is handler else None,
+                    response.getheader('Transfer-Encoding'))
+                self.assertEqual(generate_latest(self.registry), gzip.decompress(response.read()))
+                conn.close()
+            finally:
+                thread.join()
+                httpd.server_close()
+
 
 @pytest.fixture
 def registry():
@@ -775,5 +875,17 @@ def test_escape_label_name(scenario):
     assert got == scenario["expectedValue"], f"[{scenario['name']}] Value encoding failed"
 
 
+@pytest.mark.parametrize('encoder', [generate_latest, openmetrics.generate_latest, protobuf.generate_latest],
+                         ids=['text', 'openmetrics', 'protobuf'])
+def test_benchmark_generate_latest(benchmark, encoder):
+    registry = CollectorRegistry()
+    for i in range(100):
+        c = Counter(f'c{i}', 'help', ['method', 'path'], registry=registry)
+        for j in range(100):
+            c.labels('GET', f'/path/{j}').inc(j)
+    output = benchmark(encoder, registry)
+    assert len(output) > 100000
+
+
 if __name__ == '__main__':
     unittest.main()
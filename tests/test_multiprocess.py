@@ -1,16 +1,25 @@
 import glob
+import itertools
+import json
+import mmap
 import os
 import shutil
+import struct
 import tempfile
+from threading import Thread
 import unittest
+from unittest import mock
 import warnings
 
-from prometheus_client import mmap_dict, values
+import pytest
+
+from prometheus_client import mmap_dict, multiprocess, values
 from prometheus_client.core import (
-    CollectorRegistry, Counter, Gauge, Histogram, Sample, Summary,
+    CollectorRegistry, Counter, Enum, Exemplar, Gauge, Histogram, Info, Sample,
+    Summary,
 )
 from prometheus_client.multiprocess import (
-    mark_process_dead, MultiProcessCollector,
+    compact_process_files, mark_process_dead, MultiProcessCollector,
 )
 from prometheus_client.values import (
     get_value_class, MultiProcessValue, MutexValue,
@@ -205,6 +214,51 @@ class TestMultiProcess(unittest.TestCase):
         mark_process_dead(123, os.environ['PROMETHEUS_MULTIPROC_DIR'])
         self.assertEqual(2, self.registry.get_sample_value('g'))
 
+    def test_info(self):
+        i1 = Info('i', 'help', labelnames=['l'], registry=None)
+        i1.labels('a').info({'version': '1'})
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        i2 = Info('i', 'help', labelnames=['l'], registry=None).labels('a')
+        i2.info({'version': '2'})
+        self.assertEqual(1, self.registry.get_sample_value('i_info', {'l': 'a', 'version': '1'}))
+        self.assertEqual(1, self.registry.get_sample_value('i_info', {'l': 'a', 'version': '2'}))
+        i2.info({'version': '3'})
+        self.assertEqual(None, self.registry.get_sample_value('i_info', {'l': 'a', 'version': '2'}))
+        self.assertEqual(1, self.registry.get_sample_value('i_info', {'l': 'a', 'version': '3'}))
+        mark_process_dead(123, os.environ['PROMETHEUS_MULTIPROC_DIR'])
+        self.assertEqual(None, self.registry.get_sample_value('i_info', {'l': 'a', 'version': '1'}))
+        self.assertEqual(1, self.registry.get_sample_value('i_info', {'l': 'a', 'version': '3'}))
+
+    def test_info_new_label_names(self):
+        i = Info('build', 'help', registry=None)
+        i.info({'ver': '1'})
+        i.info({'rev': '2'})
+        self.assertEqual(None, self.registry.get_sample_value('build_info', {'ver': '1'}))
+        self.assertEqual(1, self.registry.get_sample_value('build_info', {'rev': '2'}))
+        i.info({'ver': '3'})
+        self.assertEqual(None, self.registry.get_sample_value('build_info', {'rev': '2'}))
+        self.assertEqual(1, self.registry.get_sample_value('build_info', {'ver': '3'}))
+        mmap_dict.MmapedDict(os.path.join(self.tempdir, 'info_123.db')).close()
+
+    def test_enum(self):
+        with mock.patch('time.time', return_value=1):
+            e1 = Enum('e', 'help', states=['a', 'b', 'c'], registry=None)
+            values.ValueClass = MultiProcessValue(lambda: 456)
+            e2 = Enum('e', 'help', states=['a', 'b', 'c'], registry=None)
+            e1.state('b')
+        self.assertEqual(0, self.registry.get_sample_value('e', {'e': 'a'}))
+        self.assertEqual(1, self.registry.get_sample_value('e', {'e': 'b'}))
+        self.assertEqual(0, self.registry.get_sample_value('e', {'e': 'c'}))
+        with mock.patch('time.time', return_value=2):
+            e2.state('c')
+        self.assertEqual(0, self.registry.get_sample_value('e', {'e': 'b'}))
+        self.assertEqual(1, self.registry.get_sample_value('e', {'e': 'c'}))
+        mark_process_dead(456, os.environ['PROMETHEUS_MULTIPROC_DIR'])
+        self.assertEqual(1, self.registry.get_sample_value('e', {'e': 'b'}))
+        self.assertEqual(0, self.registry.get_sample_value('e', {'e': 'c'}))
+        mark_process_dead(123, os.environ['PROMETHEUS_MULTIPROC_DIR'])
+        self.assertEqual(None, self.registry.get_sample_value('e', {'e': 'b'}))
+
     def test_namespace_subsystem(self):
         c1 = Counter('c', 'help', registry=None, namespace='ns', subsystem='ss')
         c1.inc(1)
@@ -222,6 +276,14 @@ class TestMultiProcess(unittest.TestCase):
         self.assertEqual(3, self.registry.get_sample_value('c_total'))
         self.assertEqual(1, c1._value.get())
 
+    def test_expected_series(self):
+        with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_EXPECTED_SERIES': '1000'}):
+            values.ValueClass = get_value_class()
+        Counter('c', 'help', registry=None).inc()
+        self.assertEqual(
+            mmap_dict._initial_mmap_size(expected_series=1000),
+            os.path.getsize(glob.glob(os.path.join(self.tempdir, 'counter_*.db'))[0]))
+
     def test_initialization_detects_pid_change(self):
         pid = 0
         values.ValueClass = MultiProcessValue(lambda: pid)
@@ -454,6 +516,198 @@ class TestMultiProcess(unittest.TestCase):
 
         self.assertEqual(metrics['h'].samples, expected_histogram)
 
+    def test_collect_reads_changed_values(self):
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        c.labels('a').inc()
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        # Values are updated in place, without changing the file's metadata.
+        c.labels('a').inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c_total', {'l': 'a'}))
+
+    def test_collect_mapped_files(self):
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        with mock.patch.object(mmap_dict, '_MAP_THRESHOLD', 0):
+            c.labels('a').inc()
+            self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+            c.labels('b').inc(2)
+            self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'b'}))
+
+    def test_collect_only_parses_new_keys(self):
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        c.labels('a').inc()
+        self.registry.get_sample_value('c_total', {'l': 'a'})
+        with mock.patch('prometheus_client.multiprocess._read_all_values',
+                        wraps=mmap_dict._read_all_values) as read:
+            c.labels('a').inc()
+            self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'a'}))
+            self.assertEqual(0, read.call_count)
+            c.labels('b').inc()
+            self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'b'}))
+            self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'a'}))
+            # The cache is shared by collectors of the same directory.
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry, self.tempdir)
+            self.assertEqual(1, registry.get_sample_value('c_total', {'l': 'b'}))
+        # Only the entries added for 'b' were parsed.
+        self.assertEqual(1, read.call_count)
+
+    def test_collect_replaced_file(self):
+        path = os.path.join(self.tempdir, 'counter_999.db')
+        d = mmap_dict.MmapedDict(path)
+        d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['a'], 'help'), 1, 0)
+        d.close()
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        os.remove(path)
+        d = mmap_dict.MmapedDict(path)
+        d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['b'], 'help'), 2, 0)
+        d.close()
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'b'}))
+        os.remove(path)
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'b'}))
+        self.assertEqual({}, self.collector._file_cache._files)
+
+    def test_collect_workers(self):
+        for pid in range(8):
+            values.ValueClass = MultiProcessValue(lambda: pid)
+            Counter('c', 'help', labelnames=['l'], registry=None).labels('a').inc(pid)
+            Histogram('h', 'help', registry=None).observe(pid)
+            Gauge('g', 'help', registry=None, multiprocess_mode='livesum').set(pid)
+        expected = sorted(self.registry.collect(), key=lambda m: m.name)
+        # The file of a dead process is skipped.
+        mark_process_dead(7)
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, self.tempdir, workers=4)
+        metrics = sorted(registry.collect(), key=lambda m: m.name)
+        self.assertEqual(
+            [self._sorted_samples(m) for m in expected if m.name != 'g'],
+            [self._sorted_samples(m) for m in metrics if m.name != 'g'])
+        self.assertEqual(21, registry.get_sample_value('g'))
+
+    @staticmethod
+    def _sorted_samples(metric):
+        return sorted(metric.samples, key=lambda s: (s.name, sorted(s.labels.items())))
+
+    def test_collect_workers_invalid(self):
+        with self.assertRaises(ValueError):
+            MultiProcessCollector(None, self.tempdir, workers=0)
+
+    def files(self):
+        return sorted(os.path.basename(f) for f in glob.glob(os.path.join(self.tempdir, '*.db')))
+
+    def collected(self):
+        return sorted(
+            (s.name, sorted(s.labels.items()), s.value)
+            for m in self.registry.collect() for s in m.samples
+        )
+
+    def test_compact_process_files(self):
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        h = Histogram('h', 'help', registry=None, buckets=(1, 5))
+        s = Summary('s', 'help', registry=None)
+        c.labels('a').inc(1)
+        h.observe(1)
+        s.observe(1)
+        for pid, amount in ((456, 2), (789, 4)):
+            values.ValueClass = MultiProcessValue(lambda: pid)
+            Counter('c', 'help', labelnames=['l'], registry=None).labels('a').inc(amount)
+            Counter('c', 'help', labelnames=['l'], registry=None).labels(str(pid)).inc(amount)
+            Histogram('h', 'help', registry=None, buckets=(1, 5)).observe(amount)
+            Summary('s', 'help', registry=None).observe(amount)
+        expected = self.collected()
+
+        compact_process_files([456])
+        self.assertEqual(expected, self.collected())
+        compact_process_files([789, 1000])
+        self.assertEqual(expected, self.collected())
+        self.assertEqual([
+            'counter_123.db', 'counter_archive.db',
+            'histogram_123.db', 'histogram_archive.db',
+            'summary_123.db', 'summary_archive.db',
+        ], self.files())
+        self.assertEqual(7, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(4, self.registry.get_sample_value('c_total', {'l': '789'}))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_bucket', {'le': '5.0'}))
+        self.assertEqual(7, self.registry.get_sample_value('s_sum'))
+
+    def test_compaction_leaves_no_lock_file(self):
+        Counter('c', 'help', registry=None).inc()
+        self.collected()
+        compact_process_files([123])
+        self.collected()
+        self.assertEqual(['counter_archive.db'], sorted(os.listdir(self.tempdir)))
+
+    def test_compaction_requires_fcntl(self):
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        Counter('c', 'help', registry=None).inc()
+        Gauge('g', 'help', registry=None, multiprocess_mode='liveall').set(1)
+        with mock.patch.object(multiprocess, 'fcntl', None):
+            self.assertRaises(RuntimeError, compact_process_files, [456])
+            self.assertRaises(RuntimeError, mark_process_dead, 456, compact=True)
+            self.assertEqual(1, self.registry.get_sample_value('c_total'))
+        self.assertEqual(['counter_456.db', 'gauge_liveall_456.db'], self.files())
+
+    def exemplar(self, name, labels):
+        for metric in self.registry.collect():
+            for sample in metric.samples:
+                if sample.name == name and sample.labels == labels:
+                    return sample.exemplar
+
+    def test_exemplars(self):
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        h = Histogram('h', 'help', labelnames=['a', 'z'], registry=None, buckets=(1, 5))
+        with mock.patch('time.time', lambda: 1.0):
+            c.labels('x').inc(exemplar={'trace_id': 'a'})
+            h.labels('1', '2').observe(2, exemplar={'trace_id': 'a'})
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        c2 = Counter('c', 'help', labelnames=['l'], registry=None)
+        h2 = Histogram('h', 'help', labelnames=['a', 'z'], registry=None, buckets=(1, 5))
+        with mock.patch('time.time', lambda: 2.0):
+            c2.labels('x').inc(exemplar={'trace_id': 'b'})
+            h2.labels('1', '2').observe(3, exemplar={'trace_id': 'b'})
+            h2.labels('1', '2').observe(0.5)
+        self.assertEqual(Exemplar({'trace_id': 'b'}, 1, 2.0), self.exemplar('c_total', {'l': 'x'}))
+        self.assertEqual(Exemplar({'trace_id': 'b'}, 3, 2.0), self.exemplar('h_bucket', {'a': '1', 'z': '2', 'le': '5.0'}))
+        self.assertIsNone(self.exemplar('h_bucket', {'a': '1', 'z': '2', 'le': '1.0'}))
+
+        with mock.patch('time.time', lambda: 3.0):
+            c.labels('x').inc(exemplar={'trace_id': 'c'})
+        self.assertEqual(Exemplar({'trace_id': 'c'}, 1, 3.0), self.exemplar('c_total', {'l': 'x'}))
+        self.assertEqual(Exemplar({'trace_id': 'c'}, 1, 3.0), c.labels('x')._value.get_exemplar())
+
+        compact_process_files([123, 456])
+        self.assertEqual(Exemplar({'trace_id': 'c'}, 1, 3.0), self.exemplar('c_total', {'l': 'x'}))
+        self.assertEqual(Exemplar({'trace_id': 'b'}, 3, 2.0), self.exemplar('h_bucket', {'a': '1', 'z': '2', 'le': '5.0'}))
+
+    def test_compact_process_files_gauges(self):
+        now = [100.0]
+        modes = ('all', 'liveall', 'sum', 'min', 'max', 'mostrecent')
+        with mock.patch('time.time', lambda: now[0]):
+            for pid, value in ((123, 5), (456, 3), (789, 8)):
+                values.ValueClass = MultiProcessValue(lambda: pid)
+                for mode in modes:
+                    Gauge('g_' + mode, 'help', registry=None, multiprocess_mode=mode).set(value)
+                now[0] += 1
+        self.assertEqual(3, self.registry.get_sample_value('g_all', {'pid': '456'}))
+
+        mark_process_dead(456, compact=True)
+        compact_process_files([789])
+        self.assertEqual(3, self.registry.get_sample_value('g_all', {'pid': '456'}))
+        self.assertEqual(None, self.registry.get_sample_value('g_liveall', {'pid': '456'}))
+        self.assertEqual(16, self.registry.get_sample_value('g_sum'))
+        self.assertEqual(3, self.registry.get_sample_value('g_min'))
+        self.assertEqual(8, self.registry.get_sample_value('g_max'))
+        self.assertEqual(8, self.registry.get_sample_value('g_mostrecent'))
+        self.assertEqual([
+            'gauge_all_123.db', 'gauge_all_456.db', 'gauge_all_789.db',
+            'gauge_liveall_123.db', 'gauge_liveall_789.db',
+            'gauge_max_123.db', 'gauge_max_archive.db',
+            'gauge_min_123.db', 'gauge_min_archive.db',
+            'gauge_mostrecent_123.db', 'gauge_mostrecent_archive.db',
+            'gauge_sum_123.db', 'gauge_sum_archive.db',
+        ], self.files())
+
     def test_missing_gauge_file_during_merge(self):
         # These files don't exist, just like if mark_process_dead(9999999) had been
         # called during self.collector.collect(), after the glob found it
@@ -462,24 +716,119 @@ class TestMultiProcess(unittest.TestCase):
         self.assertFalse(self.collector.merge([
             os.path.join(self.tempdir, 'gauge_liveall_9999999.db'),
             os.path.join(self.tempdir, 'gauge_livesum_9999999.db'),
+            os.path.join(self.tempdir, 'info_9999999.db'),
+            os.path.join(self.tempdir, 'stateset_9999999.db'),
         ]))
 
-    def test_remove_clear_warning(self):
-        os.environ['PROMETHEUS_MULTIPROC_DIR'] = self.tempdir
-        with warnings.catch_warnings(record=True) as w:
-            values.ValueClass = get_value_class()
-            registry = CollectorRegistry()
-            collector = MultiProcessCollector(registry)
-            counter = Counter('c', 'help', labelnames=['label'], registry=None)
-            counter.labels('label').inc()
-            counter.remove('label')
-            counter.clear()
-            assert os.environ['PROMETHEUS_MULTIPROC_DIR'] == self.tempdir
-            assert issubclass(w[0].category, UserWarning)
-            assert "Removal of labels has not been implemented" in str(w[0].message)
-            assert issubclass(w[-1].category, UserWarning)
-            assert "Clearing labels has not been implemented" in str(w[-1].message)
-    
+    def test_cardinality_reject(self):
+        c = Counter('c', 'help', ['l'], registry=None, max_children=1, cardinality_policy='reject')
+        c.labels('a').inc()
+        c.labels('b').inc()
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'b'}))
+
+    def test_dropped_labelsets(self):
+        c1 = Counter('c', 'help', ['l'], registry=None, max_children=1)
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        c2 = Counter('c', 'help', ['l'], registry=None, max_children=1)
+        self.assertEqual(0, self.registry.get_sample_value('c_dropped_labelsets_total'))
+        c1.labels('a').inc()
+        c1.labels('b').inc()
+        c2.labels('a').inc()
+        c2.labels('b').inc()
+        c2.labels('c').inc()
+        self.assertEqual(3, self.registry.get_sample_value('c_dropped_labelsets_total'))
+        self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'a'}))
+
+    def test_remove(self):
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        child = c.bind('a')
+        child.inc(exemplar={'trace_id': 'a'})
+        c.labels('b').inc(2)
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        used = os.path.getsize(os.path.join(self.tempdir, 'counter_123.db'))
+        c.remove('a')
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(2, self.registry.get_sample_value('c_total', {'l': 'b'}))
+        # A removed child is no longer written to the file.
+        child.inc()
+        self.assertEqual(None, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        # The space of the removed series is reused by one of the same size,
+        # and that of its exemplar by the next exemplar.
+        d = mmap_dict.MmapedDict(os.path.join(self.tempdir, 'counter_123.db'), read_mode=True)
+        before = d._used
+        d.close()
+        c.labels('c').inc(3)
+        c.labels('a').inc(exemplar={'trace_id': 'b'})
+        d = mmap_dict.MmapedDict(os.path.join(self.tempdir, 'counter_123.db'), read_mode=True)
+        self.assertEqual(before + 56, d._used)
+        d.close()
+        self.assertEqual(used, os.path.getsize(os.path.join(self.tempdir, 'counter_123.db')))
+        self.assertEqual(3, self.registry.get_sample_value('c_total', {'l': 'c'}))
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual({'trace_id': 'b'}, self.exemplar('c_total', {'l': 'a'}).labels)
+
+    def test_remove_then_new_strings(self):
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        path = os.path.join(self.tempdir, 'counter_456.db')
+        c = Counter('c', 'help', labelnames=['a'], registry=None)
+        c.labels('x').inc()
+        c.remove('x')
+        # This series is as large as the removed one, but its new strings come
+        # after the free record, so it can not be reused.
+        Counter('d', 'other', labelnames=['b'], registry=None).labels('y').inc(2)
+        self.assertEqual(2, self.registry.get_sample_value('d_total', {'b': 'y'}))
+        d = mmap_dict.MmapedDict(path)
+        used = d._used
+        d.close()
+        # Series whose strings come before the free record still reuse it.
+        c.labels('z').inc(3)
+        d = mmap_dict.MmapedDict(path)
+        self.assertEqual(used, d._used)
+        d.close()
+        self.assertEqual(3, self.registry.get_sample_value('c_total', {'a': 'z'}))
+        compact_process_files([456])
+        self.assertEqual(2, self.registry.get_sample_value('d_total', {'b': 'y'}))
+        self.assertEqual(3, self.registry.get_sample_value('c_total', {'a': 'z'}))
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'Requires os.fork')
+    def test_fork(self):
+        values.ValueClass = MultiProcessValue()
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        c.labels('a').inc()
+        child = os.fork()
+        if child == 0:
+            # The child writes its own files, starting from zero.
+            try:
+                c.labels('a').inc(2)
+                c.labels('b').inc(3)
+            finally:
+                os._exit(0)
+        os.waitpid(child, 0)
+        c.labels('a').inc()
+        self.assertEqual(4, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(3, self.registry.get_sample_value('c_total', {'l': 'b'}))
+        self.assertEqual(sorted([f'counter_{child}.db', f'counter_{os.getpid()}.db']), self.files())
+
+    def test_remove_by_labels_and_clear(self):
+        h = Histogram('h', 'help', labelnames=['l', 'm'], registry=None, buckets=(1, 5))
+        g = Gauge('g', 'help', labelnames=['l'], registry=None, multiprocess_mode='sum')
+        h.labels('a', 'x').observe(1)
+        h.labels('b', 'x').observe(1)
+        g.labels('a').set(1)
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        Gauge('g', 'help', labelnames=['l'], registry=None, multiprocess_mode='sum').labels('a').set(2)
+        self.assertEqual(3, self.registry.get_sample_value('g', {'l': 'a'}))
+        h.remove_by_labels({'l': 'a'})
+        self.assertEqual(None, self.registry.get_sample_value('h_count', {'l': 'a', 'm': 'x'}))
+        self.assertEqual(None, self.registry.get_sample_value('h_bucket', {'l': 'a', 'm': 'x', 'le': '1.0'}))
+        self.assertEqual(1, self.registry.get_sample_value('h_count', {'l': 'b', 'm': 'x'}))
+        h.clear()
+        g.clear()
+        self.assertEqual(None, self.registry.get_sample_value('h_count', {'l': 'b', 'm': 'x'}))
+        # Only the values of this process are removed.
+        self.assertEqual(2, self.registry.get_sample_value('g', {'l': 'a'}))
+
     def test_child_name_is_built_once_with_namespace_subsystem_unit(self):
         """
         Repro for #1035:
@@ -618,6 +967,44 @@ class TestMmapedDict(unittest.TestCase):
             [('abc', 42.0, 987.0), (key, 123.0, 876.0), ('def', 17.0, 765.0)],
             list(self.d.read_all_values()))
 
+    def test_initial_size_and_growth_factor(self):
+        self.d.close()
+        os.remove(self.tempfile)
+        self.d = mmap_dict.MmapedDict(self.tempfile, initial_size=1 << 14, growth_factor=1.5)
+        self.assertEqual(1 << 14, os.path.getsize(self.tempfile))
+        self.d.write_value('a' * (1 << 14), 123.0, 987.0)
+        size = os.path.getsize(self.tempfile)
+        self.assertEqual(mmap_dict._round_to_pages(int((1 << 14) * 1.5)), size)
+        self.assertEqual(size, len(self.d._m))
+        self.assertEqual([('a' * (1 << 14), 123.0, 987.0)], list(self.d.read_all_values()))
+        self.assertRaises(ValueError, mmap_dict.MmapedDict, self.tempfile, growth_factor=1)
+        self.assertRaises(ValueError, mmap_dict.MmapedDict, self.tempfile + '2', initial_size=4)
+
+    def test_expansion_without_resize(self):
+        class NoResizeMmap(mmap.mmap):
+            def resize(self, newsize):
+                raise SystemError('mmap: resizing not available--no mremap()')
+
+        self.d._m.close()
+        self.d._m = m = NoResizeMmap(self.d._f.fileno(), self.d._capacity)
+        self.d.write_value('a' * mmap_dict._INITIAL_MMAP_SIZE, 123.0, 987.0)
+        self.assertEqual([('a' * mmap_dict._INITIAL_MMAP_SIZE, 123.0, 987.0)], list(self.d.read_all_values()))
+        self.assertIsNot(m, self.d._m)
+        # Values can still be written through the superseded map.
+        self.assertEqual([m], self.d._superseded)
+        self.assertFalse(m.closed)
+        self.d.close()
+        self.assertTrue(m.closed)
+
+    def test_expected_series(self):
+        self.assertEqual(
+            mmap_dict._round_to_pages(8 + 1000 * mmap_dict._SERIES_SIZE_ESTIMATE),
+            mmap_dict._initial_mmap_size(expected_series=1000))
+        self.assertEqual(mmap_dict._INITIAL_MMAP_SIZE, mmap_dict._initial_mmap_size(expected_series=10))
+        self.assertRaises(ValueError, mmap_dict._initial_mmap_size, expected_series=-1)
+        self.assertRaises(ValueError, MultiProcessValue, expected_series=-1)
+        self.assertRaises(ValueError, MultiProcessValue, growth_factor=1)
+
     def test_corruption_detected(self):
         self.d.write_value('abc', 42.0, 987.0)
         # corrupt the written data
@@ -625,6 +1012,128 @@ class TestMmapedDict(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             list(self.d.read_all_values())
 
+    def test_series_keys(self):
+        a = mmap_dict.mmap_key('h', 'h_bucket', ['l', 'le'], ['a', '1.0'], 'help')
+        b = mmap_dict.mmap_key('h', 'h_bucket', ['l', 'le'], ['a', '+Inf'], 'help')
+        self.assertEqual(('h', 'h_bucket', (('l', 'a'), ('le', '1.0')), 'help'), a)
+        self.d.write_value(a, 1.0, 0.0)
+        used = self.d._used
+        self.d.write_value(b, 2.0, 0.0)
+        # Names and help text are stored once, so b only takes a series record.
+        self.assertEqual(64, self.d._used - used)
+        self.d.close()
+        self.d = mmap_dict.MmapedDict(self.tempfile)
+        self.d.write_value(b, 3.0, 0.0)
+        self.d.write_value(mmap_dict.mmap_key('h', 'h_sum', ['l'], ['ü'], 'help'), 4.0, 0.0)
+        self.assertEqual(
+            [(a, 1.0, 0.0), (b, 3.0, 0.0), (('h', 'h_sum', (('l', 'ü'),), 'help'), 4.0, 0.0)],
+            list(self.d.read_all_values()))
+
+    def test_version_1_file(self):
+        # Write a file as versions before string tables did.
+        key = json.dumps(['c', 'c_total', {'l': 'a'}, 'help'], sort_keys=True).encode()
+        padded = key + b' ' * (8 - (len(key) + 4) % 8)
+        entry = struct.pack(f'i{len(padded)}sdd', len(key), padded, 1.0, 0.0)
+        self.d._m[:8 + len(entry)] = struct.pack('ii', 8 + len(entry), 0) + entry
+        self.d.close()
+
+        self.d = mmap_dict.MmapedDict(self.tempfile)
+        self.d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['a'], 'help'), 2.0, 0.0)
+        self.d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['b'], 'help'), 3.0, 0.0)
+        self.assertEqual(1, self.d._version)
+        self.assertEqual([
+            (key.decode(), 2.0, 0.0),
+            ('["c", "c_total", {"l": "b"}, "help"]', 3.0, 0.0),
+        ], list(self.d.read_all_values()))
+
+    def test_version_1_file_collected(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            d = mmap_dict.MmapedDict(os.path.join(tempdir, 'counter_1.db'))
+            key = '["c", "c_total", {"l": "a"}, "help"]'.encode()
+            padded = key + b' ' * (8 - (len(key) + 4) % 8)
+            entry = struct.pack(f'i{len(padded)}sdd', len(key), padded, 1.0, 0.0)
+            d._m[:8 + len(entry)] = struct.pack('ii', 8 + len(entry), 0) + entry
+            d.close()
+            d = mmap_dict.MmapedDict(os.path.join(tempdir, 'counter_2.db'))
+            d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['a'], 'help'), 2.0, 0.0)
+            d.close()
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry, tempdir)
+            self.assertEqual(3, registry.get_sample_value('c_total', {'l': 'a'}))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_read_all_values_from_file(self):
+        self.d.write_value('abc', 42.0, 987.0)
+        self.d.write_value('def', 17.0, 765.0)
+        self.assertEqual(
+            [('abc', 42.0, 987.0), ('def', 17.0, 765.0)],
+            [(k, v, ts) for k, v, ts, _ in mmap_dict.MmapedDict.read_all_values_from_file(self.tempfile)])
+
+    def test_read_all_values_from_mapped_file(self):
+        self.d.write_value('abc', 42.0, 987.0)
+        with mock.patch.object(mmap_dict, '_MAP_THRESHOLD', 0):
+            with open(self.tempfile, 'rb') as infp:
+                data, used = mmap_dict._read_used_data(infp)
+            self.assertIsInstance(data, mmap.mmap)
+            mmap_dict._release_data(data)
+            self.assertEqual(
+                [('abc', 42.0, 987.0)],
+                [(k, v, ts) for k, v, ts, _ in mmap_dict.MmapedDict.read_all_values_from_file(self.tempfile)])
+
+    def test_read_all_values_from_new_file(self):
+        # A file can be collected between being created and initialized.
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertEqual([], list(mmap_dict.MmapedDict.read_all_values_from_file(path)))
+        finally:
+            os.unlink(path)
+
+    def test_exemplars(self):
+        key = mmap_dict.mmap_key('c', 'c_total', [], [], 'help')
+        self.d.write_value(key, 1.0, 0.0)
+        used = self.d._used
+        self.d.write_exemplar(key, Exemplar({'trace_id': 'ü'}, 1.0, 123.0))
+        # Later exemplars are written in place.
+        self.d.write_exemplar(key, Exemplar({'trace_id': 'b'}, 2.0, 456.0))
+        self.assertEqual(used + 1056, self.d._used)
+        # Exemplars with labels that do not fit are not stored.
+        self.d.write_exemplar(key, Exemplar({'trace_id': '\0' * 200}, 3.0, 789.0))
+        self.d.close()
+        self.d = mmap_dict.MmapedDict(self.tempfile)
+        self.assertEqual(Exemplar({'trace_id': 'b'}, 2.0, 456.0), self.d.read_exemplar(key))
+        self.assertEqual([(key, 1.0, 0.0)], list(self.d.read_all_values()))
+
+    def test_remove_value(self):
+        a = mmap_dict.mmap_key('c', 'c_total', ['l'], ['a'], 'help')
+        b = mmap_dict.mmap_key('c', 'c_total', ['l'], ['b'], 'help')
+        self.d.write_value(a, 1.0, 0.0)
+        self.d.write_exemplar(a, Exemplar({'trace_id': 'a'}, 1.0, 123.0))
+        self.d.write_value(b, 2.0, 0.0)
+        self.d.remove_value(a)
+        self.d.remove_value(a)
+        self.assertEqual([(b, 2.0, 0.0)], list(self.d.read_all_values()))
+        used = self.d._used
+        self.d.close()
+
+        # Free records are reused after reopening the file too.
+        self.d = mmap_dict.MmapedDict(self.tempfile)
+        self.assertEqual((0.0, 0.0), self.d.read_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['c'], 'help')))
+        self.d.write_exemplar(b, Exemplar({'trace_id': 'b'}, 2.0, 456.0))
+        self.assertEqual(used, self.d._used)
+        self.assertEqual(Exemplar({'trace_id': 'b'}, 2.0, 456.0), self.d.read_exemplar(b))
+        self.assertEqual(
+            [(mmap_dict.mmap_key('c', 'c_total', ['l'], ['c'], 'help'), 0.0, 0.0), (b, 2.0, 0.0)],
+            list(self.d.read_all_values()))
+
+    def test_unknown_record_detected(self):
+        self.d.write_value('abc', 42.0, 987.0)
+        self.d._m[8:12] = struct.pack('i', 7)
+        with self.assertRaises(RuntimeError):
+            list(self.d.read_all_values())
+
     def tearDown(self):
         os.unlink(self.tempfile)
 
@@ -646,3 +1155,60 @@ class TestUnsetEnv(unittest.TestCase):
 
     def tearDown(self):
         os.remove(self.tmpfl)
+
+
+@pytest.mark.parametrize('workers', [None, 4])
+@pytest.mark.parametrize('file_count', [16, 256])
+def test_benchmark_collect_files(benchmark, tmp_path, file_count, workers):
+    for pid in range(file_count):
+        d = mmap_dict.MmapedDict(str(tmp_path / f'counter_{pid}.db'))
+        for i in range(20):
+            d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], [str(i)], 'help'), 1, 0)
+        d.close()
+    files = glob.glob(str(tmp_path / '*.db'))
+
+    @benchmark
+    def collect():
+        # Without the file cache, so every scrape parses every file.
+        return MultiProcessCollector._accumulate_metrics(
+            MultiProcessCollector._read_metrics(files, workers=workers), True)
+
+    samples = list(collect)[0].samples
+    assert len(samples) == 20
+    assert samples[0].value == file_count
+
+
+@pytest.mark.parametrize('expected_series', [None, 10000])
+def test_benchmark_mmaped_dict_create_series(benchmark, tmp_path, expected_series):
+    keys = [mmap_dict.mmap_key('c', 'c_total', ['l'], [str(i)], 'help') for i in range(10000)]
+    initial_size = mmap_dict._initial_mmap_size(expected_series)
+    files = (str(tmp_path / f'counter_{i}.db') for i in itertools.count())
+
+    @benchmark
+    def create():
+        d = mmap_dict.MmapedDict(next(files), initial_size=initial_size)
+        for key in keys:
+            d.write_value(key, 1, 0)
+        d.close()
+
+
+@pytest.mark.parametrize('threads', [1, 4, 16])
+def test_benchmark_multiprocess_inc_threads(benchmark, tmp_path, monkeypatch, threads):
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    value_class = MultiProcessValue()
+    children = [
+        Counter('c', 'help', labelnames=['l'], registry=None, value_class=value_class).labels(str(i))
+        for i in range(threads)
+    ]
+
+    def work(child):
+        for _ in range(20000 // threads):
+            child.inc()
+
+    @benchmark
+    def inc():
+        workers = [Thread(target=work, args=(child,)) for child in children]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
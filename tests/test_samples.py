@@ -1,3 +1,4 @@
+import pickle
 import unittest
 
 from prometheus_client import samples
@@ -26,6 +27,31 @@ class TestSamples(unittest.TestCase):
         self.assertEqual(samples.Timestamp(0, 2) < samples.Timestamp(1, 1), True)
         self.assertEqual(samples.Timestamp(2, 0) < samples.Timestamp(1, 1), False)
 
+    def test_labelset(self):
+        labels = samples.LabelSet({'b': '2', 'a': '1'})
+        self.assertEqual(['a', 'b'], list(labels))
+        self.assertEqual({'a': '1', 'b': '2'}, labels)
+        self.assertEqual(labels, samples.LabelSet([('a', '1'), ('b', '2')]))
+        self.assertEqual(hash(labels), hash(samples.LabelSet([('b', '2'), ('a', '1')])))
+        self.assertNotEqual(labels, samples.LabelSet({'a': '1'}))
+        self.assertEqual(labels, pickle.loads(pickle.dumps(labels)))
+        self.assertEqual({}, samples.LabelSet())
+
+        extended = labels._extend((('le', '1'),))
+        self.assertEqual(['a', 'b', 'le'], list(extended))
+        self.assertEqual(hash(samples.LabelSet(extended)), hash(extended))
+        self.assertIs(labels._renderings(), extended._renderings())
+
+        with self.assertRaises(TypeError):
+            labels['c'] = '3'
+        with self.assertRaises(TypeError):
+            del labels['a']
+        with self.assertRaises(TypeError):
+            labels.update({'c': '3'})
+        copy = labels.copy()
+        copy['c'] = '3'
+        self.assertEqual({'a': '1', 'b': '2'}, labels)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import math
+import unittest
+from unittest import mock
+
+from prometheus_client import (
+    CollectorRegistry, generate_latest, Histogram, utils,
+)
+from prometheus_client.utils import floatToGoString
+
+
+class TestFloatToGoString(unittest.TestCase):
+    def test_special_values(self):
+        self.assertEqual('+Inf', floatToGoString(math.inf))
+        self.assertEqual('-Inf', floatToGoString(-math.inf))
+        self.assertEqual('NaN', floatToGoString(math.nan))
+        self.assertEqual('NaN', floatToGoString(math.nan))
+        self.assertEqual('0.0', floatToGoString(0.0))
+        self.assertEqual('-0.0', floatToGoString(-0.0))
+        self.assertEqual('0.0', floatToGoString(0.0))
+
+    def test_integers(self):
+        self.assertEqual('1.0', floatToGoString(1))
+        self.assertEqual('17.0', floatToGoString(17.0))
+        self.assertEqual('-17.0', floatToGoString(-17.0))
+        self.assertEqual('999999.0', floatToGoString(999999))
+        self.assertEqual('1e+06', floatToGoString(1e6))
+        self.assertEqual('1.345758e+06', floatToGoString(1345758))
+        self.assertEqual('2.478268416e+09', floatToGoString(2478268416))
+        self.assertEqual('-1000000.0', floatToGoString(-1e6))
+        self.assertEqual('-1e+16', floatToGoString(-1e16))
+        self.assertEqual('1.0', floatToGoString(True))
+
+    def test_fractions(self):
+        self.assertEqual('0.005', floatToGoString(0.005))
+        self.assertEqual('2.5', floatToGoString('2.5'))
+        self.assertEqual('-0.25', floatToGoString(-0.25))
+        self.assertEqual('1.2345675e+06', floatToGoString(1234567.5))
+
+    def test_memo_is_bounded(self):
+        max_entries = len(utils._GO_STRINGS_PRESET) + 10
+        go_strings = dict(utils._GO_STRINGS_PRESET)
+        with mock.patch.object(utils, '_GO_STRINGS_MAX_ENTRIES', max_entries), \
+                mock.patch.object(utils, '_go_strings', go_strings):
+            for i in range(25):
+                self.assertEqual(repr(i + 0.5), floatToGoString(i + 0.5))
+                self.assertLessEqual(len(go_strings), max_entries)
+            self.assertEqual('+Inf', floatToGoString(math.inf))
+            self.assertEqual('1023.0', floatToGoString(1023))
+            self.assertEqual('1024.0', floatToGoString(1024))
+            self.assertIn(24.5, go_strings)
+        self.assertNotIn(0.0, go_strings)
+        self.assertNotIn(1024.0, go_strings)
+
+
+def test_benchmark_float_to_go_string(benchmark):
+    values = [float(i) for i in range(100000)] + [0.005, 0.25, 2.5, 7.5, math.inf] * 20000
+
+    def format_values():
+        return [floatToGoString(v) for v in values]
+
+    assert len(benchmark(format_values)) == 200000
+
+
+def test_benchmark_generate_latest_histograms(benchmark):
+    # 60 histograms with 100 children of 17 buckets, sum, count and created
+    # make up over 100k samples.
+    registry = CollectorRegistry()
+    for i in range(60):
+        h = Histogram(f'h{i}', 'help', ['path'], registry=registry)
+        for j in range(100):
+            h.labels(f'/path/{j}').observe(j / 10)
+    output = benchmark(generate_latest, registry)
+    assert output.count(b'\n') > 100000
+
+
+if __name__ == '__main__':
+    unittest.main()
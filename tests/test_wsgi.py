@@ -1,9 +1,15 @@
 import gzip
+import threading
 from unittest import TestCase
+from unittest.mock import patch
 from wsgiref.util import setup_testing_defaults
 
-from prometheus_client import CollectorRegistry, Counter, make_wsgi_app
-from prometheus_client.exposition import _bake_output, CONTENT_TYPE_PLAIN_0_0_4
+from prometheus_client import (
+    CollectorRegistry, Counter, generate_latest, make_wsgi_app,
+)
+from prometheus_client.exposition import (
+    _OutputCache, _stream_output, CONTENT_TYPE_PLAIN_0_0_4,
+)
 
 
 class WSGITest(TestCase):
@@ -69,8 +75,8 @@ class WSGITest(TestCase):
     def test_favicon_path(self):
         from unittest.mock import patch
 
-        # Create mock to enable counting access of _bake_output
-        with patch("prometheus_client.exposition._bake_output", side_effect=_bake_output) as mock:
+        # Create mock to enable counting access of _stream_output
+        with patch("prometheus_client.exposition._stream_output", side_effect=_stream_output) as mock:
             # Create and run WSGI app
             app = make_wsgi_app(self.registry)
             # Try accessing the favicon path
@@ -112,3 +118,75 @@ class WSGITest(TestCase):
         outputs = app(gzip_environ, self.capture)
         # Assert outputs are not compressed.
         self.assert_outputs(outputs, metric_name, help_text, increments, compressed=False)
+
+    def test_streaming(self):
+        for i in range(2000):
+            Counter(f'c{i}', 'help ' * 20, registry=self.registry).inc()
+        expected = generate_latest(self.registry)
+        app = make_wsgi_app(self.registry)
+        outputs = list(app(self.environ, self.capture))
+        self.assertGreater(len(outputs), 1)
+        self.assertEqual(expected, b''.join(outputs))
+        gzip_environ = dict(self.environ)
+        gzip_environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        outputs = list(app(gzip_environ, self.capture))
+        self.assertIn(("Content-Encoding", "gzip"), self.captured_headers)
+        self.assertEqual(expected, gzip.decompress(b''.join(outputs)))
+
+    def test_cache(self):
+        c = Counter('counter', 'A counter', registry=self.registry)
+        c.inc()
+        now = [1000.0]
+        with patch('time.monotonic', lambda: now[0]):
+            app = make_wsgi_app(self.registry, cache_max_age=5)
+            self.assert_outputs(app(self.environ, self.capture), 'counter', 'A counter', 1, compressed=False)
+            c.inc()
+            now[0] += 4
+            self.assert_outputs(app(self.environ, self.capture), 'counter', 'A counter', 1, compressed=False)
+            # Compressed output is cached separately.
+            gzip_environ = dict(self.environ)
+            gzip_environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+            self.assert_outputs(app(gzip_environ, self.capture), 'counter', 'A counter', 2, compressed=True)
+            now[0] += 2
+            self.assert_outputs(app(self.environ, self.capture), 'counter', 'A counter', 2, compressed=False)
+
+    def test_cache_name_filter(self):
+        Counter('a', 'A counter', registry=self.registry).inc()
+        Counter('b', 'B counter', registry=self.registry).inc(2)
+        app = make_wsgi_app(self.registry, cache_max_age=60)
+        for name, expected in (('a', 1), ('b', 2), ('a', 1)):
+            environ = dict(self.environ)
+            environ['QUERY_STRING'] = f'name[]={name}_total'
+            output = app(environ, self.capture)[0].decode('utf8')
+            self.assertIn(f'\n{name}_total {expected}.0\n', output)
+            self.assertNotIn('a_total' if name == 'b' else 'b_total', output)
+
+    def test_cache_single_flight(self):
+        cache = _OutputCache(60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def bake():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return len(calls)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('k', bake))) for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual([1, 1, 1, 1], results)
+        self.assertEqual(1, len(calls))
+
+    def test_cache_bounded(self):
+        cache = _OutputCache(60)
+        for i in range(_OutputCache.MAX_ENTRIES + 10):
+            self.assertEqual(i, cache.get(i, lambda: i))
+        self.assertEqual(_OutputCache.MAX_ENTRIES, len(cache._entries))